@@ -1,18 +1,22 @@
 import gzip
 import datetime
+import sys
 from pathlib import Path
 
 import xarray
 import numpy as np
 import pandas
 
-from pyrealm.core.hygro import convert_vp_to_vpd
 from pyrealm.core.pressure import calc_patm
 from pyrealm.pmodel import PModelEnvironment, PModel
 
 
 root = Path("/rds/general/project/lemontree/live")
 
+# Shared tools
+sys.path.append(str(root / "tools"))
+from unit_conversions import cru_vap_to_vpd, swdown_to_ppfd  # noqa: E402
+
 # CRU TS data: Mean monthly temperature (°C) and Mean monthly vapour pressure (hPa)
 # Dimensions:  (lon: 720, lat: 360, time: 120)
 
@@ -61,15 +65,13 @@ class ProcessData:
         )
 
         # Convert VP in hPa to kPA and then to VPD in kPa and then to VPD in Pa and then
-        # clip values below zero and discard the VAP data
-        self.monthly_data["vpd"] = (
-            convert_vp_to_vpd(
-                vp=self.monthly_data["vap"] / 10, ta=self.monthly_data["tmp"]
-            )
-            * 1000
+        # clip values below zero.
+        vpd = self.monthly_data.pop("vap").rename("vpd")
+        vpd.attrs.clear()
+        vpd.values = cru_vap_to_vpd(
+            vap=vpd.to_numpy(), tmp=self.monthly_data["tmp"].to_numpy()
         )
-        self.monthly_data["vpd"] = self.monthly_data["vpd"].clip(min=0)
-        del self.monthly_data["vap"]
+        self.monthly_data["vpd"] = vpd
 
         # Get the years provided by this instance (remembering to exclude the last
         # padded day)
@@ -142,7 +144,7 @@ for cru_decade in cru_data_by_decade:
 
         # Get PPFD - slower step for WFDE5. Both sources provide SWDown in W/m2,
         # converted to PPFD inµmol/m2/s using 2.04 µmol W-1.
-        ppfd = swdown_monthly_mean[swdown_var].to_numpy() * 2.04
+        ppfd = swdown_to_ppfd(swdown_monthly_mean[swdown_var].to_numpy())
 
         # Fit the P Models with the default Stocker kphio and then with the theoretical
         # maximum value of 1/8
@@ -14,6 +14,10 @@ from pyrealm.core.calendar import Calendar
 
 root = Path("/rds/general/project/lemontree/live")
 
+# Shared tools
+sys.path.append(str(root / "tools"))
+from unit_conversions import cloud_to_sunshine_fraction  # noqa: E402
+
 # CRU TS data: Mean monthly temperature (°C), total monthly precipitation (mm) and mean
 # monthly cloud cover (%)
 # Dimensions:  (lon: 720, lat: 360, time: 120)
@@ -78,9 +82,11 @@ def process_data(decade_files):
         # Now forward fill the data and ditch the padded entry
         data[var] =  monthly_data.resample(time='1D').ffill().isel(time=slice(0,-1))
 
-    # Convert cloud cover
-    data['sf'] = 1 - data['cld']/100
-    del data['cld']
+    # Convert cloud cover to sunshine fraction
+    sf = data.pop('cld').rename('sf')
+    sf.attrs.clear()
+    sf.values = cloud_to_sunshine_fraction(sf.to_numpy())
+    data['sf'] = sf
 
     return data
 
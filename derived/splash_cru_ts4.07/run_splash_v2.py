@@ -14,6 +14,10 @@ from pyrealm.core.calendar import Calendar
 
 root = Path("/rds/general/project/lemontree/live")
 
+# Shared tools
+sys.path.append(str(root / "tools"))
+from unit_conversions import cloud_to_sunshine_fraction  # noqa: E402
+
 # CRU TS data: Mean monthly temperature (°C), total monthly precipitation (mm) and mean
 # monthly cloud cover (%)
 # Dimensions:  (lon: 720, lat: 360, time: 120)
@@ -82,9 +86,11 @@ class ProcessData():
             # Now store the monthly data
             self.monthly_data[var] =  var_data
 
-        # Convert cloud cover
-        self.monthly_data['sf'] = 1 - self.monthly_data['cld']/100
-        del self.monthly_data['cld']
+        # Convert cloud cover to sunshine fraction
+        sf = self.monthly_data.pop('cld').rename('sf')
+        sf.attrs.clear()
+        sf.values = cloud_to_sunshine_fraction(sf.to_numpy())
+        self.monthly_data['sf'] = sf
 
         # Remove low temperatures by clipping to -25
         self.monthly_data['tmp'] = self.monthly_data['tmp'].clip(min=-25)
@@ -0,0 +1,313 @@
+"""Build a time-contiguous, spatially tiled mirror of WFDE5 variables.
+
+The WFDE5 v2 source files contain hourly global data for a single variable and month.
+That layout works well for maps but is very slow for site or small region time series,
+which need to read and decompress every global monthly file. This script builds a
+rechunked mirror of selected variables as Zarr stores in which each chunk holds ten
+years of hourly data for a tile of 8 x 8 cells (4° x 4°), so the full record for a
+site comes from a handful of chunks:
+
+    tair = xarray.open_zarr("rechunked/Tair.zarr")["Tair"]
+    tair.sel(lat=51.4, lon=-0.6, method="nearest")
+
+The rechunking runs in two stages, both of which use bounded memory and can be resumed:
+
+1. ``year``: For a given variable and year, each monthly source file is read in blocks
+   of time steps into a scratch memory-mapped array on disk holding the whole year, so
+   each source file is only read once. The year is then written from the scratch array
+   in bands of tile rows to an annual store (``rechunked/years/Tair_1990.zarr``)
+   chunked as (year, 8, 8). The annual store is written to a temporary path and
+   renamed once complete, so existing annual stores are skipped.
+
+2. ``merge``: Once all of the annual stores for a variable exist, they are combined
+   into the final store (``rechunked/Tair.zarr``). The final store is preallocated and
+   then written in blocks of tile rows and columns covering the full time series, so
+   each chunk is written once. A marker file is written as each band of tile rows is
+   completed and completed bands are skipped when the merge is rerun. Once all bands
+   are complete, a marker file is written for the variable (e.g.
+   ``rechunked/merge_progress/Tair.done``) and the annual stores are removed unless
+   ``--keep-years`` is set.
+
+Usage:
+
+    python rechunk_wfde5.py year Tair Qair --year 1990
+    python rechunk_wfde5.py merge Tair
+    python rechunk_wfde5.py status
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import textwrap
+from pathlib import Path
+
+import dask.array
+import netCDF4
+import numpy as np
+import xarray
+
+# Paths
+root = Path("/rds/general/project/lemontree/live")
+source_path = root / "source/wfde5/wfde5_v2"
+output_path = root / "derived/wfde5/wfde5_v2/rechunked"
+
+# The variables to mirror and the years covered by WFDE5 v2
+VARIABLES = ["PSurf", "Qair", "SWdown", "Tair"]
+YEARS = range(1979, 2020)
+
+# The tile size in grid cells, the number of hours in each chunk of the final stores
+# and the number of time steps read from a source file at once.
+TILE = 8
+TIME_CHUNK = 24 * 365 * 10
+READ_STEPS = 24 * 7
+
+# The number of tile columns written at once when merging the annual stores, which
+# limits the merge memory to roughly 41 years x 8 rows x 96 columns of float32.
+MERGE_COLUMNS = TILE * 12
+
+
+def year_store(var, year):
+    """Get the path of the annual store for a variable."""
+    return output_path / "years" / f"{var}_{year}.zarr"
+
+
+def final_store(var):
+    """Get the path of the final store for a variable."""
+    return output_path / f"{var}.zarr"
+
+
+def band_marker(var, band):
+    """Get the path of the completion marker for a band of the final store."""
+    return output_path / "merge_progress" / f"{var}_band_{band:03d}.done"
+
+
+def merge_marker(var):
+    """Get the path of the completion marker for the final store."""
+    return output_path / "merge_progress" / f"{var}.done"
+
+
+def read_times(nc_var_time):
+    """Decode a NetCDF time variable to datetime64[ns] values."""
+
+    times = netCDF4.num2date(
+        nc_var_time[:],
+        units=nc_var_time.units,
+        calendar=getattr(nc_var_time, "calendar", "standard"),
+        only_use_cftime_datetimes=False,
+        only_use_python_datetimes=True,
+    )
+
+    return np.array(times, dtype="datetime64[ns]")
+
+
+def rechunk_year(var, year):
+    """Write the annual tiled store for a variable and year.
+
+    Returns False if the annual store already exists.
+    """
+
+    out_store = year_store(var, year)
+    if out_store.exists():
+        return False
+
+    source_files = sorted((source_path / var / str(year)).glob("*.nc"))
+    if len(source_files) != 12:
+        raise FileNotFoundError(f"Expected 12 files for {var} {year}")
+
+    # Get the grid and the times for the year from the source files
+    times = []
+    for each_file in source_files:
+        with netCDF4.Dataset(each_file) as ds:
+            times.append(read_times(ds["time"]))
+            if each_file == source_files[0]:
+                lat = ds["lat"][:].filled(np.nan)
+                lon = ds["lon"][:].filled(np.nan)
+
+    times = np.concatenate(times)
+    shape = (len(times), len(lat), len(lon))
+
+    # Read the source files in blocks of time steps into a scratch memory map holding
+    # the whole year, using the PBS job temporary directory if available.
+    scratch_dir = os.getenv("TMPDIR", tempfile.gettempdir())
+    with tempfile.NamedTemporaryFile(dir=scratch_dir, suffix=".dat") as scratch:
+        year_data = np.memmap(scratch.name, dtype="float32", mode="w+", shape=shape)
+
+        offset = 0
+        for each_file in source_files:
+            with netCDF4.Dataset(each_file) as ds:
+                data_var = ds[var]
+                n_steps = data_var.shape[0]
+                for start in range(0, n_steps, READ_STEPS):
+                    stop = min(start + READ_STEPS, n_steps)
+                    year_data[offset + start : offset + stop] = np.ma.filled(
+                        data_var[start:stop].astype("float32"), np.nan
+                    )
+                offset += n_steps
+
+        # Create the annual store at a temporary path and then write the scratch data in
+        # bands of tile rows, so that each chunk is written once.
+        temp_store = out_store.with_suffix(".tmp")
+        if temp_store.exists():
+            shutil.rmtree(temp_store)
+
+        template = xarray.Dataset(
+            data_vars={
+                var: (
+                    ("time", "lat", "lon"),
+                    dask.array.full(
+                        shape, np.nan, dtype="float32", chunks=(len(times), TILE, TILE)
+                    ),
+                )
+            },
+            coords={"time": times, "lat": lat, "lon": lon},
+        )
+        template.to_zarr(temp_store, mode="w-", compute=False)
+
+        for row in range(0, len(lat), TILE):
+            rows = slice(row, row + TILE)
+            band = xarray.Dataset(
+                {var: (("time", "lat", "lon"), np.array(year_data[:, rows, :]))}
+            )
+            band.to_zarr(temp_store, mode="r+", region={"lat": rows})
+
+        del year_data
+
+    temp_store.rename(out_store)
+
+    return True
+
+
+def merge_years(var, keep_years=False):
+    """Merge the annual stores for a variable into the final store.
+
+    Returns False if any annual stores are missing.
+    """
+
+    if merge_marker(var).exists():
+        return True
+
+    year_stores = [year_store(var, year) for year in YEARS]
+    if not all(store.exists() for store in year_stores):
+        return False
+
+    out_store = final_store(var)
+    year_data = [xarray.open_zarr(store)[var] for store in year_stores]
+    times = np.concatenate([data["time"].values for data in year_data])
+    lat = year_data[0]["lat"].values
+    lon = year_data[0]["lon"].values
+
+    # Preallocate the final store with the time contiguous chunks
+    if not out_store.exists():
+        template = xarray.Dataset(
+            data_vars={
+                var: (
+                    ("time", "lat", "lon"),
+                    dask.array.full(
+                        (len(times), len(lat), len(lon)),
+                        np.nan,
+                        dtype="float32",
+                        chunks=(TIME_CHUNK, TILE, TILE),
+                    ),
+                )
+            },
+            coords={"time": times, "lat": lat, "lon": lon},
+        )
+        template.to_zarr(out_store, mode="w-", compute=False)
+
+    # Write the full time series for blocks of tiles, one band of tile rows at a time
+    for band, row in enumerate(range(0, len(lat), TILE)):
+        marker = band_marker(var, band)
+        if marker.exists():
+            continue
+
+        rows = slice(row, row + TILE)
+        for col in range(0, len(lon), MERGE_COLUMNS):
+            cols = slice(col, col + MERGE_COLUMNS)
+            block = np.concatenate(
+                [data[:, rows, cols].values for data in year_data], axis=0
+            )
+            block_ds = xarray.Dataset({var: (("time", "lat", "lon"), block)})
+            block_ds.to_zarr(out_store, mode="r+", region={"lat": rows, "lon": cols})
+
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+
+    # All of the bands are now complete, so mark the variable as complete and tidy up
+    merge_marker(var).touch()
+    for marker in (output_path / "merge_progress").glob(f"{var}_band_*.done"):
+        marker.unlink()
+
+    if not keep_years:
+        for store in year_stores:
+            shutil.rmtree(store)
+
+    return True
+
+
+def print_status(variables):
+    """Print the rechunking progress for each variable."""
+
+    for var in variables:
+        if merge_marker(var).exists():
+            status = "complete"
+        elif final_store(var).exists():
+            n_bands = len(list(band_marker(var, 0).parent.glob(f"{var}_band_*.done")))
+            status = f"merging, {n_bands} bands complete"
+        else:
+            n_years = sum(year_store(var, year).exists() for year in YEARS)
+            status = f"{n_years} of {len(YEARS)} years"
+
+        print(f"{var}: {status}")
+
+
+def rechunk_wfde5_cli():
+    """Build a time-contiguous, tiled mirror of WFDE5 variables.
+
+    The year command writes the annual tiled store for a variable and year and the
+    merge command combines the annual stores for a variable into the final store. When
+    run as a PBS array job, the year command uses PBS_ARRAY_INDEX as the year if no
+    year is given.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(rechunk_wfde5_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    year_parser = subparsers.add_parser("year", help="Write annual stores")
+    year_parser.add_argument("variables", nargs="+", choices=VARIABLES)
+    year_parser.add_argument(
+        "--year", type=int, default=os.getenv("PBS_ARRAY_INDEX"), help="The year"
+    )
+
+    merge_parser = subparsers.add_parser("merge", help="Merge annual stores")
+    merge_parser.add_argument("variables", nargs="+", choices=VARIABLES)
+    merge_parser.add_argument(
+        "--keep-years", action="store_true", help="Keep the annual stores"
+    )
+
+    subparsers.add_parser("status", help="Show the rechunking progress")
+
+    args = parser.parse_args()
+
+    if args.command == "year":
+        if args.year is None:
+            parser.error("No year given and PBS_ARRAY_INDEX is not set")
+        for var in args.variables:
+            done = rechunk_year(var, int(args.year))
+            print(f"{var} {args.year}: {'written' if done else 'already exists'}")
+    elif args.command == "merge":
+        for var in args.variables:
+            done = merge_years(var, keep_years=args.keep_years)
+            print(f"{var}: {'merged' if done else 'annual stores missing'}")
+    else:
+        print_status(VARIABLES)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    rechunk_wfde5_cli()
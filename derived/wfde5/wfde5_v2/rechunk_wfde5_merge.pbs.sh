@@ -0,0 +1,30 @@
+#!/bin/bash
+
+# Merge the annual tiled WFDE5 stores into the final time-contiguous stores, with one
+# job per variable. Completed bands of the final stores are skipped, so a failed merge
+# can be resubmitted. Submit once the annual stores job array has completed:
+#
+#   YEARS_JOB=$(qsub rechunk_wfde5_years.pbs.sh)
+#   qsub -W depend=afterok:$YEARS_JOB rechunk_wfde5_merge.pbs.sh
+
+#PBS -lselect=1:ncpus=1:mem=16gb
+#PBS -lwalltime=24:00:00
+#PBS -j oe
+#PBS -J 0-3
+#PBS -o /rds/general/project/lemontree/live/derived/wfde5/wfde5_v2/rechunked/rechunk_wfde5_merge.out
+
+variables=(PSurf Qair SWdown Tair)
+var=${variables[$PBS_ARRAY_INDEX]}
+
+# Activate the conda environment
+eval "$(~/miniforge3/bin/conda shell.bash hook)"
+conda activate pyrealm_py312
+
+python --version
+date
+
+python /rds/general/project/lemontree/live/derived/wfde5/wfde5_v2/rechunk_wfde5.py \
+    merge $var
+
+date
+conda deactivate
@@ -0,0 +1,30 @@
+#!/bin/bash
+
+# Write the annual tiled WFDE5 stores for the rechunked mirror as a job array over the
+# years 1979 - 2019. Each job writes the annual stores for all of the mirrored variables
+# for a single year, skipping any annual stores that already exist, so the job array
+# can simply be resubmitted to fill in any failed years.
+
+# NOTES:
+#
+# * Each variable year is read into a ~9GB scratch memory map in the job TMPDIR, so
+#   the memory use is bounded by the page cache rather than the data size.
+
+#PBS -lselect=1:ncpus=1:mem=16gb:ephemeral=20gb
+#PBS -lwalltime=08:00:00
+#PBS -j oe
+#PBS -J 1979-2019
+#PBS -o /rds/general/project/lemontree/live/derived/wfde5/wfde5_v2/rechunked/rechunk_wfde5_years.out
+
+# Activate the conda environment
+eval "$(~/miniforge3/bin/conda shell.bash hook)"
+conda activate pyrealm_py312
+
+python --version
+date
+
+python /rds/general/project/lemontree/live/derived/wfde5/wfde5_v2/rechunk_wfde5.py \
+    year PSurf Qair SWdown Tair
+
+date
+conda deactivate
@@ -1,8 +1,13 @@
+import sys
 import xarray as xr
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
+# Shared tools, located relative to this script so that it also runs from a mapped drive
+sys.path.append(str(Path(__file__).resolve().parents[3] / "tools"))
+from gathered_grids import GatherIndex, iter_unpacked, unpack_dataarray  # noqa: E402
+
 # pathway
 input_file = r"Z:\ephemeral\crujra.v2.5.5d.dlwrf.1980.365d.noc.nc\crujra.v2.5.5d.dlwrf.1980.365d.noc.nc"
 output_file   = r"Z:\ephemeral\crujra.v2.5.5d.dlwrf.1980.365d.noc.nc\crujra.v2.5.5d.dlwrf.1980.365d.hr.noc.nc"
@@ -138,37 +143,22 @@ ds_flat.to_netcdf(flat_file, format="NETCDF4", encoding=encoding_flat)
 
 print("Wrote flattened hourly file:", flat_file)
 
-# reconstruct 3d data
-dlwrf_flat = ds_flat["dlwrf"]            # (time, location)
-lat_index  = ds_flat["lat_index"].values
-lon_index  = ds_flat["lon_index"].values
-time       = ds_flat["time"]
-
-lat_grid = ds_flat["lat_full"].values    
-lon_grid = ds_flat["lon_full"].values    
-
-n_time = dlwrf_flat.sizes["time"]
-n_lat  = lat_grid.size
-n_lon  = lon_grid.size
-
-# fill 3d array
-dlwrf_3d = np.full((n_time, n_lat, n_lon), np.nan, dtype=np.float32)
-
-# Fill land points
-for loc in range(dlwrf_flat.sizes["location"]):
-    i_lat = lat_index[loc]
-    i_lon = lon_index[loc]
-    dlwrf_3d[:, i_lat, i_lon] = dlwrf_flat[:, loc].values
-
-ds_recon = xr.Dataset(
-    data_vars={"dlwrf": (("time", "lat_full", "lon_full"), dlwrf_3d)},
-    coords={
-        "time":     time,
-        "lat_full": (("lat_full",), lat_grid),
-        "lon_full": (("lon_full",), lon_grid),
-    },
-    attrs=ds_flat.attrs
+# reconstruct 3d data - the land locations are scattered back onto the full grid with a
+# single indexed assignment using the saved index map
+index = GatherIndex.from_indices(
+    ds_flat["lat_full"].values,
+    ds_flat["lon_full"].values,
+    ds_flat["lat_index"].values,
+    ds_flat["lon_index"].values,
 )
 
-ds_recon = ds_recon.rename({"lat_full": "lat", "lon_full": "lon"})
-print(ds_recon)
\ No newline at end of file
+dlwrf_3d = unpack_dataarray(ds_flat["dlwrf"], index, cell_dim="location")
+ds_recon = xr.Dataset({"dlwrf": dlwrf_3d}, attrs=ds_flat.attrs)
+print(ds_recon)
+
+# Partial periods can be reconstructed a chunk of time steps at a time, without
+# allocating the full (time, lat, lon) cube - for example, daily grids for one week.
+for day_grid in iter_unpacked(
+    ds_flat["dlwrf"].isel(time=slice(0, 24 * 7)), index, 24, cell_dim="location"
+):
+    print(day_grid["time"].values[0], float(day_grid.mean()))
\ No newline at end of file
@@ -1,24 +1,24 @@
 #!/bin/bash
 
-# This script runs the download of the ERA5 data on a compute node, not the login. The
-# script is set up to run a Python script that allocates different variables and
-# different year ranges to different workers.
+# This script converts the CDSAPI GRIB downloads to NetCDF on a compute node, not the
+# login. Both variables are converted in one job, with the monthly files spread across
+# NCPUS worker processes. Converted months and GRIB files that are still downloading
+# are skipped, so the job can be resubmitted while the downloads are running.
 
-# Use the throughput class - single node, single cpu
-#PBS -lselect=1:ncpus=1:mem=96gb
+# Use the throughput class - single node, several cpus
+#PBS -lselect=1:ncpus=8:mem=16gb
 #PBS -lwalltime=24:00:00
 #PBS -j oe
-#PBS -J 1-4
-#PBS -o /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/CDSAPI_grib_convert_^array_index^.out
+#PBS -o /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/CDSAPI_grib_convert.out
 
 eval "$(~/miniforge3/bin/conda shell.bash hook)"
 
 # Activate a conda environment python314_xarray, which needs:
-# cdsswwarm
+# earthkit-data (which provides eccodes) and netCDF4
 
 conda activate python314_xarray
 
-python /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/CDSAPI_grib_convert.py
+python /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/CDSAPI_GRIB_convert.py mx2t mn2t
 
 conda deactivate # Out of python314_xarray
 conda deactivate # Out of base
@@ -1,38 +1,313 @@
-"""Simple conversion tool using ECMWF earthkit.data to convert CDS GRIB to NetCDF."""
+"""Convert the monthly CDSAPI GRIB downloads to NetCDF.
 
-import sys
+The original conversion used earthkit.data to load each month of GRIB data into xarray
+in one go, which holds the whole month in memory as float64 and then a float32 copy,
+and converted every file in turn, including files that had already been converted. This
+script instead:
+
+* Converts the files across a pool of worker processes (NCPUS), with each worker
+  converting one monthly file at a time.
+* Reads the GRIB messages one at a time using eccodes, which is installed along with
+  earthkit.data, and writes each message directly as float32 into its time step in an
+  output file that is created with the full set of hourly time steps for the month.
+  Only a single field is ever held in memory.
+* Places each message using its validity date and time, so the output is in time order
+  even if the messages are not, and checks that every hour in the month is written
+  exactly once before the output file is renamed from a temporary file to its final
+  name.
+* Skips months where the NetCDF file already exists and contains every hour, and GRIB
+  files that do not yet contain every hour, such as files that are still being
+  downloaded. The script can therefore be rerun while the downloads are in progress and
+  will convert any newly completed months.
+
+The output files use the same structure as the previous earthkit conversion: a
+``time(time)`` axis, ``latitude`` and ``longitude`` axes in the order of the GRIB grid
+and a float32 ``var(time, latitude, longitude)`` data variable.
+
+Usage:
+
+    python CDSAPI_GRIB_convert.py mx2t mn2t
+"""
+
+import argparse
+import calendar
 import os
+import re
+import sys
+import textwrap
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
-import earthkit.data as ekd
+import eccodes
+import netCDF4
+import numpy as np
+
+# The directory containing the GRIB files in a subdirectory for each variable
+src_root = Path("/rds/general/project/lemontree/ephemeral/ERA5_CDSAPI")
+
+VARIABLES = ("mx2t", "mn2t")
+
+# Monthly files are named as var_year_month.grib
+FILE_PATTERN = re.compile(r"(?P<var>\w+?)_(?P<year>\d{4})_(?P<month>\d{2})$")
+
+
+def expected_hours(path: Path) -> tuple[np.datetime64, int]:
+    """Get the start and the number of hourly time steps of a monthly file.
+
+    Args:
+        path: A GRIB or NetCDF file named as var_year_month.
+    """
+
+    match = FILE_PATTERN.match(path.stem)
+    if match is None:
+        raise ValueError(f"Cannot get the month from the file name: {path.name}")
+
+    year, month = int(match["year"]), int(match["month"])
+    start = np.datetime64(f"{year}-{month:02}-01T00", "h")
+
+    return start, calendar.monthrange(year, month)[1] * 24
+
+
+def is_converted(path: Path) -> bool:
+    """Check that a NetCDF file exists and contains every hour in the month."""
+
+    if not path.exists():
+        return False
+
+    _, n_hours = expected_hours(path)
+    try:
+        with netCDF4.Dataset(path) as nc_file:
+            return nc_file["time"].shape[0] == n_hours
+    except (OSError, IndexError):
+        return False
+
+
+def grib_is_complete(path: Path) -> bool:
+    """Check that a GRIB file contains a message for every hour in the month."""
+
+    _, n_hours = expected_hours(path)
+    with open(path, "rb") as grib_file:
+        return eccodes.codes_count_in_file(grib_file) == n_hours
+
+
+def grid_axes(gid) -> tuple[np.ndarray, np.ndarray]:
+    """Get the latitude and longitude axes of a regular GRIB grid."""
+
+    if eccodes.codes_get(gid, "gridType") != "regular_ll":
+        raise ValueError("Only regular latitude and longitude grids are supported")
+
+    lat = np.linspace(
+        eccodes.codes_get(gid, "latitudeOfFirstGridPointInDegrees"),
+        eccodes.codes_get(gid, "latitudeOfLastGridPointInDegrees"),
+        eccodes.codes_get(gid, "Nj"),
+    )
+    lon = np.linspace(
+        eccodes.codes_get(gid, "longitudeOfFirstGridPointInDegrees"),
+        eccodes.codes_get(gid, "longitudeOfLastGridPointInDegrees"),
+        eccodes.codes_get(gid, "Ni"),
+    )
+
+    return lat, lon
+
+
+def create_output(path: Path, gid, start: np.datetime64, n_hours: int):
+    """Create the output NetCDF file for a month using the first GRIB message.
+
+    The file is created with every hourly time step in the month, so that each message
+    can be written directly to its time step.
+
+    Returns:
+        The open NetCDF dataset and the data variable.
+    """
+
+    lat, lon = grid_axes(gid)
+    var = eccodes.codes_get(gid, "shortName")
+
+    ds = netCDF4.Dataset(path, "w")
+    ds.Conventions = "CF-1.8"
+    ds.institution = "European Centre for Medium-Range Weather Forecasts"
+    ds.history = "Converted from GRIB by CDSAPI_GRIB_convert.py"
+
+    ds.createDimension("time", n_hours)
+    ds.createDimension("latitude", len(lat))
+    ds.createDimension("longitude", len(lon))
+
+    time_var = ds.createVariable("time", "f8", ("time",))
+    time_var.standard_name = "time"
+    time_var.units = f"hours since {start.astype(object):%Y-%m-%d %H:%M:%S}"
+    time_var.calendar = "proleptic_gregorian"
+    time_var[:] = np.arange(n_hours)
+
+    for name, values, units in (
+        ("latitude", lat, "degrees_north"),
+        ("longitude", lon, "degrees_east"),
+    ):
+        axis_var = ds.createVariable(name, "f8", (name,))
+        axis_var.standard_name = name
+        axis_var.units = units
+        axis_var[:] = values
+
+    data_var = ds.createVariable(
+        var,
+        "f4",
+        ("time", "latitude", "longitude"),
+        zlib=True,
+        complevel=4,
+        fill_value=np.float32(np.nan),
+        chunksizes=(1, len(lat), len(lon)),
+    )
+    data_var.long_name = eccodes.codes_get(gid, "name")
+    data_var.units = eccodes.codes_get(gid, "units")
+    data_var.GRIB_paramId = eccodes.codes_get(gid, "paramId")
+    cf_name = eccodes.codes_get(gid, "cfName")
+    if cf_name != "unknown":
+        data_var.standard_name = cf_name
+
+    return ds, data_var
+
+
+def validity_time(gid) -> np.datetime64:
+    """Get the validity time of a GRIB message."""
+
+    date = str(eccodes.codes_get(gid, "validityDate"))
+    hhmm = eccodes.codes_get(gid, "validityTime")
+
+    return np.datetime64(f"{date[:4]}-{date[4:6]}-{date[6:]}T{hhmm // 100:02}", "h")
+
+
+def convert_grib(source: Path, dest: Path) -> int:
+    """Convert a monthly GRIB file to NetCDF, one message at a time.
+
+    Args:
+        source: The GRIB file.
+        dest: The NetCDF file.
+
+    Returns:
+        The number of time steps written.
+    """
+
+    start, n_hours = expected_hours(source)
+    written = np.zeros(n_hours, dtype="bool")
+    temp_file = dest.with_suffix(".tmp")
+    ds = None
+
+    try:
+        with open(source, "rb") as grib_file:
+            while (gid := eccodes.codes_grib_new_from_file(grib_file)) is not None:
+                try:
+                    if ds is None:
+                        ds, data_var = create_output(temp_file, gid, start, n_hours)
+                        shape = data_var.shape[1:]
+
+                    # Find the time step for the message
+                    step = int((validity_time(gid) - start) / np.timedelta64(1, "h"))
+                    if not 0 <= step < n_hours:
+                        raise ValueError(f"Message outside of the month in {source}")
+                    if written[step]:
+                        raise ValueError(f"Repeated time step in {source}")
+
+                    # Convert the field to float32 with missing values as NaN
+                    values = eccodes.codes_get_values(gid).astype("float32")
+                    if eccodes.codes_get(gid, "bitmapPresent"):
+                        missing = eccodes.codes_get(gid, "missingValue")
+                        values[values == np.float32(missing)] = np.nan
+
+                    data_var[step] = values.reshape(shape)
+                    written[step] = True
+                finally:
+                    eccodes.codes_release(gid)
+    finally:
+        if ds is not None:
+            ds.close()
+
+    if not written.all():
+        temp_file.unlink(missing_ok=True)
+        raise ValueError(f"Missing {np.sum(~written)} of {n_hours} hours in {source}")
+
+    temp_file.replace(dest)
+
+    return int(written.sum())
+
+
+def find_pending(variables: list[str]) -> list[tuple[Path, Path]]:
+    """Find the GRIB files that are complete but not yet converted.
+
+    Returns:
+        A list of tuples of the source GRIB file and destination NetCDF file.
+    """
+
+    pending = []
+    for var in variables:
+        for source in sorted((src_root / var).glob("*.grib")):
+            dest = source.with_suffix(".nc")
+            if is_converted(dest):
+                continue
+            if not grib_is_complete(source):
+                print(f"Skipping incomplete {source}")
+                continue
+            pending.append((source, dest))
+
+    return pending
+
+
+def grib_convert_cli():
+    """Convert the monthly CDSAPI GRIB downloads to NetCDF.
+
+    The GRIB files for each variable are converted in parallel across NCPUS worker
+    processes, writing the NetCDF files into the same directory. Months that have
+    already been converted and GRIB files that do not yet contain every hour are
+    skipped.
+    """
 
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(grib_convert_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "variables",
+        nargs="*",
+        metavar="variable",
+        help=f"The variables to convert (default: {' '.join(VARIABLES)})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("NCPUS", 1)),
+        help="The number of worker processes",
+    )
 
-def convert_GRIB_to_NetCDF(source: Path, dest: Path):
+    args = parser.parse_args()
 
-    # Load the data from a GRIB file
-    grib_data = ekd.from_source("file", source)
+    # The variables are checked here, as argparse checks an empty list against choices
+    variables = args.variables or VARIABLES
+    unknown = set(variables).difference(VARIABLES)
+    if unknown:
+        parser.error(f"Unknown variables: {', '.join(sorted(unknown))}")
 
-    # Convert it using valid_time dimensions and dropping the optional earthkit metadata
-    xarray_data = grib_data.to_xarray(time_dims="valid_time", add_earthkit_attrs=False)
+    pending = find_pending(variables)
+    print(f"{len(pending)} files to convert")
 
-    # Rename valid_time to restore CF compliance
-    xarray_data_time = xarray_data.rename({"valid_time": "time"})
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(convert_grib, source, dest): source
+            for source, dest in pending
+        }
 
-    # Reduce byte depth to save space
-    xarray_data_time = xarray_data_time.astype("float32")
+        for future in as_completed(futures):
+            try:
+                n_steps = future.result()
+            except Exception as excep:
+                # Failed files are left unconverted and retried on the next run
+                print(f"Failed {futures[future]}: {excep}")
+                failed += 1
+                continue
 
-    # Save to file
-    xarray_data_time.to_netcdf(dest)
+            print(f"Converted {futures[future]}: {n_steps} hours")
 
+    return 1 if failed else 0
 
-# Get job array index to get a variable for the array job
-job_index = int(os.environ.get("PBS_ARRAY_INDEX"))
-variables = ("mx2t", "mn2t")
-this_var = variables[job_index]
 
-# Setup the source directory
-src_dir = f"/rds/general/project/lemontree/ephemeral/ERA5_CDSAPI/{this_var}"
+if __name__ == "__main__":
 
-# Loop over files, writing NetCDF back into the same directory.
-for file in Path(src_dir).glob("*.grib"):
-    convert_GRIB_to_NetCDF(file, file.with_suffix(".nc"))
+    sys.exit(grib_convert_cli())
@@ -14,7 +14,7 @@
 eval "$(~/miniforge3/bin/conda shell.bash hook)"
 
 # Activate a conda environment python314_xarray, which needs:
-# cdsswwarm
+# ecmwf-datastores-client
 
 conda activate python314_xarray
 
@@ -1,9 +1,12 @@
 import os
+import sys
 from itertools import product
 from pathlib import Path
 import tomllib
 
-import cdsswarm
+from ecmwf.datastores import Client
+
+from CDSAPI_queue import AdaptiveLimit, RequestLog, run_queue
 
 """
 [DO 2026-04-21]
@@ -11,9 +14,16 @@ import cdsswarm
 This script downloads ERA5 data from CDS using the CDS API. The script runs as a job
 array, setting a per job CDSAPI key.
 
-The script uses the cdsswarm package to manage the download task list efficiently. It
-uses a limited number of workers to submit monthly tasks, and allows the submission,
-acceptance and running of tasks to continue alongside data download.
+The script uses the adaptive request queue in CDSAPI_queue.py to manage the download
+task list. It submits monthly tasks using the ecmwf.datastores client and allows the
+submission, acceptance and running of tasks to continue alongside data download. Rather
+than using a fixed number of workers, the number of requests in flight for the key is
+raised when requests are starting quickly and lowered when they are waiting in the CDS
+queue. The queued, running and download times for each request are logged as JSON lines
+to requests_<index>.jsonl in the output directory.
+
+The CDSAPI_URL environment variable can be used to run the script against the mock CDS
+server in CDSAPI_testing/mock_cds_server.py.
 
 It is expecting to be able to access a TOML file in the home directory of the submitting
 user that contains CDSAPI keys to be used with the different array jobs. This allows the
@@ -42,8 +52,8 @@ job_index = int(os.environ.get("PBS_ARRAY_INDEX"))
 cdsapi_path = Path("~/cdsapi.toml").expanduser().resolve()
 cdsapi_info = tomllib.load(open(cdsapi_path, "rb"))
 
-os.environ["CDSAPI_URL"] = cdsapi_info["url"]
-os.environ["CDSAPI_KEY"] = cdsapi_info["key"][job_index - 1]
+cdsapi_url = os.getenv("CDSAPI_URL", cdsapi_info["url"])
+cdsapi_key = cdsapi_info["key"][job_index - 1]
 
 # Set the variable and year range for the jobs
 job_subsets = (
@@ -74,7 +84,14 @@ var, short_var, years = job_subsets[job_index - 1]
 # Check an output directory on the ephemeral directory.
 output_dir = Path("/rds/general/project/lemontree/ephemeral/ERA5_CDSAPI")
 output_dir.mkdir(exist_ok=True)
-progress_file = open(output_dir / "progress.log", "a")
+request_log = RequestLog(output_dir / f"requests_{job_index}.jsonl", job_index)
+
+# The limits on the number of requests in flight for the key and the target time for
+# requests to wait in the CDS queue before they start running.
+INITIAL_REQUESTS = 4
+MAX_REQUESTS = 12
+TARGET_QUEUE_SECONDS = 10 * 60
+POLL_SECONDS = 30
 
 # Set the months, days and time
 months = [f"{m:02}" for m in range(1, 13)]
@@ -83,9 +100,8 @@ time = [f"{h:02}:00" for h in range(0, 24)]
 
 # Build the task list
 task_list = [
-    cdsswarm.Task(
-        dataset="reanalysis-era5-single-levels",
-        request={
+    (
+        {
             "product_type": ["reanalysis"],
             "variable": [var],
             "year": [year],
@@ -94,9 +110,25 @@ task_list = [
             "time": time,
             "data_format": "grib",
         },
-        target=output_dir / short_var / f"{short_var}_{year}_{month}.grib",
+        output_dir / short_var / f"{short_var}_{year}_{month}.grib",
     )
     for year, month in product(years, months)
 ]
 
-results = cdsswarm.download(task_list, num_workers=4)
+client = Client(url=cdsapi_url, key=cdsapi_key, progress=False)
+limit = AdaptiveLimit(
+    initial=INITIAL_REQUESTS,
+    maximum=MAX_REQUESTS,
+    target_queue_seconds=TARGET_QUEUE_SECONDS,
+)
+
+n_failed = run_queue(
+    client,
+    "reanalysis-era5-single-levels",
+    task_list,
+    limit,
+    request_log,
+    poll_seconds=POLL_SECONDS,
+)
+print(f"Finished with {n_failed} failed requests")
+sys.exit(1 if n_failed else 0)
@@ -0,0 +1,299 @@
+"""Adaptive CDSAPI request queue with latency and throughput logging.
+
+The CDSAPI throttles the requests for each user: requests are accepted into a queue and
+only a limited number run at once. The time spent in the queue varies strongly during
+the day (see ``CDSAPI_testing``), so a fixed number of requests in flight for each key
+either leaves capacity unused when the queue is short or just adds queued requests
+when it is long. This module provides the download layer used by CDSAPI_download.py:
+
+* The ``run_queue`` function submits requests for a key using the
+  ``ecmwf.datastores`` client, polls their status and downloads the results in a
+  separate pool of threads, so that downloads overlap with the requests that are still
+  queued or running.
+* Each request is logged as a JSON line, giving the time the request spent queued and
+  running on the CDS (from the CDS job timestamps), the time taken to download the
+  results and the download throughput. Changes to the request limit are also logged,
+  so the logs can be loaded with ``pandas.read_json(path, lines=True)``.
+* The AdaptiveLimit class sets the number of requests in flight from the observed
+  queue latency. The queue latency of each request is added to a smoothed average when
+  the request starts running: when the average is below the target, there is spare
+  capacity and the limit is raised by one, and when it is more than twice the target,
+  the extra requests are only waiting and the limit is lowered by one.
+
+Downloads are written to a temporary file and renamed once the file size has been
+checked against the size of the results, so existing targets are complete and are
+skipped. The queue can be tested locally against the mock server in
+``CDSAPI_testing/mock_cds_server.py``.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from pathlib import Path
+
+# The CDS job states for requests that are still in flight
+QUEUED_STATES = ("accepted", "running")
+
+
+class AdaptiveLimit:
+    """An adaptive limit on the number of requests in flight for a key.
+
+    Args:
+        initial: The initial limit.
+        minimum: The lowest limit.
+        maximum: The highest limit.
+        target_queue_seconds: The target queue latency.
+        smoothing: The weight given to each new observation in the smoothed latency.
+    """
+
+    def __init__(
+        self,
+        initial=4,
+        minimum=1,
+        maximum=16,
+        target_queue_seconds=300,
+        smoothing=0.3,
+    ):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_queue_seconds = target_queue_seconds
+        self.smoothing = smoothing
+        self.queue_seconds = None
+
+    def update(self, queue_seconds):
+        """Update the limit from the queue latency of a request.
+
+        Returns:
+            The new limit.
+        """
+
+        if self.queue_seconds is None:
+            self.queue_seconds = queue_seconds
+        else:
+            self.queue_seconds += self.smoothing * (queue_seconds - self.queue_seconds)
+
+        if self.queue_seconds < self.target_queue_seconds:
+            self.limit = min(self.limit + 1, self.maximum)
+        elif self.queue_seconds > 2 * self.target_queue_seconds:
+            self.limit = max(self.limit - 1, self.minimum)
+
+        return self.limit
+
+
+class RequestLog:
+    """A thread-safe log of JSON records.
+
+    Args:
+        path: The log file, which is appended to.
+        key_index: The index of the CDSAPI key, which is added to each record.
+    """
+
+    def __init__(self, path, key_index=None):
+        self.path = Path(path)
+        self.key_index = key_index
+        self._lock = threading.Lock()
+
+    def write(self, event, **fields):
+        """Write a record for an event."""
+
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "event": event,
+            "key_index": self.key_index,
+            **fields,
+        }
+        with self._lock, open(self.path, "a") as log_file:
+            log_file.write(json.dumps(record) + "\n")
+
+
+def parse_time(value):
+    """Parse a CDS job timestamp, which may be missing, as a UTC datetime."""
+
+    if value is None:
+        return None
+
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+
+    return parsed
+
+
+def seconds_between(start, end):
+    """Get the seconds between two timestamps, or None if either is missing."""
+
+    if start is None or end is None:
+        return None
+
+    return round((end - start).total_seconds(), 1)
+
+
+def download_results(remote, target):
+    """Download the results of a request to a temporary file and rename it.
+
+    Returns:
+        The number of bytes downloaded and the time taken.
+    """
+
+    start = time.monotonic()
+    temp_file = target.with_suffix(".tmp")
+    results = remote.get_results()
+
+    try:
+        results.download(str(temp_file))
+
+        # Only rename the file once it is the size of the results
+        n_bytes = temp_file.stat().st_size
+        if n_bytes != results.content_length:
+            raise ValueError(
+                f"Downloaded {n_bytes} of {results.content_length} bytes for {target}"
+            )
+    except BaseException:
+        # Do not leave a partial download behind
+        temp_file.unlink(missing_ok=True)
+        raise
+
+    temp_file.replace(target)
+
+    return n_bytes, time.monotonic() - start
+
+
+def run_queue(
+    client,
+    dataset,
+    tasks,
+    limit,
+    log,
+    poll_seconds=30,
+    download_workers=2,
+):
+    """Run a set of requests for a key, adapting the number of requests in flight.
+
+    Args:
+        client: An ``ecmwf.datastores.Client`` for the key.
+        dataset: The CDS dataset.
+        tasks: A list of tuples of a request and the target path for the results.
+        limit: The AdaptiveLimit for the key.
+        log: A RequestLog for the request records.
+        poll_seconds: The time between checks on the requests in flight.
+        download_workers: The number of concurrent downloads.
+
+    Returns:
+        The number of failed requests.
+    """
+
+    # Skip targets that have already been downloaded
+    pending = deque(
+        (request, Path(target))
+        for request, target in tasks
+        if not Path(target).exists()
+    )
+    log.write("start", n_tasks=len(tasks), n_pending=len(pending), limit=limit.limit)
+
+    in_flight = {}
+    downloads = {}
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=download_workers) as pool:
+        while pending or in_flight or downloads:
+            # Submit requests up to the current limit
+            while pending and len(in_flight) < limit.limit:
+                request, target = pending.popleft()
+                target.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    remote = client.submit(dataset, request)
+                except Exception as excep:
+                    log.write("failed", target=str(target), error=str(excep))
+                    failed += 1
+                    continue
+                in_flight[remote.request_id] = {
+                    "remote": remote,
+                    "target": target,
+                    "started": False,
+                }
+
+            # Wait for downloads to finish or until the next check on the requests
+            if downloads:
+                done, _ = wait(
+                    downloads, timeout=poll_seconds, return_when=FIRST_COMPLETED
+                )
+            else:
+                done = set()
+                if in_flight:
+                    time.sleep(poll_seconds)
+
+            for future in done:
+                record = downloads.pop(future)
+                try:
+                    n_bytes, download_seconds = future.result()
+                except Exception as excep:
+                    log.write("failed", **record, error=str(excep))
+                    failed += 1
+                    continue
+
+                log.write(
+                    "complete",
+                    **record,
+                    download_seconds=round(download_seconds, 1),
+                    bytes=n_bytes,
+                    mb_per_second=round(
+                        n_bytes / 1024**2 / max(download_seconds, 0.1), 2
+                    ),
+                )
+
+            # Check the requests in flight
+            for request_id, state in list(in_flight.items()):
+                remote = state["remote"]
+                try:
+                    reply = remote.json
+                except Exception as excep:
+                    # Transient errors are retried on the next check
+                    log.write("poll_error", request_id=request_id, error=str(excep))
+                    continue
+
+                status = reply["status"]
+                created = parse_time(reply.get("created"))
+                started = parse_time(reply.get("started"))
+                finished = parse_time(reply.get("finished"))
+
+                # Update the limit from the queue latency once a request starts
+                queued_seconds = seconds_between(created, started)
+                if not state["started"] and queued_seconds is not None:
+                    state["started"] = True
+                    old_limit = limit.limit
+                    if limit.update(queued_seconds) != old_limit:
+                        log.write(
+                            "limit",
+                            old_limit=old_limit,
+                            limit=limit.limit,
+                            queue_seconds=round(limit.queue_seconds, 1),
+                        )
+
+                if status in QUEUED_STATES:
+                    continue
+
+                del in_flight[request_id]
+                record = {
+                    "request_id": request_id,
+                    "target": str(state["target"]),
+                    "status": status,
+                    "queued_seconds": queued_seconds,
+                    "running_seconds": seconds_between(started, finished),
+                    "limit": limit.limit,
+                }
+
+                if status != "successful":
+                    log.write("failed", **record)
+                    failed += 1
+                    continue
+
+                future = pool.submit(download_results, remote, state["target"])
+                downloads[future] = record
+
+    log.write("finish", n_failed=failed, limit=limit.limit)
+
+    return failed
@@ -0,0 +1,280 @@
+"""A local mock of the CDS retrieve API for testing the adaptive download queue.
+
+The server implements the parts of the CDS retrieve API used by the ecmwf.datastores
+client to submit requests, poll their status and download the results, and simulates
+the CDS throttle:
+
+* Each submitted request is queued for a delay that follows a cycle of busy and quiet
+  periods, standing in for the daily variation in queue times seen in
+  request_times.csv, compressed into a few minutes.
+* After the queue delay, requests only start running when the key has fewer than the
+  maximum number of running requests, so requests beyond that limit just wait.
+* Requests run for a fixed time and then return random bytes as the results.
+
+Run the server and then point CDSAPI_download.py at it using the CDSAPI_URL
+environment variable. The script also needs PBS_ARRAY_INDEX to be set to the job array
+index, which selects the key and variable subset for the run:
+
+    python mock_cds_server.py --port 8080
+    CDSAPI_URL=http://localhost:8080/api PBS_ARRAY_INDEX=1 python ../CDSAPI_download.py
+"""
+
+import argparse
+import json
+import math
+import textwrap
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class MockCDS:
+    """The simulated state of the CDS jobs.
+
+    Args:
+        running_per_key: The maximum number of running requests for each key.
+        queue_seconds: The mean queue delay.
+        cycle_seconds: The period of the cycle in the queue delay.
+        run_seconds: The time taken to run a request.
+        file_size: The size of the results in bytes.
+    """
+
+    def __init__(
+        self, running_per_key, queue_seconds, cycle_seconds, run_seconds, file_size
+    ):
+        self.running_per_key = running_per_key
+        self.queue_seconds = queue_seconds
+        self.cycle_seconds = cycle_seconds
+        self.run_seconds = run_seconds
+        self.file_size = file_size
+        self.start = time.monotonic()
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def queue_delay(self, now):
+        """Get the queue delay for a request submitted at a given time."""
+
+        phase = 2 * math.pi * (now - self.start) / self.cycle_seconds
+        return self.queue_seconds * (1 + 0.9 * math.sin(phase))
+
+    def submit(self, key, process_id, inputs):
+        """Add a job and return its ID."""
+
+        now = time.monotonic()
+        job_id = str(uuid.uuid4())
+        with self.lock:
+            self.jobs[job_id] = {
+                "key": key,
+                "process_id": process_id,
+                "inputs": inputs,
+                "created": now,
+                "ready": now + self.queue_delay(now),
+                "started": None,
+                "finished": None,
+            }
+
+        return job_id
+
+    def update(self):
+        """Start and finish jobs up to the current time."""
+
+        now = time.monotonic()
+        with self.lock:
+            for job in sorted(self.jobs.values(), key=lambda job: job["created"]):
+                if job["started"] is None and job["ready"] <= now:
+                    running = sum(
+                        1
+                        for other in self.jobs.values()
+                        if other["key"] == job["key"]
+                        and other["started"] is not None
+                        and other["finished"] is None
+                    )
+                    if running < self.running_per_key:
+                        job["started"] = now
+
+                if job["started"] is not None and job["finished"] is None:
+                    if now - job["started"] >= self.run_seconds:
+                        job["finished"] = now
+
+    def timestamp(self, value):
+        """Convert a monotonic time to an ISO timestamp."""
+
+        if value is None:
+            return None
+
+        wall = time.time() - (time.monotonic() - value)
+        return datetime.fromtimestamp(wall, timezone.utc).isoformat()
+
+    def job_json(self, job_id, base_url):
+        """Get the status of a job in the format of the CDS API."""
+
+        self.update()
+        job = self.jobs[job_id]
+        if job["finished"] is not None:
+            status = "successful"
+        elif job["started"] is not None:
+            status = "running"
+        else:
+            status = "accepted"
+
+        job_url = f"{base_url}/retrieve/v1/jobs/{job_id}"
+        return {
+            "processID": job["process_id"],
+            "type": "process",
+            "jobID": job_id,
+            "status": status,
+            "created": self.timestamp(job["created"]),
+            "started": self.timestamp(job["started"]),
+            "finished": self.timestamp(job["finished"]),
+            "updated": self.timestamp(time.monotonic()),
+            "metadata": {"request": {"ids": job["inputs"]}},
+            "links": [
+                {"href": job_url, "rel": "self"},
+                {"href": job_url, "rel": "monitor"},
+                {"href": f"{job_url}/results", "rel": "results"},
+            ],
+        }
+
+
+def make_handler(cds, prefix):
+    """Create a request handler class for a MockCDS instance."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def base_url(self):
+            return f"http://{self.headers['Host']}{prefix}"
+
+        def send_json(self, content, code=200):
+            body = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def parts(self):
+            path = urlparse(self.path).path
+            if not path.startswith(prefix):
+                return None
+            return path[len(prefix) :].strip("/").split("/")
+
+        def do_POST(self):
+            parts = self.parts()
+            length = int(self.headers.get("Content-Length", 0))
+            content = json.loads(self.rfile.read(length) or "{}")
+
+            # Submit a request: /retrieve/v1/processes/{process}/execution
+            if parts and parts[:3] == ["retrieve", "v1", "processes"]:
+                job_id = cds.submit(
+                    self.headers.get("PRIVATE-TOKEN"), parts[3], content["inputs"]
+                )
+                self.send_json(cds.job_json(job_id, self.base_url()), 201)
+            else:
+                self.send_json({"title": "Not found"}, 404)
+
+        def do_HEAD(self):
+            self.do_GET(head=True)
+
+        def do_GET(self, head=False):
+            parts = self.parts()
+
+            if parts and parts[0] == "catalogue":
+                self.send_json({"messages": []})
+
+            elif parts and parts[:3] == ["retrieve", "v1", "processes"]:
+                self.send_json({"id": parts[3], "links": []})
+
+            elif parts and parts[:3] == ["retrieve", "v1", "jobs"]:
+                job_id = parts[3]
+                if job_id not in cds.jobs:
+                    self.send_json({"title": "Job not found"}, 404)
+                elif len(parts) == 5 and parts[4] == "results":
+                    self.send_json(
+                        {
+                            "asset": {
+                                "value": {
+                                    "href": f"{self.base_url()}/download/{job_id}",
+                                    "file:size": cds.file_size,
+                                    "type": "application/x-grib",
+                                }
+                            }
+                        }
+                    )
+                else:
+                    self.send_json(cds.job_json(job_id, self.base_url()))
+
+            elif parts and parts[0] == "download":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-grib")
+                self.send_header("Content-Length", str(cds.file_size))
+                self.end_headers()
+                if not head:
+                    rng = np.random.default_rng()
+                    self.wfile.write(rng.bytes(cds.file_size))
+
+            else:
+                self.send_json({"title": "Not found"}, 404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def mock_cds_server_cli():
+    """Run a local mock of the CDS retrieve API.
+
+    Requests are queued for a delay that cycles between busy and quiet periods and then
+    run, with a limit on the number of running requests for each key.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(mock_cds_server_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--port", type=int, default=8080, help="The server port")
+    parser.add_argument(
+        "--running-per-key",
+        type=int,
+        default=2,
+        help="The maximum number of running requests for each key",
+    )
+    parser.add_argument(
+        "--queue-seconds", type=float, default=20, help="The mean queue delay"
+    )
+    parser.add_argument(
+        "--cycle-seconds",
+        type=float,
+        default=300,
+        help="The period of the busy and quiet cycle in the queue delay",
+    )
+    parser.add_argument(
+        "--run-seconds", type=float, default=5, help="The time to run a request"
+    )
+    parser.add_argument(
+        "--file-size", type=int, default=1024**2, help="The size of the results"
+    )
+
+    args = parser.parse_args()
+
+    cds = MockCDS(
+        args.running_per_key,
+        args.queue_seconds,
+        args.cycle_seconds,
+        args.run_seconds,
+        args.file_size,
+    )
+    server = ThreadingHTTPServer(("localhost", args.port), make_handler(cds, "/api"))
+    print(f"Mock CDS API at http://localhost:{args.port}/api")
+    server.serve_forever()
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    mock_cds_server_cli()
@@ -1,9 +1,11 @@
 #!/bin/bash
 
-# This script runs the download of the ERA5 data on a compute node, not the login
+# This script runs the download of the ERA5 data on a compute node, not the login. By
+# default, the data are remapped to 0.5° as they are downloaded - submit with
+# `qsub -v REGRID=0 CDS_ARCO_download.pbs.sh` to save the 0.25° data to ephemeral.
 
-# Use the throughput class - single node, single cpu
-#PBS -lselect=1:ncpus=1:mem=96gb
+# Single node - several months are downloaded concurrently, each needing ~3GB
+#PBS -lselect=1:ncpus=4:mem=96gb
 #PBS -lwalltime=24:00:00
 #PBS -j oe
 #PBS -o /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/CDS_ARCO_download.out
@@ -1,11 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 from itertools import product
 from pathlib import Path
+import calendar
 import configparser
-from datetime import datetime
+import json
+import os
+import sys
+import threading
+import time
 
 
+import netCDF4
+import numpy as np
 from obstore.store import HTTPStore
 import xarray as xr
+import zarr
 from zarr.storage import ObjectStore
 
 
@@ -18,12 +28,61 @@ expects to find a .cdsapi file giving CDS credentials in the users home director
 The script needs to be run in Python 3.13+ environment that provides:
 
 pip install "xarray[io]" zarr httpio fsspec ipython obstore
+
+The data are downloaded as one file per variable and month. Several months are fetched
+concurrently (TASK_WORKERS) and zarr fetches the chunks for each month concurrently
+(CHUNK_CONCURRENCY), so the number of simultaneous chunk requests is bounded by the
+product of the two settings. The store is opened without dask chunks, so each read goes
+straight to zarr rather than through the dask scheduler. The files are written to a
+temporary file and renamed once complete, so an interrupted download never leaves a
+partial file under the final name. Months that fail are retried on the next run and the
+script exits with a non-zero status if any month failed.
+
+Completed months are recorded in a manifest file (manifest.json), which is saved after
+every month so the script can be restarted at any point and resume from the remaining
+months. Existing files that are not in the manifest - such as files from earlier runs -
+are checked for a complete set of hourly time steps before being added to the manifest,
+and are downloaded again if they are incomplete. The time taken and throughput for each
+month are logged to progress.log.
+
+By default, each month is remapped to the 0.5° grid in half_degree.grd as it is
+downloaded, using bilinear interpolation in the same way as `cdo remapbil`, and only the
+0.5° data are written, directly to the variable directories in this ERA5 directory. The
+bilinear weights are calculated once using the shared regrid_weights.py module and the
+0.25° data are fetched and remapped a day at a time, so the full resolution data never
+need to be staged on ephemeral. Setting the REGRID environment variable to 0 restores
+the original behaviour of saving the 0.25° data to ephemeral.
 """
 
-# Create an output directory on the ephemeral directory.
-output_dir = Path("/rds/general/project/lemontree/ephemeral/ERA5_ARCO")
-output_dir.mkdir(exist_ok=True)
-progress_file = open(output_dir / "progress.log", "a")
+# The 0.25° data can be saved to ephemeral or remapped to 0.5° on download and saved
+# to the project ERA5 directory. The progress log and manifest are always on ephemeral.
+REGRID = os.getenv("REGRID", "1") == "1"
+project_root = Path("/rds/general/project/lemontree/live")
+era5_dir = project_root / "projects/inter_compar_HB/GLOBAL/ERA5"
+download_dir = Path("/rds/general/project/lemontree/ephemeral/ERA5_ARCO")
+download_dir.mkdir(exist_ok=True)
+
+# Shared tools
+sys.path.append(str(project_root / "tools"))
+from regrid_weights import RegridWeights, read_grid_description  # noqa: E402
+
+if REGRID:
+    output_dir = era5_dir
+    progress_file = open(download_dir / "progress_half_degree.log", "a")
+    manifest_file = download_dir / "manifest_half_degree.json"
+else:
+    output_dir = download_dir
+    progress_file = open(download_dir / "progress.log", "a")
+    manifest_file = download_dir / "manifest.json"
+
+# The number of hourly time steps fetched and remapped at once
+REGRID_STEPS = 24
+
+# The number of months downloaded concurrently and the number of concurrent chunk
+# requests used by zarr for each month. Each month of a variable is ~3GB in memory at
+# 0.25° but only ~0.8GB when remapped to 0.5° as it is downloaded.
+TASK_WORKERS = 4
+CHUNK_CONCURRENCY = 16
 
 
 # Get the cdsapi key from the RC file in the user home directory.
@@ -85,38 +144,183 @@ http_store = HTTPStore(
     client_options={
         "default_headers": {"Authorization": f"Bearer {cdsapi_key}"},
     },
+    retry_config={"max_retries": 10, "retry_timeout": timedelta(minutes=5)},
 )
 
+zarr.config.set({"async.concurrency": CHUNK_CONCURRENCY})
 store = ObjectStore(http_store, read_only=True)
-ds = xr.open_zarr(store)
+# Open without dask chunks, so that each read is a single zarr read using the chunk
+# concurrency above rather than a set of dask tasks.
+ds = xr.open_zarr(store, chunks=None)
+
+
+# Calculate the bilinear weights from the ARCO grid to the 0.5° grid once, so that each
+# block of data is remapped with a single sparse matrix multiplication.
+target_lat, target_lon = read_grid_description(era5_dir / "half_degree.grd")
+weights = RegridWeights.from_grids(
+    ds["latitude"].values, ds["longitude"].values, target_lat, target_lon
+)
+
+
+def regrid_month(subset):
+    """Fetch a month of 0.25° data a block at a time and remap it to 0.5°."""
+
+    n_times = subset.sizes["time"]
+    data = np.empty((n_times, len(target_lat), len(target_lon)), dtype="float32")
+
+    for start in range(0, n_times, REGRID_STEPS):
+        block = subset.isel(time=slice(start, start + REGRID_STEPS))
+        block = block.transpose("time", "latitude", "longitude").values
+        data[start : start + REGRID_STEPS] = weights.regrid(block)
+
+    return xr.DataArray(
+        data,
+        dims=("time", "lat", "lon"),
+        coords={
+            "time": subset["time"].values,
+            "lat": ("lat", target_lat, {"units": "degrees_north"}),
+            "lon": ("lon", target_lon, {"units": "degrees_east"}),
+        },
+        name=subset.name,
+        attrs=subset.attrs,
+    )
+
+
+# The NetCDF library is not thread-safe, so the downloaded months are written one at a
+# time while other months continue to download.
+write_lock = threading.Lock()
+
+
+def expected_hours(year, month):
+    """Get the number of hourly time steps in a month."""
+    return calendar.monthrange(year, month)[1] * 24
+
+
+def is_complete(path, var, year, month):
+    """Check that an existing file contains every hour in the month."""
+
+    try:
+        with netCDF4.Dataset(path) as nc_file:
+            return nc_file[var].shape[0] == expected_hours(year, month)
+    except (OSError, KeyError, IndexError):
+        return False
+
+
+def save_manifest(manifest):
+    """Save the manifest via a temporary file, so that it is never left incomplete."""
+
+    temp_file = manifest_file.with_suffix(".tmp")
+    with open(temp_file, "w") as outf:
+        json.dump(manifest, outf, indent=1)
+    temp_file.replace(manifest_file)
 
-# Create a generator yielding (variable, year, month) tuples
-data_subsets = product(variables, years, months)
 
-for (long_name, var), year, month in data_subsets:
+def download_month(var, year, month, outfile_name):
+    """Download a month of data for a variable to a NetCDF file.
+
+    Returns the download details for the progress log and manifest.
+    """
+
+    # Log the start of the subset
+    start_time = datetime.now().isoformat(timespec="seconds")
+    start = time.monotonic()
+
+    # Define the subset for the variable and the current month
+    month_selector = f"{year}-{month:02}"
+    subset = ds[var].sel(time=month_selector)
+
+    if subset.sizes["time"] != expected_hours(year, month):
+        raise ValueError(
+            f"Expected {expected_hours(year, month)} hours, got {subset.sizes['time']}"
+        )
+
+    # Fetch the chunks, remapping to 0.5° if requested
+    if REGRID:
+        data = regrid_month(subset)
+        encoding = {var: {"zlib": True, "complevel": 6}}
+    else:
+        data = subset.load()
+        encoding = None
+    fetch_seconds = time.monotonic() - start
+
+    # Write to a temporary file and then move it to the final name
+    temp_file = outfile_name.with_suffix(".tmp")
+    try:
+        with write_lock:
+            data.to_netcdf(temp_file, encoding=encoding)
+    except BaseException:
+        # Do not leave a partial file behind
+        temp_file.unlink(missing_ok=True)
+        raise
+    temp_file.replace(outfile_name)
+
+    return {
+        "start": start_time,
+        "end": datetime.now().isoformat(timespec="seconds"),
+        "gb": round(subset.nbytes / 1024**3, 2),
+        "fetch_seconds": round(fetch_seconds, 1),
+        "mb_per_second": round(subset.nbytes / 1024**2 / max(fetch_seconds, 0.1), 1),
+        "total_seconds": round(time.monotonic() - start, 1),
+        "file_size": outfile_name.stat().st_size,
+    }
+
+
+# Load the manifest of completed downloads
+manifest = {}
+if manifest_file.exists():
+    with open(manifest_file) as inf:
+        manifest = json.load(inf)
+
+# Find the months that still need to be downloaded
+tasks = []
+for (long_name, var), year, month in product(variables, years, months):
     # Check a variable directory exists
     var_dir = output_dir / var
     var_dir.mkdir(exist_ok=True)
 
-    # Get the output file name and skip over existing files
     outfile_name = var_dir / f"{var}_{year}_{month:02}.nc"
-    if outfile_name.exists():
+    key = outfile_name.name
+
+    # Skip months in the manifest where the file is still in place
+    if key in manifest and outfile_name.exists():
+        if outfile_name.stat().st_size == manifest[key]["file_size"]:
+            continue
+
+    # Adopt complete files from earlier runs that are not in the manifest
+    if outfile_name.exists() and is_complete(outfile_name, var, year, month):
+        manifest[key] = {"file_size": outfile_name.stat().st_size}
         print(f"skipping {outfile_name}")
         continue
 
-    # Log the start of the subset
-    start_time = datetime.now().isoformat(timespec="seconds")
+    tasks.append((var, year, month, outfile_name))
 
-    # Define the subset for the variable and the current month
-    month_selector = f"{year}-{month:02}"
-    subset = ds[var].sel(time=month_selector)
+save_manifest(manifest)
+print(f"{len(tasks)} months to download")
 
-    subset.to_netcdf(outfile_name)
+n_failed = 0
+with ThreadPoolExecutor(max_workers=TASK_WORKERS) as executor:
+    futures = {executor.submit(download_month, *task): task for task in tasks}
 
-    # Log the download completion
-    progress_file.write(
-        f"{start_time}, {datetime.now().isoformat(timespec='seconds')}, "
-        f"{var}, {year}, {month}, {round(subset.nbytes / 1024**3, 2)}\n"
-    )
+    for future in as_completed(futures):
+        var, year, month, outfile_name = futures[future]
+
+        try:
+            details = future.result()
+        except Exception as excep:
+            # Failed months are left out of the manifest and retried on the next run
+            print(f"Failed {outfile_name}: {excep}")
+            n_failed += 1
+            continue
+
+        # Checkpoint the manifest and log the download throughput
+        manifest[outfile_name.name] = details
+        save_manifest(manifest)
+
+        progress_file.write(
+            f"{details['start']}, {details['end']}, {var}, {year}, {month}, "
+            f"{details['gb']}, {details['fetch_seconds']}, {details['mb_per_second']}\n"
+        )
+        progress_file.flush()
 
-    progress_file.flush()
+print(f"Finished with {n_failed} failed months")
+sys.exit(1 if n_failed else 0)
@@ -5,15 +5,20 @@
 # different variables. This job handles the eight variables downloaded through the ARCO
 # API - the remaining two variables need to be downloaded as GRIB using CDSAPI and then
 # converted to NetCDF before resampling.
+#
+# The bilinear weights from the 0.25° grid to the 0.5° grid are calculated once for
+# each variable using the shared regrid_weights.py tool, which then remaps every file
+# using the same weights rather than running `cdo remapbil` separately on each file.
 
 # Use the throughput class - single node, single cpu
-#PBS -lselect=1:ncpus=1:mem=96gb
+#PBS -lselect=1:ncpus=1:mem=16gb
 #PBS -lwalltime=24:00:00
 #PBS -j oe
 #PBS -J 0-9
 #PBS -o /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/ERA5_downscale_^array_index^.out
 
-module load CDO
+eval "$(~/miniforge3/bin/conda shell.bash hook)"
+conda activate pyrealm_py312
 
 # Select a variable to convert based on the array index
 
@@ -34,14 +39,13 @@ DEST_DIR="/rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ER
 # Make a variable specific output if one doesn't exist
 mkdir -p $DEST_DIR/$THIS_VAR
 
-# Iterate over the source directory contents, converting to mildly compressed NetCDF at
-# 0.5° resolution. We are using remapbil to generate bilinear estimates of the cell
-# centres of a regular 0.5° lat/lon grid.
-
-for file in $SRC_DIR/*.nc ; 
-    do echo $file; 
-    cdo -z zip_6  \
-        remapbil,/rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/half_degree.grd \
-        $file \
-        $DEST_DIR/$THIS_VAR/$(basename $file)
-done
+# Remap the source directory contents to mildly compressed NetCDF at 0.5° resolution,
+# using bilinear estimates of the cell centres of a regular 0.5° lat/lon grid. The
+# weights are saved in the source directory and existing outputs are skipped.
+
+python /rds/general/project/lemontree/live/tools/regrid_weights.py \
+    $SRC_DIR/*.nc \
+    --grid $DEST_DIR/half_degree.grd \
+    --out-dir $DEST_DIR/$THIS_VAR \
+    --weights $SRC_DIR/half_degree_bilinear_weights.npz \
+    --complevel 6
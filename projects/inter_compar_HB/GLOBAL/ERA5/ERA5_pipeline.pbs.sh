@@ -0,0 +1,39 @@
+#!/bin/bash
+
+# This script runs the rolling download, conversion and remapping pipeline for the
+# CDSAPI variables on a compute node, not the login. It runs as an array job, with each
+# job using a different CDSAPI key for a variable and range of years. Each job has a
+# disk budget of 2TB for the 0.25° files on ephemeral, keeping the total for the four
+# jobs within the 10TB ephemeral quota. Completed months are skipped, so the job can be
+# resubmitted to continue after reaching the walltime.
+
+# Single node - several CPUs for the conversion and remapping workers
+#PBS -lselect=1:ncpus=4:mem=16gb
+#PBS -lwalltime=24:00:00
+#PBS -j oe
+#PBS -J 1-4
+#PBS -o /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/ERA5_pipeline_^array_index^.out
+
+eval "$(~/miniforge3/bin/conda shell.bash hook)"
+
+# Activate a conda environment python314_xarray, which needs:
+# cdsswarm
+# earthkit-data (which provides eccodes)
+# netCDF4
+# scipy
+
+conda activate python314_xarray
+
+# Select a variable and year range based on the array index
+VARIABLES=("mn2t" "mn2t" "mx2t" "mx2t")
+FIRST_YEARS=(1980 2003 1980 2003)
+LAST_YEARS=(2002 2025 2002 2025)
+INDEX=$((PBS_ARRAY_INDEX - 1))
+
+python /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/ERA5/ERA5_pipeline.py \
+    ${VARIABLES[$INDEX]} \
+    --years ${FIRST_YEARS[$INDEX]} ${LAST_YEARS[$INDEX]} \
+    --budget-gb 2000
+
+conda deactivate # Out of python314_xarray
+conda deactivate # Out of base
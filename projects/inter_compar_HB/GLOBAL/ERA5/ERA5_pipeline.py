@@ -0,0 +1,417 @@
+"""Run the CDSAPI download, conversion and downscaling of ERA5 as a rolling pipeline.
+
+The CDSAPI variables are otherwise processed in three separate stages - download the
+GRIB files to ephemeral, convert them to NetCDF and then remap them to 0.5° - which
+needs the full 0.25° data for a variable on ephemeral at once. The 10TB ephemeral quota
+means that the full set of years cannot be processed in one pass. This script instead
+treats each month as a chain of steps and runs the chains concurrently:
+
+    download -> convert to NetCDF -> remap to 0.5° -> verify -> delete the 0.25° files
+
+* Downloads run in a small pool of threads (cdsswarm tasks are mostly waiting on the
+  CDS queue) and the conversion and remapping run in a pool of worker processes, so
+  that months are processed while the following months are still queued or
+  downloading.
+* A new download only starts if the estimated disk use of the months in progress stays
+  within the disk budget. Each month reserves an estimate of the space needed for its
+  GRIB file and the intermediate 0.25° NetCDF file until those files are deleted. The
+  estimate starts from a typical month and is updated from the sizes of the completed
+  months. Raw files left by an earlier run are picked up and counted against the
+  budget.
+* The 0.25° files are only deleted once the 0.5° output has been checked for every
+  hour in the month on the target grid. Failed months keep their files, with their
+  share of the budget reduced to the size of the files left on disk, and are retried
+  when the pipeline is restarted. If the files of failed months leave no space to
+  start another month, the remaining months are also left for the next run.
+* Months with a verified 0.5° output are skipped, so the pipeline can simply be
+  resubmitted to continue after hitting the walltime.
+
+The timing of each step is logged to pipeline.log on ephemeral.
+
+The ARCO variables do not need this pipeline, as CDS_ARCO_download.py remaps them to
+0.5° as they are downloaded.
+
+Usage:
+
+    python ERA5_pipeline.py mx2t mn2t --years 1980 2025 --budget-gb 2000
+"""
+
+import argparse
+import calendar
+import os
+import sys
+import textwrap
+import time
+import tomllib
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime
+from itertools import product
+from pathlib import Path
+
+import cdsswarm
+import netCDF4
+
+from CDSAPI_GRIB_convert import convert_grib, grib_is_complete, is_converted
+
+# Paths
+project_root = Path("/rds/general/project/lemontree/live")
+era5_dir = project_root / "projects/inter_compar_HB/GLOBAL/ERA5"
+raw_dir = Path("/rds/general/project/lemontree/ephemeral/ERA5_CDSAPI")
+
+# Shared tools
+sys.path.append(str(project_root / "tools"))
+from regrid_weights import (  # noqa: E402
+    RegridWeights,
+    read_grid_description,
+    regrid_file,
+)
+
+# The CDS names of the variables
+VARIABLES = {
+    "mx2t": "maximum_2m_temperature_since_previous_post_processing",
+    "mn2t": "minimum_2m_temperature_since_previous_post_processing",
+}
+
+# The typical size of the GRIB and 0.25° NetCDF files for a month, used to reserve
+# space for a month until the sizes of completed months are known.
+DEFAULT_MONTH_BYTES = 4 * 1024**3
+
+# The 0.5° target grid and the bilinear weights, which are calculated once in each
+# worker process for the grid of the first month it processes.
+target_lat, target_lon = read_grid_description(era5_dir / "half_degree.grd")
+_weights = None
+
+
+def raw_file(var, year, month):
+    """Get the path of the downloaded GRIB file for a month."""
+    return raw_dir / var / f"{var}_{year}_{month:02}.grib"
+
+
+def output_file(var, year, month):
+    """Get the path of the 0.5° output file for a month."""
+    return era5_dir / var / f"{var}_{year}_{month:02}.nc"
+
+
+def is_regridded(path, year, month):
+    """Check that a 0.5° output file contains every hour in the month."""
+
+    if not path.exists():
+        return False
+
+    n_hours = calendar.monthrange(year, month)[1] * 24
+    try:
+        with netCDF4.Dataset(path) as nc_file:
+            data_var = nc_file[path.name.split("_")[0]]
+            return data_var.shape == (n_hours, len(target_lat), len(target_lon))
+    except (OSError, IndexError):
+        return False
+
+
+def download_month(var, year, month):
+    """Download a month of hourly data for a variable as GRIB.
+
+    Returns:
+        The size of the downloaded file.
+    """
+
+    target = raw_file(var, year, month)
+    target.parent.mkdir(parents=True, exist_ok=True)
+
+    task = cdsswarm.Task(
+        dataset="reanalysis-era5-single-levels",
+        request={
+            "product_type": ["reanalysis"],
+            "variable": [VARIABLES[var]],
+            "year": [year],
+            "month": [f"{month:02}"],
+            "day": [f"{d:02}" for d in range(1, 32)],
+            "time": [f"{h:02}:00" for h in range(0, 24)],
+            "data_format": "grib",
+        },
+        target=target,
+    )
+    cdsswarm.download([task], num_workers=1)
+
+    if not target.exists() or not grib_is_complete(target):
+        raise ValueError(f"Incomplete download: {target}")
+
+    return target.stat().st_size
+
+
+def raw_bytes_on_disk(var, year, month):
+    """Get the size of the GRIB, 0.25° NetCDF and temporary files left for a month."""
+
+    grib = raw_file(var, year, month)
+    paths = (grib, grib.with_suffix(".nc"), grib.with_suffix(".tmp"))
+
+    return sum(path.stat().st_size for path in paths if path.exists())
+
+
+def process_month(var, year, month):
+    """Convert a downloaded month to NetCDF, remap it to 0.5° and delete the sources.
+
+    Returns:
+        The size of the GRIB and 0.25° NetCDF files and the time taken by each step.
+    """
+
+    global _weights
+
+    grib = raw_file(var, year, month)
+    netcdf = grib.with_suffix(".nc")
+    out_file = output_file(var, year, month)
+    out_file.parent.mkdir(exist_ok=True)
+    timings = {}
+
+    start = time.monotonic()
+    if not is_converted(netcdf):
+        convert_grib(grib, netcdf)
+    timings["convert"] = time.monotonic() - start
+
+    start = time.monotonic()
+    with netCDF4.Dataset(netcdf) as src:
+        src_lat, src_lon = src["latitude"][:], src["longitude"][:]
+    if _weights is None or not _weights.matches(src_lat, src_lon):
+        _weights = RegridWeights.from_grids(src_lat, src_lon, target_lat, target_lon)
+    regrid_file(netcdf, out_file, _weights, complevel=6)
+    timings["regrid"] = time.monotonic() - start
+
+    if not is_regridded(out_file, year, month):
+        raise ValueError(f"Incomplete 0.5° output: {out_file}")
+
+    # Only delete the sources once the output is verified
+    raw_bytes = grib.stat().st_size + netcdf.stat().st_size
+    grib.unlink()
+    netcdf.unlink()
+
+    return raw_bytes, timings
+
+
+class DiskBudget:
+    """Track the disk space reserved for the months in progress.
+
+    Args:
+        budget: The total number of bytes that can be reserved.
+        estimate: The initial estimate of the bytes needed for a month.
+    """
+
+    def __init__(self, budget, estimate=DEFAULT_MONTH_BYTES):
+        self.budget = budget
+        self.estimate = estimate
+        self.reserved = {}
+
+    @property
+    def used(self):
+        """The total number of reserved bytes."""
+        return sum(self.reserved.values())
+
+    def can_reserve(self):
+        """Check if there is space to start another month."""
+        return self.used + self.estimate <= self.budget
+
+    def reserve(self, key, n_bytes=None):
+        """Reserve space for a month, using the current estimate by default."""
+        self.reserved[key] = max(self.estimate, n_bytes or 0)
+
+    def resize(self, key, n_bytes):
+        """Set the space reserved for a month to the space it actually uses."""
+        self.reserved[key] = n_bytes
+
+    def release(self, key, actual=None):
+        """Release the space for a month, updating the estimate from its actual size."""
+
+        self.reserved.pop(key, None)
+        if actual is not None:
+            self.estimate = max(self.estimate, actual)
+
+
+def run_pipeline(months, budget, max_downloads, workers, log_file):
+    """Run the rolling download, conversion and remapping of a list of months.
+
+    Args:
+        months: A list of (var, year, month) tuples to process.
+        budget: The DiskBudget for the 0.25° files.
+        max_downloads: The maximum number of concurrent downloads.
+        workers: The number of worker processes for conversion and remapping.
+        log_file: An open file for the pipeline log.
+
+    Returns:
+        The number of months that failed.
+    """
+
+    def log(key, step, seconds):
+        var, year, month = key
+        log_file.write(
+            f"{datetime.now().isoformat(timespec='seconds')}, {var}, {year}, {month}, "
+            f"{step}, {seconds:.1f}, {budget.used / 1024**3:.1f}\n"
+        )
+        log_file.flush()
+
+    queue = deque()
+    running_since = {}
+    failed = 0
+
+    with (
+        ThreadPoolExecutor(max_workers=max_downloads) as downloads,
+        ProcessPoolExecutor(max_workers=workers) as processors,
+    ):
+        running = {}
+
+        def start_processing(key):
+            running[processors.submit(process_month, *key)] = ("process", key)
+
+        # Months with complete raw files from an earlier run go straight to processing
+        for key in months:
+            grib = raw_file(*key)
+            if grib.exists() and grib_is_complete(grib):
+                netcdf = grib.with_suffix(".nc")
+                size = grib.stat().st_size
+                size += netcdf.stat().st_size if netcdf.exists() else size
+                budget.reserve(key, size)
+                start_processing(key)
+            else:
+                queue.append(key)
+
+        print(f"{len(running)} months to process and {len(queue)} to download")
+
+        while queue or running:
+            # Start downloads while there is space in the budget
+            n_downloading = sum(step == "download" for step, _ in running.values())
+            while queue and n_downloading < max_downloads and budget.can_reserve():
+                key = queue.popleft()
+                budget.reserve(key)
+                running[downloads.submit(download_month, *key)] = ("download", key)
+                running_since[key] = time.monotonic()
+                n_downloading += 1
+
+            if not running:
+                # Only the files of failed months are left, so stop and leave the
+                # remaining months for the next run
+                print(f"No space in the disk budget for the {len(queue)} other months")
+                failed += len(queue)
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, key = running.pop(future)
+
+                try:
+                    result = future.result()
+                except Exception as excep:
+                    print(f"Failed to {step} {key}: {excep}")
+                    failed += 1
+                    # Failed downloads are removed, but failed months keep their files
+                    # until the pipeline is restarted, so keep a reservation for the
+                    # space those files actually use.
+                    if step == "download":
+                        raw_file(*key).unlink(missing_ok=True)
+                        budget.release(key)
+                    else:
+                        budget.resize(key, raw_bytes_on_disk(*key))
+                    continue
+
+                if step == "download":
+                    log(key, "download", time.monotonic() - running_since.pop(key))
+                    start_processing(key)
+                else:
+                    raw_bytes, timings = result
+                    budget.release(key, raw_bytes)
+                    log(key, "convert", timings["convert"])
+                    log(key, "regrid", timings["regrid"])
+                    print(f"Completed {key}")
+
+    return failed
+
+
+def era5_pipeline_cli():
+    """Download, convert and remap the CDSAPI ERA5 variables as a rolling pipeline.
+
+    The months for the variables and years are downloaded as GRIB, converted to NetCDF
+    and remapped to 0.5°, and the downloaded files are deleted once the 0.5° files are
+    verified. New downloads are only started while the estimated space used by the
+    months in progress is within the disk budget. Completed months are skipped. The
+    CDSAPI key is taken from the keys in ~/cdsapi.toml using the key index, which
+    defaults to PBS_ARRAY_INDEX.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(era5_pipeline_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("variables", nargs="+", choices=list(VARIABLES))
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs=2,
+        default=(1980, 2025),
+        help="The first and last year to process",
+    )
+    parser.add_argument(
+        "--budget-gb",
+        type=float,
+        default=2000,
+        help="The disk space in GB that can be used for 0.25° files",
+    )
+    parser.add_argument(
+        "--downloads", type=int, default=4, help="The number of concurrent downloads"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("NCPUS", 1)),
+        help="The number of worker processes for conversion and remapping",
+    )
+    parser.add_argument(
+        "--key-index",
+        type=int,
+        default=int(os.getenv("PBS_ARRAY_INDEX", 1)),
+        help="The (one-based) index of the CDSAPI key to use",
+    )
+
+    args = parser.parse_args()
+
+    # Set up CDS credentials to be used by the job
+    cdsapi_path = Path("~/cdsapi.toml").expanduser().resolve()
+    with open(cdsapi_path, "rb") as cdsapi_io:
+        cdsapi_info = tomllib.load(cdsapi_io)
+
+    os.environ["CDSAPI_URL"] = cdsapi_info["url"]
+    os.environ["CDSAPI_KEY"] = cdsapi_info["key"][args.key_index - 1]
+
+    # Find the months without a verified output, removing any raw files left for
+    # verified months by an interrupted run
+    first_year, last_year = args.years
+    months = []
+    for var, year, month in product(
+        args.variables, range(first_year, last_year + 1), range(1, 13)
+    ):
+        if is_regridded(output_file(var, year, month), year, month):
+            grib = raw_file(var, year, month)
+            grib.unlink(missing_ok=True)
+            grib.with_suffix(".nc").unlink(missing_ok=True)
+        else:
+            months.append((var, year, month))
+
+    raw_dir.mkdir(exist_ok=True)
+    with open(raw_dir / "pipeline.log", "a") as log_file:
+        failed = run_pipeline(
+            months,
+            DiskBudget(args.budget_gb * 1024**3),
+            args.downloads,
+            args.workers,
+            log_file,
+        )
+
+    print(f"Finished with {failed} failures")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+
+    sys.exit(era5_pipeline_cli())
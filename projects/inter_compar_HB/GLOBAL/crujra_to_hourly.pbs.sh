@@ -0,0 +1,25 @@
+#!/bin/bash
+
+# This script interpolates the 6-hourly CRU-JRA variables to hourly land cell data, with
+# each array job handling all of the variables for one year. The interpolation streams
+# through each file in windows, so only a modest amount of memory is needed.
+
+#PBS -lselect=1:ncpus=1:mem=8gb
+#PBS -lwalltime=08:00:00
+#PBS -j oe
+#PBS -J 1901-2023
+#PBS -o /rds/general/project/lemontree/ephemeral/crujra_to_hourly_^array_index^.out
+
+# Activate the conda environment
+eval "$(~/miniforge3/bin/conda shell.bash hook)"
+conda activate pyrealm_py312
+
+# Echo the python version and start time
+python --version
+echo -e "In PBS.SH and running year $PBS_ARRAY_INDEX"
+date
+
+python /rds/general/project/lemontree/live/projects/inter_compar_HB/GLOBAL/crujra_to_hourly.py
+
+date
+conda deactivate
@@ -0,0 +1,265 @@
+"""Interpolate 6-hourly CRU-JRA variables to hourly land cell data.
+
+The test script (CRU_JRA_test.py) interpolates a year of 6-hourly data to hourly using
+``xarray`` resampling, which holds the whole year and the six times larger hourly result
+in memory and then loads the result again to remove the ocean cells. This script does
+the same conversion for all of the variables and years in bounded memory:
+
+* The land cells are found from the cells with data in the source file and the hourly
+  data are only calculated and stored for those cells, using the gathered land cell
+  format from the shared gathered_grids.py module.
+* The source file is read in windows of time steps and each window is interpolated to
+  hourly data using the streaming LinearInterpolator from the shared
+  temporal_interpolation.py module, which carries the last step of each window over to
+  the next so that the output is continuous.
+* Each window of hourly data is written to the output file as it is calculated. The
+  windows are arranged so that each write fills complete chunks of the output file.
+* When the file for the following year is available, its first time step is used to
+  complete the interpolation of the last six hours of the year. Otherwise, the hourly
+  data end at the last source time step, as with ``resample().interpolate()``.
+
+The output file is written to a temporary path and renamed once complete, so existing
+outputs are skipped and the script can simply be rerun to complete missing files.
+
+Precipitation (pre) and the daily temperature extremes (tmax, tmin) are not included, as
+linear interpolation is not appropriate for them.
+
+Usage:
+
+    python crujra_to_hourly.py dlwrf tmp --year 1980
+"""
+
+import argparse
+import os
+import sys
+import textwrap
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+# Paths
+root = Path("/rds/general/project/lemontree/live")
+source_path = root / "projects/inter_compar_HB/GLOBAL/crujra2.5"
+output_path = root / "projects/inter_compar_HB/GLOBAL/crujra2.5_hourly"
+
+# Shared tools
+sys.path.append(str(root / "tools"))
+from gathered_grids import GATHER_DIM, GatherIndex, landmask_from_data  # noqa: E402
+from temporal_interpolation import LinearInterpolator  # noqa: E402
+
+# The variables to interpolate
+VARIABLES = ["dlwrf", "dswrf", "pres", "spfh", "tmp", "ugrd", "vgrd"]
+
+# The number of source time steps read at once - 30 days of 6-hourly data - which also
+# sets the time chunking of the output files.
+WINDOW_STEPS = 4 * 30
+
+# The number of land cells in each chunk of the output files
+CELL_CHUNK = 4096
+
+# Conversion of CF time units to hours
+HOURS_PER_UNIT = {"days": 24, "hours": 1, "minutes": 1 / 60, "seconds": 1 / 3600}
+
+
+def source_file(var, year):
+    """Get the path of the 6-hourly source file for a variable."""
+    return source_path / f"crujra.v2.5.5d.{var}.{year}.365d.noc.nc"
+
+
+def hourly_file(var, year):
+    """Get the path of the hourly output file for a variable."""
+    return output_path / var / f"crujra.v2.5.5d.{var}.{year}.365d.hr_gathered.noc.nc"
+
+
+def variable_attrs(nc_var):
+    """Get the attributes of a NetCDF variable, excluding the fill value."""
+    return {k: v for k, v in nc_var.__dict__.items() if k != "_FillValue"}
+
+
+def read_boundary(var, year, index, units, calendar):
+    """Read the first time step of the following year, if available.
+
+    Returns:
+        A tuple of the time in the source units and the land cell data, or None.
+    """
+
+    next_file = source_file(var, year + 1)
+    if not next_file.exists():
+        return None
+
+    with netCDF4.Dataset(next_file) as ds:
+        time_var = ds["time"]
+        first_time = netCDF4.num2date(
+            time_var[0], time_var.units, getattr(time_var, "calendar", "standard")
+        )
+        data = np.ma.filled(ds[var][0].astype("float32"), np.nan)
+
+    return netCDF4.date2num(first_time, units, calendar), index.gather(data)
+
+
+def interpolate_year(var, year, window_steps=WINDOW_STEPS):
+    """Write the hourly land cell data for a variable and year.
+
+    Returns False if the output file already exists.
+    """
+
+    out_file = hourly_file(var, year)
+    if out_file.exists():
+        return False
+
+    in_file = source_file(var, year)
+    mask = landmask_from_data(in_file, [var])
+
+    with netCDF4.Dataset(in_file) as src:
+        index = GatherIndex.from_mask(
+            mask, src["lat"][:].filled(np.nan), src["lon"][:].filled(np.nan)
+        )
+
+        # Get the source times and the number of hourly steps per source step
+        src_time = src["time"]
+        times = src_time[:].filled(np.nan).astype("float64")
+        calendar = getattr(src_time, "calendar", "standard")
+        step = np.unique(np.diff(times))
+        if len(step) != 1:
+            raise ValueError(f"Irregular time steps in {in_file}")
+
+        ratio = round(step[0] * HOURS_PER_UNIT[src_time.units.split()[0]])
+        boundary = read_boundary(var, year, index, src_time.units, calendar)
+        if boundary is not None and not np.isclose(boundary[0], times[-1] + step[0]):
+            raise ValueError(f"Next year does not follow on from {in_file}")
+
+        n_src = len(times)
+        n_out = (n_src - 1) * ratio + (1 if boundary is None else ratio)
+
+        # Create the output file at a temporary path
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = out_file.with_suffix(".tmp")
+
+        with netCDF4.Dataset(temp_file, "w") as dest:
+            dest.setncatts(src.__dict__)
+            dest.history = (
+                getattr(src, "history", "")
+                + " | Linearly interpolated to hourly in windows and gathered onto"
+                " land cells."
+            )
+
+            dest.createDimension("time", n_out)
+            dest.createDimension("lat", len(index.lat))
+            dest.createDimension("lon", len(index.lon))
+            dest.createDimension(GATHER_DIM, index.n_cells)
+
+            for axis, values in (("lat", index.lat), ("lon", index.lon)):
+                axis_var = dest.createVariable(axis, "f4", (axis,))
+                axis_var.setncatts(variable_attrs(src[axis]))
+                axis_var[:] = values
+
+            landpoint = dest.createVariable(GATHER_DIM, "i4", (GATHER_DIM,))
+            landpoint.compress = "lat lon"
+            landpoint[:] = index.flat_index
+
+            out_time = dest.createVariable("time", "f8", ("time",))
+            out_time.setncatts(variable_attrs(src_time))
+
+            out_var = dest.createVariable(
+                var,
+                "f4",
+                ("time", GATHER_DIM),
+                zlib=True,
+                complevel=4,
+                shuffle=True,
+                fill_value=np.float32(np.nan),
+                chunksizes=(
+                    min(n_out, window_steps * ratio),
+                    min(index.n_cells, CELL_CHUNK),
+                ),
+            )
+            out_var.setncatts(variable_attrs(src[var]))
+
+            # Interpolate the data and times in windows. The first window is one step
+            # longer, so that each window gives exactly one time chunk of output.
+            data_interp = LinearInterpolator(ratio, "float32")
+            time_interp = LinearInterpolator(ratio, "float64")
+            starts = [0, *range(window_steps + 1, n_src, window_steps)]
+            stops = [*starts[1:], n_src]
+            offset = 0
+
+            def write(data, hours):
+                nonlocal offset
+                out_var[offset : offset + len(data)] = data
+                out_time[offset : offset + len(data)] = hours[:, 0]
+                offset += len(data)
+
+            for start, stop in zip(starts, stops):
+                data = np.ma.filled(src[var][start:stop].astype("float32"), np.nan)
+                write(
+                    data_interp.push(index.gather(data)),
+                    time_interp.push(times[start:stop, None]),
+                )
+
+            # Complete the final interval using the following year or add the last step
+            if boundary is None:
+                write(data_interp.finish(), time_interp.finish())
+            else:
+                write(
+                    data_interp.push(boundary[1][None]),
+                    time_interp.push(np.array([[boundary[0]]])),
+                )
+
+            if offset != n_out:
+                raise RuntimeError(f"Wrote {offset} of {n_out} hourly steps")
+
+    temp_file.rename(out_file)
+
+    return True
+
+
+def crujra_to_hourly_cli():
+    """Interpolate 6-hourly CRU-JRA variables to hourly land cell data.
+
+    The variables for a year are interpolated in turn, writing one file per variable.
+    When run as a PBS array job, PBS_ARRAY_INDEX is used as the year if no year is
+    given.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(crujra_to_hourly_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "variables",
+        nargs="*",
+        metavar="variable",
+        help=f"The variables to interpolate (default: {' '.join(VARIABLES)})",
+    )
+    parser.add_argument(
+        "--year", type=int, default=os.getenv("PBS_ARRAY_INDEX"), help="The year"
+    )
+    parser.add_argument(
+        "--window-steps",
+        type=int,
+        default=WINDOW_STEPS,
+        help="The number of source time steps read at once",
+    )
+
+    args = parser.parse_args()
+
+    if args.year is None:
+        parser.error("No year given and PBS_ARRAY_INDEX is not set")
+
+    # The variables are checked here, as argparse checks an empty list against choices
+    variables = args.variables or VARIABLES
+    unknown = set(variables).difference(VARIABLES)
+    if unknown:
+        parser.error(f"Unknown variables: {', '.join(sorted(unknown))}")
+
+    for var in variables:
+        done = interpolate_year(var, int(args.year), args.window_steps)
+        print(f"{var} {args.year}: {'written' if done else 'already exists'}")
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    crujra_to_hourly_cli()
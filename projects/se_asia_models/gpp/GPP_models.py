@@ -1,6 +1,12 @@
 # This is a draft of the Python code for running the GPP models
+#
+# The model fitting for a year is provided by the run_gpp_models function for a given
+# set of latitude and longitude bounds. Running this file as a script fits the models
+# for the whole region of interest for each year in turn, and the gpp_tiled_runner.py
+# script imports the function to run the models for tiles of the region in parallel.
 
-from contextlib import redirect_stdout
+import sys
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -18,6 +24,24 @@ co2_path = project_root / "source/NOAA_CO2/co2_mm_gl.csv"
 fapar_path = project_root / "source/SNU_2024/annual_grids"
 output_path = project_root / "projects/se_asia_models/gpp/"
 
+# Shared tools
+sys.path.append(str(project_root / "tools"))
+from array_diagnostics import DiagnosticsCollector  # noqa: E402
+from unit_conversions import chelsa_rsds_to_ppfd, chelsa_tas_to_celsius  # noqa: E402
+
+# Fixed histogram bins (lower, upper, number of bins) for the model diagnostics. These
+# need to be constant so that diagnostics can be merged across years.
+diagnostic_bins = {
+    "tc": (-25, 50, 75),
+    "vpd": (0, 10000, 100),
+    "patm": (50000, 110000, 60),
+    "co2": (300, 450, 150),
+    "ppfd": (0, 1000, 100),
+    "fapar": (0, 1, 100),
+    "potential_gpp": (0, 1000, 100),
+    "brc_model_gpp": (0, 1000, 100),
+}
+
 # Set the bounds
 longitude_bounds = [92.0, 141.0]
 latitude_bounds = [29.0, -11.0]
@@ -28,28 +52,37 @@ latitude_bounds = [29.0, -11.0]
 # - Then loop over years.
 # -------------------------------------------------------------------------------------
 
-# Load the GMTED 2010 elevation at 30 arc seconds
-elevation_ds = xarray.open_dataset(elev_path, engine="rasterio")
+# Load the CO2 and extract the 12 values for the year
+co2_data_full = pandas.read_csv(co2_path, comment="#")
+
+# Define a function to load the atmospheric pressure for a region. This is constant
+# across years, so the last result is cached to avoid reloading it for each year.
 
-# Load the elevation for the region of interest
-elevation_data = elevation_ds.sel(
-    y=slice(*latitude_bounds),
-    x=slice(*longitude_bounds),
-)
 
-# Calculate atmospheric pressure and broadcast the single layer of data to 12 months
-# [from (1, y, x) to (12, y, x)], implicitly converting it to a numpy array
+@lru_cache(maxsize=1)
+def load_patm_data(latitude_bounds, longitude_bounds):
+    """Load the atmospheric pressure for a region from the GMTED 2010 elevation.
 
-patm_data = calc_patm(elevation_data)
-shape = list(patm_data["band_data"].shape)
-shape[0] = 12
-patm_data = np.broadcast_to(patm_data["band_data"], shape)
+    The bounds must be provided as tuples so that the result can be cached.
+    """
 
-# Finished with the elevation data
-del elevation_data
+    # Load the GMTED 2010 elevation at 30 arc seconds
+    elevation_ds = xarray.open_dataset(elev_path, engine="rasterio")
+
+    # Load the elevation for the region of interest
+    elevation_data = elevation_ds.sel(
+        y=slice(*latitude_bounds),
+        x=slice(*longitude_bounds),
+    )
+
+    # Calculate atmospheric pressure and broadcast the single layer of data to 12 months
+    # [from (1, y, x) to (12, y, x)], implicitly converting it to a numpy array
+    patm_data = calc_patm(elevation_data)
+    shape = list(patm_data["band_data"].shape)
+    shape[0] = 12
+
+    return np.broadcast_to(patm_data["band_data"], shape)
 
-# Load the CO2 and extract the 12 values for the year
-co2_data_full = pandas.read_csv(co2_path, comment="#")
 
 # Define a function to load a year of CHELSA data from 12 monthly tiff files. There may
 # be a way to load these using an xarray multifile dataset, but the inputs lack an
@@ -93,16 +126,26 @@ def load_chelsa_data(path_format, year, latitude_bounds, longitude_bounds):
 # - SNU fAPAR is 1982 - 2021
 # - NOAA CO2 is 1979 - 2023
 # - PATM is constant
-#
-# Calculate for 1982 to 2018
 # -------------------------------------------------------------------------------------
 
-for year in np.arange(1982, 2019):
-    print(f"Processing {year}")
+
+def run_gpp_models(year, latitude_bounds, longitude_bounds, source_label=None):
+    """Fit the GPP models for a year within a region.
+
+    Returns a tuple of an xarray Dataset containing the potential and BRC model GPP
+    predictions and a DiagnosticsCollector for the model inputs and outputs. The
+    source_label is used to label the diagnostics and defaults to the year.
+    """
+
+    if source_label is None:
+        source_label = str(year)
 
     # Subset CO2 data to the single year
     co2_data = co2_data_full.query(f"year=={year}")["average"].to_numpy()
 
+    # Load the atmospheric pressure for the region
+    patm_data = load_patm_data(tuple(latitude_bounds), tuple(longitude_bounds))
+
     # Load fAPAR data for this year and subset to the latitude and longitude bounds
     # - this data is at coarser resolution, handled below.
     fapar_ds = xarray.open_dataset(fapar_path / f"snu_fpar_cf_v1_{year}.nc")
@@ -126,10 +169,8 @@ for year in np.arange(1982, 2019):
     # Save the xarray coordinates
     coords = temperature_data.coords
 
-    temperature_data = np.clip(
-        (temperature_data["band_data"].to_numpy() / 10) - 273.15,
-        a_min=-25,
-        a_max=None,
+    temperature_data = chelsa_tas_to_celsius(
+        temperature_data["band_data"].to_numpy(), min_celsius=-25
     )
 
     # VPD is already in Pa
@@ -158,8 +199,8 @@ for year in np.arange(1982, 2019):
     # * divide by 24 * 60 * 60 to J/m2/s (max ~304)
     # * and then scale from J/m2/s (= W/m2) to µmol/m2/s (1W ~ 4.57 µmol m2 s1 and roughly
     #   44% is photosynthetically active radiation) so 4.57 * 0.44 ~ 2.04 (max ~621)
-    ppfd_data = (rsds_data["band_data"] * 1e6) / (24 * 60 * 60) * 2.04
-    ppfd_data = ppfd_data.to_numpy()
+    # This is applied in place as a single float32 multiplication.
+    ppfd_data = chelsa_rsds_to_ppfd(rsds_data["band_data"].to_numpy())
 
     # ---------------------------------------------------------------------------------
     # Reconciling data dimensions
@@ -180,15 +221,22 @@ for year in np.arange(1982, 2019):
 
     # Tile the fapar data to match resolution using the Kronecker function
     # NOTE: Could do something fancier than tiling here.
-    fapar_data_30_arcsec = np.kron(fapar_data["fAPAR"].to_numpy(), np.ones((1, 6, 6)))
-
-    # The fapar data has a different orientation, so need to swap the last two axes
-    fapar_data_30_arcsec = np.swapaxes(fapar_data_30_arcsec, 1, 2)
+    fapar_data_30_arcsec = np.kron(
+        fapar_data["fAPAR"].to_numpy(), np.ones((1, 6, 6), dtype="float32")
+    )
 
     # ---------------------------------------------------------------------------------
     # Fit the GPP models
     # ---------------------------------------------------------------------------------
-    summary_path = output_path / f"data/1se_asia_gpp_{year}_summary.txt"
+
+    # Collect diagnostics for the model inputs
+    diagnostics = DiagnosticsCollector(bins=diagnostic_bins, sources=[source_label])
+    diagnostics.add("tc", temperature_data)
+    diagnostics.add("vpd", vpd_data)
+    diagnostics.add("patm", patm_data)
+    diagnostics.add("co2", co2_data)
+    diagnostics.add("ppfd", ppfd_data)
+    diagnostics.add("fapar", fapar_data_30_arcsec)
 
     # Potential GPP
     env = PModelEnvironment(
@@ -202,15 +250,7 @@ for year in np.arange(1982, 2019):
 
     pmodel = PModel(env=env)
     potential_gpp = pmodel.gpp
-
-    # Write out the environment and model summarize() outputs for simple checking
-    with open(summary_path, "w") as f:
-        with redirect_stdout(f):
-            print(f"Potential GPP: P Model and environment summaries for {year}\n\n")
-            env.summarize()
-            print("\n")
-            pmodel.summarize()
-            print("\n")
+    diagnostics.add("potential_gpp", potential_gpp)
 
     # BRC model settings for Stocker soil moisture
     env = PModelEnvironment(
@@ -227,15 +267,7 @@ for year in np.arange(1982, 2019):
         reference_kphio=0.081785,
     )
     brc_model_gpp = pmodel.gpp
-
-    # Append out the environment and model summarize() outputs for simple checking
-    with open(summary_path, "a") as f:
-        with redirect_stdout(f):
-            print(f"Stocker BRC GPP: P Model and environment summaries for {year}\n\n")
-            env.summarize()
-            print("\n")
-            pmodel.summarize()
-            print("\n")
+    diagnostics.add("brc_model_gpp", brc_model_gpp)
 
     # Create a dataset of the GPP values
     gpp_data = xarray.Dataset(
@@ -246,23 +278,37 @@ for year in np.arange(1982, 2019):
         coords=coords,
     )
 
-    # Save the file as netCDF using compressed float32
-    gpp_data.to_netcdf(
-        output_path / f"data/1se_asia_gpp_{year}.nc",
-        encoding={
-            "potential_gpp": {"dtype": "float32", "zlib": True, "complevel": 6},
-            "brc_model_gpp": {"dtype": "float32", "zlib": True, "complevel": 6},
-        },
-    )
+    return gpp_data, diagnostics
 
-    # Free up memory
-    del (
-        env,
-        pmodel,
-        temperature_data,
-        vpd_data,
-        co2_data,
-        ppfd_data,
-        fapar_data,
-        fapar_data_30_arcsec,
-    )
+
+# Output encoding as compressed float32
+gpp_encoding = {
+    "potential_gpp": {"dtype": "float32", "zlib": True, "complevel": 6},
+    "brc_model_gpp": {"dtype": "float32", "zlib": True, "complevel": 6},
+}
+
+# -------------------------------------------------------------------------------------
+# Calculate for 1982 to 2018 across the whole region
+# -------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    for year in np.arange(1982, 2019):
+        print(f"Processing {year}")
+
+        gpp_data, diagnostics = run_gpp_models(
+            year=year,
+            latitude_bounds=latitude_bounds,
+            longitude_bounds=longitude_bounds,
+        )
+
+        # Write out the diagnostics for simple checking - these can be merged across
+        # years using tools/array_diagnostics.py
+        diagnostics.to_json(output_path / f"data/1se_asia_gpp_{year}_diagnostics.json")
+
+        # Save the file as netCDF using compressed float32
+        gpp_data.to_netcdf(
+            output_path / f"data/1se_asia_gpp_{year}.nc", encoding=gpp_encoding
+        )
+
+        # Free up memory
+        del gpp_data, diagnostics
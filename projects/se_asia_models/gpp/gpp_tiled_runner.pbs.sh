@@ -0,0 +1,35 @@
+#!/bin/bash
+
+# Run the SE Asia GPP models in parallel across tiles
+
+# NOTES:
+#
+# * This is an array job with one job per year. Each job runs the tiles for the year
+#   across a pool of worker processes, using the NCPUS set by PBS, and then stitches the
+#   tiles into the annual output files.
+# * Rerunning the job only runs the missing tiles for years that are not complete.
+
+# The lines below are the PBS directives. They specify the resources required for the
+# job. 
+
+#PBS -lselect=1:ncpus=8:mem=64gb
+#PBS -lwalltime=08:00:00
+#PBS -J 1982-2018
+#PBS -j oe
+#PBS -o /rds/general/project/lemontree/live/projects/se_asia_models/gpp/gpp_tiled_runner_^array_index^.out
+
+# Activate the conda environment
+eval "$(~/miniforge3/bin/conda shell.bash hook)"
+conda activate pyrealm_py312
+
+# Echo the python version and start time
+python --version
+echo -e "In PBS.SH and running"
+date
+
+# Run the tiled GPP runner for the year given by PBS_ARRAY_INDEX
+python /rds/general/project/lemontree/live/projects/se_asia_models/gpp/gpp_tiled_runner.py run
+
+# Echo the end time and deactivate the conda environment
+date
+conda deactivate
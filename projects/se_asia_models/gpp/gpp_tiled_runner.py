@@ -0,0 +1,274 @@
+"""Tiled parallel runner for the SE Asia GPP models.
+
+Running the GPP models for the whole region in a single process needs the whole region
+in memory for each year and runs the years in series. This script splits the region
+into tiles of whole degrees of latitude and longitude and then runs the models for each
+(year, tile) task using the run_gpp_models function from GPP_models.py. The tasks are
+spread across a local process pool and, when submitted as a PBS array job, each array
+job runs the tiles for a single year, given by the PBS_ARRAY_INDEX.
+
+Each completed task writes a tile file and a diagnostics file to
+`data/tiles/{year}`. The tile files are written to a temporary file that is then
+renamed, so the presence of a tile file shows that the task is complete and a rerun
+only runs the missing tasks. Once all of the tiles for a year are complete, they are
+stitched into the annual output file (e.g. `data/1se_asia_gpp_1982.nc`) along with
+the merged diagnostics, and the tile files are removed.
+
+Usage:
+
+    python gpp_tiled_runner.py run --workers 8 --years 1982 1990
+    python gpp_tiled_runner.py status
+    python gpp_tiled_runner.py stitch
+"""
+
+import argparse
+import os
+import textwrap
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+
+import numpy as np
+import xarray
+
+import GPP_models
+from GPP_models import DiagnosticsCollector
+
+# Location of the tile outputs
+tile_root = GPP_models.output_path / "data/tiles"
+
+
+def make_tiles(tile_lat, tile_lon):
+    """Split the region of interest into tiles.
+
+    The tiles are whole numbers of degrees, so that the tile edges align with both the
+    30 arc second CHELSA grid and the 0.05° fAPAR grid. The last row and column of
+    tiles are truncated to the region bounds.
+
+    Returns a list of tuples of (tile index, latitude bounds, longitude bounds).
+    """
+
+    lat_max, lat_min = GPP_models.latitude_bounds
+    lon_min, lon_max = GPP_models.longitude_bounds
+
+    lat_edges = [*np.arange(lat_max, lat_min, -tile_lat), lat_min]
+    lon_edges = [*np.arange(lon_min, lon_max, tile_lon), lon_max]
+
+    tiles = [
+        ([float(lat_hi), float(lat_lo)], [float(lon_lo), float(lon_hi)])
+        for (lat_hi, lat_lo), (lon_lo, lon_hi) in product(
+            zip(lat_edges[:-1], lat_edges[1:]), zip(lon_edges[:-1], lon_edges[1:])
+        )
+    ]
+
+    return [(index, lat, lon) for index, (lat, lon) in enumerate(tiles)]
+
+
+def tile_file(year, index):
+    """Get the path of the output file for a tile."""
+    return tile_root / str(year) / f"gpp_{year}_tile_{index:03d}.nc"
+
+
+def year_file(year):
+    """Get the path of the stitched output file for a year."""
+    return GPP_models.output_path / f"data/1se_asia_gpp_{year}.nc"
+
+
+def run_task(year, tile):
+    """Run the GPP models for a single tile in a year and write the tile outputs.
+
+    Returns the year, tile index and run time in seconds.
+    """
+
+    start = time.time()
+    index, latitude_bounds, longitude_bounds = tile
+
+    gpp_data, diagnostics = GPP_models.run_gpp_models(
+        year=year,
+        latitude_bounds=latitude_bounds,
+        longitude_bounds=longitude_bounds,
+        source_label=f"{year}_tile_{index:03d}",
+    )
+
+    # Write the diagnostics first and then write the tile data to a temporary file that
+    # is renamed, so that the tile file only exists once the task is complete
+    out_file = tile_file(year, index)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    diagnostics.to_json(out_file.with_suffix(".json"))
+
+    temp_file = out_file.with_suffix(".tmp")
+    gpp_data.to_netcdf(temp_file, encoding=GPP_models.gpp_encoding)
+    temp_file.replace(out_file)
+
+    return year, index, time.time() - start
+
+
+def stitch_year(year, tiles, keep_tiles=False):
+    """Stitch the completed tiles for a year into the annual output files.
+
+    Returns True if the year was stitched and False if tiles are missing.
+    """
+
+    tile_files = [tile_file(year, index) for index, _, _ in tiles]
+
+    if not all(f.exists() for f in tile_files):
+        return False
+
+    # Combine the tiles using their coordinates and write the annual file, again via a
+    # temporary file. The tiles are opened lazily, so the year is written in chunks.
+    out_file = year_file(year)
+    temp_file = out_file.with_suffix(".tmp")
+
+    with xarray.open_mfdataset(tile_files, combine="by_coords") as tiled_data:
+        tiled_data.to_netcdf(temp_file, encoding=GPP_models.gpp_encoding)
+
+    temp_file.replace(out_file)
+
+    # Merge the tile diagnostics into a single file for the year
+    diagnostics = DiagnosticsCollector()
+    for each_file in tile_files:
+        diagnostics.merge(
+            DiagnosticsCollector.from_json(each_file.with_suffix(".json"))
+        )
+
+    diagnostics.to_json(
+        GPP_models.output_path / f"data/1se_asia_gpp_{year}_diagnostics.json"
+    )
+
+    if not keep_tiles:
+        for each_file in tile_files:
+            each_file.with_suffix(".json").unlink()
+            each_file.unlink()
+
+    return True
+
+
+def report(message):
+    """Print a progress message and append it to the progress log."""
+
+    message = f"{time.strftime('%Y-%m-%d %H:%M:%S')} {message}"
+    print(message, flush=True)
+
+    tile_root.mkdir(parents=True, exist_ok=True)
+    with open(tile_root / "progress.log", "a") as log:
+        log.write(message + "\n")
+
+
+def run_tiles(years, tiles, workers, keep_tiles):
+    """Run all of the incomplete (year, tile) tasks and stitch completed years."""
+
+    tasks = [
+        (year, tile)
+        for year, tile in product(years, tiles)
+        if not year_file(year).exists() and not tile_file(year, tile[0]).exists()
+    ]
+
+    report(f"Running {len(tasks)} tasks across {workers} workers")
+
+    if workers == 1:
+        results = (run_task(*task) for task in tasks)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        futures = [executor.submit(run_task, *task) for task in tasks]
+        results = (future.result() for future in as_completed(futures))
+
+    for n_done, (year, index, elapsed) in enumerate(results, start=1):
+        report(
+            f"[{n_done}/{len(tasks)}] Completed {year} tile {index:03d} in "
+            f"{elapsed:.0f} seconds"
+        )
+
+    if workers > 1:
+        executor.shutdown()
+
+    stitch_years(years, tiles, keep_tiles)
+
+
+def stitch_years(years, tiles, keep_tiles):
+    """Stitch any years that have all of their tiles completed."""
+
+    for year in years:
+        if year_file(year).exists():
+            continue
+
+        if stitch_year(year, tiles, keep_tiles=keep_tiles):
+            report(f"Stitched {year}")
+
+
+def print_status(years, tiles):
+    """Print the number of completed tiles for each year."""
+
+    for year in years:
+        if year_file(year).exists():
+            status = "complete"
+        else:
+            n_done = sum(tile_file(year, index).exists() for index, _, _ in tiles)
+            status = f"{n_done} of {len(tiles)} tiles"
+
+        print(f"{year}: {status}")
+
+
+def gpp_tiled_runner_cli():
+    """Run the SE Asia GPP models in parallel across tiles.
+
+    The region is split into tiles and the (year, tile) tasks are run across a pool of
+    worker processes. When run as a PBS array job and no years are given, the job runs
+    all of the tiles for the year given by PBS_ARRAY_INDEX.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(gpp_tiled_runner_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument("command", choices=["run", "status", "stitch"])
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs=2,
+        metavar=("FIRST", "LAST"),
+        help="The first and last year to process (default: 1982 2018)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("NCPUS", 1)),
+        help="The number of worker processes (default: NCPUS or 1)",
+    )
+    parser.add_argument(
+        "--tile-lat", type=int, default=8, help="Tile height in degrees (default: 8)"
+    )
+    parser.add_argument(
+        "--tile-lon", type=int, default=7, help="Tile width in degrees (default: 7)"
+    )
+    parser.add_argument(
+        "--keep-tiles",
+        action="store_true",
+        help="Keep the tile files after stitching",
+    )
+
+    args = parser.parse_args()
+
+    # Get the years to process
+    if args.years is not None:
+        years = list(range(args.years[0], args.years[1] + 1))
+    elif os.getenv("PBS_ARRAY_INDEX") is not None:
+        years = [int(os.getenv("PBS_ARRAY_INDEX"))]
+    else:
+        years = list(range(1982, 2019))
+
+    tiles = make_tiles(args.tile_lat, args.tile_lon)
+
+    if args.command == "run":
+        run_tiles(years, tiles, args.workers, args.keep_tiles)
+    elif args.command == "stitch":
+        stitch_years(years, tiles, args.keep_tiles)
+    else:
+        print_status(years, tiles)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    gpp_tiled_runner_cli()
@@ -1,6 +1,15 @@
 # This Python script calculates the long run aridity index for the region and then the
 # monthly Stocker soil moisture penalties
+#
+# The long run totals of AET and PET are kept in an accumulator file along with the
+# list of years that have already been added. Each run only reads the total AET and PET
+# from years that are not yet in the accumulator, so adding a new year of soil moisture
+# data updates the aridity index without rescanning the whole history. The Stocker
+# penalty is then calculated from the stored index for the newly added years and for any
+# years that are missing a penalty file. Setting the environment variable
+# RECALCULATE_PENALTIES=1 recalculates the penalty for all years from the current index.
 
+import os
 from pathlib import Path
 import re
 
@@ -13,33 +22,127 @@ from pyrealm.pmodel.functions import calc_soilmstress_stocker
 project_root = Path("/rds/general/project/lemontree/live/")
 output_path = project_root / "projects/se_asia_models/soil_moisture_penalty/data"
 
-# Get a list of only the compiled data files (in case the 2° banded outputs are still
-# present)
-compiled_data = re.compile("soil_moisture_([0-9]){4}.nc")
-soil_moisture_files = list(
-    f
-    for f in output_path.glob("soil_moisture_*.nc")
-    if compiled_data.match(str(f.name))
-)
+recalculate_penalties = os.getenv("RECALCULATE_PENALTIES", "0") == "1"
+
+
+class AridityAccumulator:
+    """Running totals of annual AET and PET for the long run aridity index.
+
+    The totals are persisted to a NetCDF file along with a ``year`` variable listing the
+    years that have been included. Years already in the accumulator are skipped when
+    added again, so the file can be updated incrementally as new years are compiled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.total_aet = None
+        self.total_pet = None
+        self.years = []
+
+        # Load the existing totals - load_dataset is used rather than open_dataset so
+        # that the file is closed and can be overwritten by save()
+        if self.path.exists():
+            ds = xarray.load_dataset(self.path)
+            self.total_aet = ds["total_aet"]
+            self.total_pet = ds["total_pet"]
+            self.years = [int(y) for y in ds["year"].to_numpy()]
+
+    def add_year(self, year, annual_file):
+        """Add the annual AET and PET totals from a soil moisture store.
+
+        Returns:
+            False if the year was already included, otherwise True.
+        """
 
-soil_moisture_files.sort()
+        if year in self.years:
+            return False
 
-# Calculate aridity index
-first_loop = True
-for annual_file in soil_moisture_files:
-    with xarray.open_dataset(annual_file) as ds:
-        if first_loop:
-            total_aet = ds["total_annual_aet"].compute()
-            total_pet = ds["total_annual_pet"].compute()
-            first_loop = False
+        with xarray.open_zarr(annual_file) as ds:
+            annual_aet = ds["total_annual_aet"].astype("float64").compute()
+            annual_pet = ds["total_annual_pet"].astype("float64").compute()
+
+        if self.total_aet is None:
+            # Drop any time coordinate carried across from the annual file
+            self.total_aet = annual_aet.drop_vars("time", errors="ignore")
+            self.total_pet = annual_pet.drop_vars("time", errors="ignore")
         else:
-            total_aet += ds["total_annual_aet"].compute()
-            total_pet += ds["total_annual_pet"].compute()
+            self.total_aet += annual_aet.to_numpy()
+            self.total_pet += annual_pet.to_numpy()
+
+        self.years.append(year)
+        return True
+
+    @property
+    def aridity_index(self):
+        """The long run aridity index as total AET / total PET."""
+        aridity_index = (self.total_aet / self.total_pet).astype("float32")
+        aridity_index.name = "aridity_index"
+        aridity_index.attrs["years"] = f"{min(self.years)} - {max(self.years)}"
+        return aridity_index
+
+    def save(self):
+        """Write the running totals to file.
+
+        The totals are written to a temporary file that then replaces the existing file,
+        so that a failure during writing does not corrupt the stored totals.
+        """
+
+        totals = xarray.Dataset(
+            data_vars={
+                "total_aet": self.total_aet,
+                "total_pet": self.total_pet,
+                "year": ("year", np.array(sorted(self.years), dtype="int32")),
+            }
+        )
 
-aridity_index = total_aet / total_pet
+        temp_path = self.path.with_suffix(".tmp")
+        totals.to_netcdf(
+            temp_path,
+            encoding={
+                "total_aet": {"dtype": "float64", "zlib": True, "complevel": 6},
+                "total_pet": {"dtype": "float64", "zlib": True, "complevel": 6},
+            },
+        )
+        temp_path.replace(self.path)
+
+
+# The number of 2° latitudinal bands written into each annual store
+N_BANDS = 20
+
+# Get the annual regional soil moisture stores written by the banded jobs keyed by year,
+# keeping only the years where all of the band jobs have marked their writes as complete
+store_name = re.compile("soil_moisture_([0-9]{4}).zarr")
+soil_moisture_files = {
+    int(match.group(1)): f
+    for f in output_path.glob("soil_moisture_*.zarr")
+    if (match := store_name.match(str(f.name)))
+}
+
+for year in list(soil_moisture_files):
+    bands_done = list(
+        (output_path / "band_progress").glob(f"soil_moisture_{year}_band_*.done")
+    )
+    if len(bands_done) < N_BANDS:
+        print(f"Skipping {year}: {len(bands_done)} of {N_BANDS} bands complete")
+        del soil_moisture_files[year]
+
+# Update the running totals with any new years
+accumulator = AridityAccumulator(output_path / "aridity_totals.nc")
+
+new_years = [
+    year
+    for year, annual_file in sorted(soil_moisture_files.items())
+    if accumulator.add_year(year, annual_file)
+]
+
+print(f"Years added to aridity totals: {new_years}")
+
+if new_years:
+    accumulator.save()
+
+aridity_index = accumulator.aridity_index
 
 # Write aridity index to file
-aridity_index.name = "aridity_index"
 aridity_index.to_netcdf(
     output_path / "aridity_index.nc",
     encoding={
@@ -54,9 +157,17 @@ aridity_index = np.broadcast_to(
     aridity_index.to_numpy()[None, :, :], (12, *aridity_index.shape)
 )
 
-for annual_file in soil_moisture_files:
+for year, annual_file in sorted(soil_moisture_files.items()):
+    penalty_file = output_path / f"stocker_penalty_{year}.nc"
+
+    # Only calculate penalties for new years or missing files unless requested
+    if not (recalculate_penalties or year in new_years or not penalty_file.exists()):
+        continue
+
+    print(f"Calculating Stocker penalty for {year}")
+
     # Open the input dataset
-    with xarray.open_dataset(annual_file) as ds:
+    with xarray.open_zarr(annual_file) as ds:
         # Calculate the penalty factor
         soil_penalty = calc_soilmstress_stocker(
             soilm=ds["monthly_wn"].to_numpy() / 150, meanalpha=aridity_index
@@ -68,7 +179,7 @@ for annual_file in soil_moisture_files:
             coords=ds.coords,
         )
         soil_penalty_ds.to_netcdf(
-            output_path / ("stocker_penalty_" + annual_file.name[-7:]),
+            penalty_file,
             encoding={
                 "stocker_penalty": {"dtype": "float32", "zlib": True, "complevel": 6},
             },
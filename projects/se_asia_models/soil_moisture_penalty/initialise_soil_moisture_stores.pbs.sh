@@ -1,7 +1,7 @@
 
 #!/bin/bash
 
-# Compile the banded soil moisture data
+# Preallocate the annual regional soil moisture stores
 
 # NOTES:
 #
@@ -11,10 +11,10 @@
 # The lines below are the PBS directives. They specify the resources required for the
 # job. 
 
-#PBS -lselect=1:ncpus=1:mem=128gb
-#PBS -lwalltime=24:00:00
+#PBS -lselect=1:ncpus=1:mem=16gb
+#PBS -lwalltime=01:00:00
 #PBS -j oe
-#PBS -o /rds/general/project/lemontree/live/projects/se_asia_models/soil_moisture_penalty/compile_banded_data.out
+#PBS -o /rds/general/project/lemontree/live/projects/se_asia_models/soil_moisture_penalty/initialise_soil_moisture_stores.out
 
 # Activate the conda environment
 eval "$(~/miniforge3/bin/conda shell.bash hook)"
@@ -25,8 +25,8 @@ python --version
 echo -e "In PBS.SH and running"
 date
 
-# Run the GPP script
-python /rds/general/project/lemontree/live/projects/se_asia_models/soil_moisture_penalty/compile_banded_data.py
+# Run the store initialisation script
+python /rds/general/project/lemontree/live/projects/se_asia_models/soil_moisture_penalty/initialise_soil_moisture_stores.py
 
 # Echo the end time and deactivate the conda environment
 date
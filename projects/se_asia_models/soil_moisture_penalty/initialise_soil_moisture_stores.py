@@ -0,0 +1,99 @@
+# This Python script preallocates the annual regional Zarr stores that are populated
+# directly by the 2° latitudinal band jobs in soil_moisture_banded.py.
+#
+# Each store contains the full region of interest and is chunked so that the chunk
+# boundaries along the y axis match the 2° band boundaries (240 rows at 30 arc
+# seconds). Each band job therefore writes to its own set of chunks and the band jobs
+# can write concurrently into the same store without any locking. Only the store
+# metadata and the coordinates are written here, so this job is quick and needs little
+# memory. It must be run before the soil_moisture_banded.pbs.sh array job is submitted.
+
+from pathlib import Path
+
+import dask.array
+import numpy as np
+import rioxarray  # noqa: F401, provides engine = 'rasterio'
+import xarray
+
+# Paths
+project_root = Path("/rds/general/project/lemontree/live/")
+elev_path = project_root / "source/GMTED2010/mn30/mn30.tiff"
+output_path = project_root / "projects/se_asia_models/soil_moisture_penalty/data"
+
+# Set the bounds - these must match the full extent of the bands in
+# soil_moisture_banded.py
+longitude_bounds = [92.0, 141.0]
+latitude_bounds = [29.0, -11.0]
+
+# The number of rows in a 2° band at 30 arc seconds and the number of columns in each
+# chunk, giving 6 chunks of 980 columns across the 5880 columns of the region.
+BAND_ROWS = 240
+CHUNK_COLUMNS = 980
+
+# Use the GMTED 2010 elevation at 30 arc seconds to provide the coordinates for the
+# region, as the band jobs also subset the CHELSA data using these bounds.
+elevation_ds = xarray.open_dataset(elev_path, engine="rasterio")
+region = elevation_ds.sel(
+    y=slice(*latitude_bounds),
+    x=slice(*longitude_bounds),
+)
+
+n_y = region.sizes["y"]
+n_x = region.sizes["x"]
+
+if n_y % BAND_ROWS:
+    raise ValueError(f"Region rows ({n_y}) are not a multiple of {BAND_ROWS}")
+
+for year in range(1982, 2019):
+    store_path = output_path / f"soil_moisture_{year}.zarr"
+
+    if store_path.exists():
+        print(f"Store already exists: {store_path}")
+        continue
+
+    time = np.array(
+        [np.datetime64(f"{year}-{month:02d}") for month in range(1, 13)]
+    ).astype("datetime64[ns]")
+
+    # Create a template dataset using lazy dask arrays - with compute=False, only the
+    # metadata and the coordinates are written to the store.
+    template = xarray.Dataset(
+        data_vars={
+            "monthly_wn": (
+                ("time", "y", "x"),
+                dask.array.full(
+                    (12, n_y, n_x),
+                    np.nan,
+                    dtype="float32",
+                    chunks=(12, BAND_ROWS, CHUNK_COLUMNS),
+                ),
+            ),
+            "total_annual_aet": (
+                ("y", "x"),
+                dask.array.full(
+                    (n_y, n_x),
+                    np.nan,
+                    dtype="float32",
+                    chunks=(BAND_ROWS, CHUNK_COLUMNS),
+                ),
+            ),
+            "total_annual_pet": (
+                ("y", "x"),
+                dask.array.full(
+                    (n_y, n_x),
+                    np.nan,
+                    dtype="float32",
+                    chunks=(BAND_ROWS, CHUNK_COLUMNS),
+                ),
+            ),
+        },
+        coords={
+            "time": time,
+            "y": region["y"],
+            "x": region["x"],
+            "spatial_ref": region["spatial_ref"],
+        },
+    )
+
+    template.to_zarr(store_path, mode="w-", compute=False)
+    print(f"Created store: {store_path}")
@@ -1,6 +1,7 @@
 # This is a draft of the Python code for running the GPP models
 import gc
 import os
+import sys
 import time
 from itertools import pairwise
 from pathlib import Path
@@ -17,6 +18,14 @@ chelsa_path = project_root / "source/CHELSA"
 elev_path = project_root / "source/GMTED2010/mn30/mn30.tiff"
 output_path = project_root / "projects/se_asia_models/soil_moisture_penalty/data"
 
+# Shared tools
+sys.path.append(str(project_root / "tools"))
+from unit_conversions import (  # noqa: E402
+    chelsa_clt_to_sunshine_fraction,
+    chelsa_pr_to_mm,
+    chelsa_tas_to_celsius,
+)
+
 # Set the bounds
 # The bounds were used to test memory usage. With the following bounds:
 #
@@ -98,6 +107,35 @@ def load_chelsa_data(path_format, year, latitude_bounds, longitude_bounds):
     return xarray.concat(month_data, dim="time", join="override")
 
 
+# Define a function to find the rows of the regional store covered by this band. The
+# band coordinates are matched to the nearest store coordinates, to avoid problems with
+# negligible differences in floating point representation, and the rows are then
+# checked to make sure they align with the store chunks so that concurrent band writes
+# never touch the same chunk.
+
+
+def find_band_rows(store_path, band_y):
+    """Find the slice of rows in a regional Zarr store matching the band y coordinates.
+
+    The store must have been created by initialise_soil_moisture_stores.py.
+    """
+
+    with xarray.open_zarr(store_path) as store:
+        store_y = store["y"].to_numpy()
+        chunk_rows = store["monthly_wn"].encoding["chunks"][1]
+
+    start = int(np.argmin(np.abs(store_y - band_y[0])))
+    band_rows = slice(start, start + len(band_y))
+
+    if not np.allclose(store_y[band_rows], band_y):
+        raise ValueError(f"Band coordinates do not match store: {store_path}")
+
+    if start % chunk_rows or len(band_y) % chunk_rows:
+        raise ValueError(f"Band rows {band_rows} not aligned to store chunks")
+
+    return band_rows
+
+
 # -------------------------------------------------------------------------------------
 # Year  variable data and modelling
 # - CHELSA is 1979 - 2018
@@ -130,11 +168,11 @@ for year in np.arange(1982, 2019):
     # Store coordinate data before converting
     coords = temperature_data.coords
 
-    # Now convert temperature to °C and reduce to numpy.
-    temperature_data = (temperature_data.to_numpy() / 10) - 273.15
-
-    # Clip out temperatures below -25°C
-    temperature_data = np.clip(temperature_data, a_min=-25.0, a_max=None)
+    # Now reduce to numpy and convert temperature to °C in place, clipping out
+    # temperatures below -25°C
+    temperature_data = chelsa_tas_to_celsius(
+        temperature_data.to_numpy(), min_celsius=-25.0
+    )
 
     # Precipitation
     precipitation_data = load_chelsa_data(
@@ -147,7 +185,7 @@ for year in np.arange(1982, 2019):
     # Convert units - converting from (kg m-2 month-1 * 100) in file
     # - approximating 1kg m-2 = 1 litre m-2 = 1mm m-2
     # - also reduce to numpy.
-    precipitation_data = precipitation_data.to_numpy() / 100
+    precipitation_data = chelsa_pr_to_mm(precipitation_data.to_numpy())
 
     # Cloud cover, converting from percentage to sunshine fraction as 1 - (clt /100) and
     # reduce to numpy.
@@ -158,7 +196,7 @@ for year in np.arange(1982, 2019):
         longitude_bounds=longitude_bounds,
     )
 
-    cloud_data = 1 - (cloud_data.to_numpy() / 100)
+    cloud_data = chelsa_clt_to_sunshine_fraction(cloud_data.to_numpy())
 
     # For some reason, the downloaded CLT data is at a coarser resolution (~3km)
     cloud_data = np.kron(cloud_data, np.ones((1, 3, 3), dtype="float32"))
@@ -245,26 +283,28 @@ for year in np.arange(1982, 2019):
     total_annual_aet = aet.sum(axis=0)
     total_annual_pet = splash.evap.pet_d.sum(axis=0)
 
-    # Create an xarray dataset
+    # Create an xarray dataset - the coordinates are omitted as they are already written
+    # to the regional store by initialise_soil_moisture_stores.py.
     calculated_data = xarray.Dataset(
         data_vars={
-            "monthly_wn": (("time", "y", "x"), wn_month),
-            "total_annual_aet": (("y", "x"), total_annual_aet),
-            "total_annual_pet": (("y", "x"), total_annual_pet),
+            "monthly_wn": (("time", "y", "x"), wn_month.astype("float32")),
+            "total_annual_aet": (("y", "x"), total_annual_aet.astype("float32")),
+            "total_annual_pet": (("y", "x"), total_annual_pet.astype("float32")),
         },
-        coords=coords,
     )
 
-    # Write data out as compressed float32 values.
-    out_encoding = {"dtype": "float32", "zlib": True, "complevel": 6}
-    calculated_data.to_netcdf(
-        output_path / f"soil_moisture_{year}_band_{array_index}.nc",
-        encoding={
-            "monthly_wn": out_encoding,
-            "total_annual_aet": out_encoding,
-            "total_annual_pet": out_encoding,
-        },
-    )
+    # Write the band directly into the rows of the preallocated regional store for the
+    # year. The store chunks are aligned to the band boundaries, so each band job only
+    # writes its own chunks and bands can be written concurrently.
+    store_path = output_path / f"soil_moisture_{year}.zarr"
+    band_rows = find_band_rows(store_path, coords["y"].to_numpy())
+    calculated_data.to_zarr(store_path, mode="r+", region={"y": band_rows})
+
+    # Record that this band is complete for the year - the stores are preallocated for
+    # all years, so the completion markers are used to find years with all bands written
+    progress_path = output_path / "band_progress"
+    progress_path.mkdir(exist_ok=True)
+    (progress_path / f"soil_moisture_{year}_band_{array_index}.done").touch()
 
     # Free up memory
     del (
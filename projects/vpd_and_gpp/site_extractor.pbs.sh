@@ -4,10 +4,11 @@
 
 # NOTES:
 #
-# * Use the throughput class - single node, single cpu, using GPFS for better file
-#   handling
+# * Use the throughput class - single node, using GPFS for better file handling
+# * The WFDE5 files are read in parallel across NCPUS worker processes, but only the
+#   site cells are read from each file, so the memory requirements are small.
 
-#PBS -lselect=1:ncpus=1:mem=96gb:gpfs=true
+#PBS -lselect=1:ncpus=8:mem=16gb:gpfs=true
 #PBS -lwalltime=02:00:00
 #PBS -j oe
 #PBS -o /rds/general/project/lemontree/ephemeral/vpd_and_gpp_site_extractor.out
@@ -1,11 +1,20 @@
 """Extract monthly mean values for P Model drivers for VPD and GPP project.
 
-This script extracts the model driver values for the P Model from 2010 - 2019 from the
-WFDE5 dataset, the SNU FAPAR dataset and the NOAA global CO2 series, using the nearest
-global grid cell for a set of defined sites being used in the project. All variables are
-resampled to monthly means and then compiled into a single driver dataset.
+This script extracts the model driver values for the P Model from 1982 - 2019 from the
+WFDE5 dataset, the SNU FAPAR dataset, the Mengoli soil moisture stress data and the NOAA
+global CO2 series, using the nearest global grid cell for a set of defined sites being
+used in the project. All variables are resampled to monthly means and then compiled into
+a single driver dataset.
+
+The gridded sources are extracted using the shared site extraction tools, which read
+only the site cells from each file. The monthly means for each grid cell extracted from
+the gridded sources are stored in a site cache in `projects/vpd_and_gpp/site_cache`, so
+rerunning the script with a changed site list only reads the gridded files for grid
+cells that have not been seen before.
 """
 
+import os
+import sys
 from pathlib import Path
 
 import numpy as np
@@ -16,16 +25,23 @@ import xarray as xr
 root = Path("/rds/general/project/lemontree/live")
 project = root / "projects/vpd_and_gpp"
 
-# Load site data and convert to an xarray dataset that can be used
-#  to spatially index the global gridded data
-site_coords = pd.read_csv(project / "site_data_new.csv")
+# Shared tools
+sys.path.append(str(root / "tools"))
+from site_extraction import extract_sites  # noqa: E402
+
+# Load site data, allowing for the byte order mark at the start of the file, and
+# standardise the site id and location column names
+site_coords = pd.read_csv(project / "site_data_new.csv", encoding="utf-8-sig")
+site_coords = site_coords.rename(
+    columns={"Ecoregion_Location": "site_id", "Lat": "lat", "Long": "lon"}
+)
 
 site_coords_xarray = xr.Dataset(
     data_vars={
-        "lat": ("site_id", site_coords["Lat"]),
-        "lon": ("site_id", site_coords["Long"]),
+        "lat": ("site_id", site_coords["lat"]),
+        "lon": ("site_id", site_coords["lon"]),
     },
-    coords={"site_id": site_coords["Ecoregion_Location"]},
+    coords={"site_id": site_coords["site_id"]},
 )
 
 # Data sources:
@@ -50,73 +66,29 @@ timestamps = np.arange(start_date, end_date, np.timedelta64(1, "M")).astype(
 )
 timeslice = slice(np.datetime64("1982-01-01 00:00"), np.datetime64("2019-12-31 23:59"))
 
-# Create an empty directory to collect processed data arrays to build the new dataset
-compiled_data = {}
-
 # -----------------
-# WFDE5 DATA
-# -----------------
-wfde_path = root / "source/wfde5/wfde5_v2/"
-wfde_vars = ["PSurf", "Qair", "SWdown", "Tair"]
-
-for var in wfde_vars:
-    # Get a list of all the files across years for this variable. The open_mfdataset
-    # creates a meta-dataset across multiple files that can then be used to select data.
-    # The contents of the files are not loaded until actually needed for processing.
-    var_directory = wfde_path / var
-    print(var_directory)
-    wfde_files = list(var_directory.rglob("*.nc"))
-    wfde_data = xr.open_mfdataset(wfde_files)
-
-    # Find the cell closest to the provided site coordinates
-    site_data = wfde_data.sel(
-        lat=site_coords_xarray["lat"], lon=site_coords_xarray["lon"], method="nearest"
-    )
-
-    # Drop to the target time range
-    site_data = site_data.sel(time=timeslice)
-
-    # Aggregate to monthly mean values and call compute to load and process the data
-    monthly_site_data = site_data.resample(time="1ME").mean().compute()
-
-    # The lat lon coordinates are taken from the grid, so reset to the site to
-    # standardise across sources
-    monthly_site_data = monthly_site_data.assign_coords(
-        lat=site_coords_xarray["lat"], lon=site_coords_xarray["lon"], time=timestamps
-    )
-
-    # Save the data array specific variable into the compiled data
-    compiled_data[var] = monthly_site_data[var]
-
+# GRIDDED DATA
 # -----------------
-# FAPAR data
-# -----------------
-# Again - collect all the available files and open them as a meta-dataset
-fapar_path = root / "source/SNU_005_Version_1/FPAR_daily_by_month/"
-fapar_files = list(fapar_path.rglob("*.nc"))
-fapar_data = xr.open_mfdataset(fapar_files)
-
-# Find the cell closest to the provided site coordinates - need to rename the variables
-# to match the site data names first
-fapar_data = fapar_data.rename({"latitude": "lat", "longitude": "lon"})
-site_data = fapar_data.sel(
-    lat=site_coords_xarray["lat"], lon=site_coords_xarray["lon"], method="nearest"
+# Extract monthly means for the WFDE5, FAPAR and soil moisture stress data. The three
+# products are read in parallel across NCPUS worker processes.
+site_data = extract_sites(
+    site_coords,
+    products=["wfde5", "snu_fapar", "soilmstress_mengoli"],
+    start=timeslice.start,
+    end=timeslice.stop,
+    monthly=True,
+    root=root,
+    cache_dir=project / "site_cache",
+    workers=int(os.getenv("NCPUS", 1)),
 )
 
-# Drop to the target time range
-site_data = site_data.sel(time=timeslice)
-
-# Aggregate to monthly mean values and compute the actual data
-monthly_site_data = site_data.resample(time="1ME").mean().compute()
-
-# Standardise the coordinates from the grid to the sites
-monthly_site_data = monthly_site_data.assign_coords(
-    lat=site_coords_xarray["lat"], lon=site_coords_xarray["lon"], time=timestamps
+# Align to the common timestamps and use the project variable names
+compiled_data = dict(
+    site_data.reindex(time=timestamps)
+    .rename(FPAR="FAPAR", soilmstress_mengoli="SOILMSTRESS")
+    .data_vars
 )
 
-# Store the data array of the required variable
-compiled_data["FAPAR"] = monthly_site_data["FPAR"]
-
 # -----------------
 # NOAA CO2 data
 # -----------------
@@ -142,34 +114,6 @@ co2_noaa = co2_noaa.assign_coords(time=timestamps)
 co2_noaa, _ = xr.broadcast(co2_noaa, site_coords_xarray)
 compiled_data["co2"] = co2_noaa["co2"]
 
-# -------------------------
-# SOIL MOISTURE (MENGOLI)
-# --------------------------
-
-# Collect all the available files and open them as a meta-dataset
-soilmstress_path = root / "derived/aridity/data/"
-soilmstress_files = list(soilmstress_path.rglob("*.nc"))
-soilmstress_data = xr.open_mfdataset(soilmstress_files)
-
-# Find the cell closest to the provided site coordinates
-site_data = soilmstress_data.sel(
-    lat=site_coords_xarray["lat"], lon=site_coords_xarray["lon"], method="nearest"
-)
-
-# Drop to the target time range
-site_data = site_data.sel(time=timeslice)
-
-# Aggregate to monthly mean values and compute the actual data
-monthly_site_data = site_data.resample(time="1ME").mean().compute()
-
-# Standardise the coordinates from the grid to the sites
-monthly_site_data = monthly_site_data.assign_coords(
-    lat=site_coords_xarray["lat"], lon=site_coords_xarray["lon"], time=timestamps
-)
-
-# Store the data array of the required variable
-compiled_data["SOILMSTRESS"] = monthly_site_data["soilmstress_mengoli"]
-
 # -----------------
 # COMPILE AND EXPORT
 # -----------------
@@ -3,9 +3,9 @@
 # This script repakages the incoming data from individual day files in landonly
 # vectors to netcdf files containing a year of data in an unpacked grid
 
-# Use the throughput class - single node, single cpu
+# Single node, with files checked in parallel across the requested cpus
 
-#PBS -lselect=1:ncpus=1:mem=96gb:gpfs=true
+#PBS -lselect=1:ncpus=8:mem=16gb:gpfs=true
 #PBS -lwalltime=24:00:00
 #PBS -j oe
 #PBS -o limit_checker.out
@@ -1,19 +1,26 @@
-import os
-import re
-import sys
-from pathlib import Path
-
-import numpy as np
-import xarray
-
 """
 This script is used to check the distribution of values in the incoming raw data. The
 following environment variables need to be set:
 
 * variable name in VAR
 * root directory in DIR
+
+The checks use the shared file QC tools, which read each file in slabs and summarise the
+values in a single pass, checking files in parallel across NCPUS worker processes. The
+file summaries are cached in the raw data directory, so rerunning the checks after new
+files arrive only reads the new or changed files.
 """
 
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# Shared tools
+sys.path.append("/rds/general/project/lemontree/live/tools")
+from file_qc import check_files, write_csv  # noqa: E402
+
 # Environment variables
 var = os.getenv("VAR")
 # Location of the root directory
@@ -42,41 +49,23 @@ input_file_dir = os.path.join(dir_root, f"{file_var}_raw")
 input_files = list(Path(input_file_dir).rglob("*.nc"))
 input_files.sort()
 
-# Create an output file
-outfile = Path(input_file_dir) / f"{var_name}_distribution.csv"
-
-# Create the histogram bins
-bins = np.arange(hist_lo, hist_hi, hist_step)
-
-
-with open(outfile, "w", buffering=1) as outf:
-
-    # Write headers
-    outf.write(f"file,N_na,N_inf,lo,{','.join([f'{x:0.2f}' for x in bins])},hi\n")
-
-    # Add lower and upper limits to bins
-    bins = np.concatenate([[-np.inf], bins, [np.inf]])
-
-    # Loop over the files
-    for this_file in input_files:
-
-        # Load, reduce to required DataArray and set missing values
-        try:
-            ds = xarray.load_dataset(this_file)
-            mat = ds[var_name]
-        except (OSError, RuntimeError, ValueError) as e:
-            err_string = str(e).replace("\n", " ")
-            outf.write(f"{this_file} # {err_string}\n")
-            continue
-
-        # Set NAs and count and remove inf
-        mat = mat.where(mat != missing_value)
-        na_count = int(mat.isnull().sum())
-        inf_count = int(np.isinf(mat).sum())
-        mat = mat.where(np.isfinite(mat))
-
-        counts, edges = np.histogram(mat, bins)
-        # Report limits
-        outf.write(
-            f"{this_file},{na_count},{inf_count},{','.join([f'{x}' for x in counts])}\n"
-        )
+# Create an output file and the file summary cache
+outfile = Path(input_file_dir) / f"{var_name.strip()}_distribution.csv"
+cache_file = Path(input_file_dir) / f"{var_name.strip()}_qc_cache.json"
+
+# Create the histogram bins from the bin edges, with values below the first edge and
+# above the last edge counted separately
+bins = None
+if hist_step is not None:
+    edges = np.arange(hist_lo, hist_hi, hist_step)
+    bins = (float(edges[0]), float(edges[-1]), len(edges) - 1)
+
+summaries = check_files(
+    input_files,
+    var_name,
+    missing_value=missing_value,
+    bins=bins,
+    cache_path=cache_file,
+    workers=int(os.getenv("NCPUS", 1)),
+)
+write_csv(summaries, outfile)
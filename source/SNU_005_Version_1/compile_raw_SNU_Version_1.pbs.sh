@@ -3,9 +3,11 @@
 # This script repakages the incoming data from individual day NetCDF files 
 # vectors to netcdf files containing a year of data.
 
-# Use the throughput class - single node, single cpu, using GPFS for better file handling
+# Use the throughput class - single node, using GPFS for better file handling. The daily
+# files are decoded across the NCPUS cores into two float32 month buffers that are
+# memory mapped in the job TMPDIR (~3.2GB each), so the memory needed is much smaller.
 
-#PBS -lselect=1:ncpus=8:mem=96gb:gpfs=true
+#PBS -lselect=1:ncpus=8:mem=32gb:ephemeral=10gb:gpfs=true
 #PBS -lwalltime=24:00:00
 #PBS -J 1-21
 #PBS -j oe
@@ -8,13 +8,21 @@ following environment variables set:
 * variable name in VAR - used to identify sets of attributes for processing
 * output dir suffix in OUTDIR_SUFFIX
 * the earliest year to process in YEARONE
+
+The daily files for each month are decoded in parallel across NCPUS worker processes
+into a float32 month buffer, and each completed month is written to disk while the next
+month is decoded. Existing monthly files are skipped, so a failed job can be
+resubmitted.
 """
 
 import os
 import re
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+import netCDF4
 import numpy as np
 import psutil
 import xarray
@@ -113,54 +121,133 @@ res = 0.05
 longitude = np.arange(-180 + res / 2, 180, res)
 latitude = np.arange(90 - res / 2, -90, -res)
 
-# Loop over months
-for this_month in np.arange(1, 13):
+# Get the variable and coordinate attributes from the first file
+with xarray.open_dataset(year_files[0][1]) as first_file:
+    var_attrs = first_file[var_info["data_var"]].attrs
+    lat_attrs = first_file["lat"].attrs
+    lon_attrs = first_file["lon"].attrs
 
-    # Reduce to monthly files - should preserve order
-    month_files = [df for df, m in zip(year_files, months) if m == this_month]
+# Output directory
+out_dir = os.path.join(dir_root, f"{var}_{outdir_suffix}")
+os.makedirs(out_dir, exist_ok=True)
 
-    # Make a 3D array in uint16 to complete for the year following
-    # CF TZYX recommendation
-    base_grid = np.ndarray((len(month_files), len(latitude), len(longitude)))
+# The daily files are decoded by a pool of worker processes - the NetCDF library is not
+# thread-safe - directly into a month buffer. The buffers are float32 memory maps in the
+# job temporary directory, which the workers open and write their day into. There are
+# two buffers, so that the completed month in one buffer can be written to disk by a
+# writer thread while the days for the next month are decoded into the other.
+n_workers = int(os.getenv("NCPUS", 1))
+buffer_shape = (31, len(latitude), len(longitude))
+scratch_dir = os.getenv("TMPDIR", tempfile.gettempdir())
 
-    # Loop over the files
-    for day_idx, (day_num, this_file) in enumerate(month_files):
 
-        report_mem(process, f"Loading day: {day_idx}; ")
+def decode_day(this_file, data_var, buffer_path, day_idx):
+    """Decode a daily file into a day of a month buffer.
 
-        # Load the data and reduce to the data array (this is really just about
-        # handling NIRv and the NIRv QA - all the rest are single data variable)
-        mat = xarray.load_dataset(this_file)
-        mat = mat[var_info["data_var"]]
+    The daily files store the data as (longitude, latitude), so the data are transposed
+    as they are copied into the buffer. Returns the range of the values for the day.
+    """
 
-        # insert into the correct day of year
-        base_grid[day_idx - 1, :, :] = mat.T
+    with netCDF4.Dataset(this_file) as ds:
+        data = np.ma.filled(ds[data_var][:].astype("float32"), np.nan)
 
-    # Reporting
-    report_mem(process, "Data loaded; ")
+    buffer = np.memmap(buffer_path, dtype="float32", mode="r+", shape=buffer_shape)
+    np.copyto(buffer[day_idx], data.T)
+    buffer.flush()
 
-    sys.stdout.write(f"Range: {np.nanmin(base_grid)} {np.nanmax(base_grid)}\n")
-    sys.stdout.flush()
+    return np.nanmin(data), np.nanmax(data)
+
+
+def write_month(buffer, n_days, month_dates, out_file):
+    """Write the days for a month from a buffer to a NetCDF file.
+
+    The file is written to a temporary file that is renamed once complete.
+    """
 
     xds = xarray.DataArray(
-        base_grid,
+        buffer[:n_days],
         coords=[
-            dates[months == this_month],
-            xarray.DataArray(latitude, attrs=mat["lat"].attrs),
-            xarray.DataArray(longitude, attrs=mat["lon"].attrs),
+            month_dates,
+            xarray.DataArray(latitude, attrs=lat_attrs),
+            xarray.DataArray(longitude, attrs=lon_attrs),
         ],
         dims=["time", "latitude", "longitude"],
         name=var_info["data_var"],
-        attrs=mat.attrs,
+        attrs=var_attrs,
     )
 
-    report_mem(process, "DataArray created; ")
-
-    # Save to disk - creating output directory
-    out_dir = os.path.join(dir_root, f"{var}_{outdir_suffix}")
-    os.makedirs(out_dir, exist_ok=True)
-    out_file = os.path.join(out_dir, f"{var}_{year}_{this_month:02}.nc")
-
+    temp_file = out_file + ".tmp"
     xds.to_netcdf(
-        out_file, encoding={var_info["data_var"]: {"zlib": True, "complevel": 6}}
+        temp_file, encoding={var_info["data_var"]: {"zlib": True, "complevel": 6}}
     )
+    os.replace(temp_file, out_file)
+
+    report_mem(process, f"Written {out_file}; ")
+
+
+if __name__ == "__main__":
+
+    with (
+        tempfile.TemporaryDirectory(dir=scratch_dir) as buffer_dir,
+        ProcessPoolExecutor(max_workers=n_workers) as decoders,
+        ThreadPoolExecutor(max_workers=1) as writer,
+    ):
+        buffer_paths = [os.path.join(buffer_dir, f"buffer_{idx}.dat") for idx in (0, 1)]
+        buffers = [
+            np.memmap(path, dtype="float32", mode="w+", shape=buffer_shape)
+            for path in buffer_paths
+        ]
+        pending_writes = [None, None]
+
+        # Loop over months
+        for this_month in np.arange(1, 13):
+
+            out_file = os.path.join(out_dir, f"{var}_{year}_{this_month:02}.nc")
+            if os.path.exists(out_file):
+                sys.stdout.write(f"Skipping existing file: {out_file}\n")
+                continue
+
+            # Reduce to monthly files - should preserve order
+            month_files = [df for df, m in zip(year_files, months) if m == this_month]
+            if not month_files:
+                sys.stdout.write(f"No files for month {this_month}\n")
+                continue
+
+            # Wait for any previous write from the buffer for this month to complete
+            buf_idx = this_month % 2
+            if pending_writes[buf_idx] is not None:
+                pending_writes[buf_idx].result()
+
+            # Decode the days into the correct day index of the buffer
+            futures = [
+                decoders.submit(
+                    decode_day,
+                    this_file,
+                    var_info["data_var"],
+                    buffer_paths[buf_idx],
+                    day_idx,
+                )
+                for day_idx, (_, this_file) in enumerate(month_files)
+            ]
+            day_ranges = np.array([future.result() for future in futures])
+
+            # Reporting
+            report_mem(process, f"Month {this_month} loaded; ")
+            sys.stdout.write(
+                f"Range: {np.nanmin(day_ranges[:, 0])} {np.nanmax(day_ranges[:, 1])}\n"
+            )
+            sys.stdout.flush()
+
+            # Write the month in the background while the next month is decoded
+            pending_writes[buf_idx] = writer.submit(
+                write_month,
+                buffers[buf_idx],
+                len(month_files),
+                dates[months == this_month],
+                out_file,
+            )
+
+        # Check for errors in the outstanding writes
+        for pending in pending_writes:
+            if pending is not None:
+                pending.result()
@@ -3,9 +3,10 @@
 # This script encodes compiled monthly data files using integer data to improve
 # file size and compression by discarding spurious precision.
 
-# Use the throughput class - single node, single cpu, using GPFS for better file handling
+# Use the throughput class - single node, single cpu, using GPFS for better file handling.
+# The files are encoded in slabs of rows, so the memory needed is small.
 
-#PBS -lselect=1:ncpus=8:mem=96gb:gpfs=true
+#PBS -lselect=1:ncpus=1:mem=8gb:gpfs=true
 #PBS -lwalltime=24:00:00
 #PBS -J 1-21
 #PBS -j oe
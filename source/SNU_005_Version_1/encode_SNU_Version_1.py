@@ -1,6 +1,11 @@
 """Encodes monthly files from double to uint16.
 
-This script uses xarray encoding to compress the file sizes from float32 to uint16.
+This script encodes the monthly float data as uint16 (or uint8) packed integers to
+reduce the file sizes. The encoding rules for each variable are given in var_dict: the
+input fill value, values to discard above an upper limit, values to clamp to a lower
+limit, the scale factor and offset, the encoded type and the missing value. The files
+are read, encoded and written in slabs of latitude rows, so the memory use does not
+depend on the file size.
 
 The script is intended to be submitted with an array job to loop over years with the
 following environment variables set:
@@ -15,13 +20,15 @@ import re
 import sys
 from pathlib import Path
 
+import netCDF4
 import numpy as np
 import psutil
-import xarray
 
 # TODO - look at gathering to save space - cf-python implements reading and
 #        unpacking back to 2D really elegantly but xarray and netcdf4 read the
-#        fine but need unpacking separately (not built in)
+#        fine but need unpacking separately (not built in). The shared
+#        tools/gathered_grids.py module now writes CF gathered files and provides
+#        the unpacking and subsetting readers for xarray.
 
 # Environment variables
 var = os.getenv("VAR")
@@ -146,84 +153,128 @@ year_filter = [(yr_regex.search(p.name).groups(), p) for p in input_year_files]
 year_filter.sort()
 year_files = [fl for ((yr,), fl) in year_filter if int(yr) == year]
 
-# Loop over months
-for this_month in year_files:
-
-    # Load the data
-    mat = xarray.load_dataset(this_month)
-    mat = mat[file_var]
-
-    # Set missing values - note that the test in DataArray.where() identifies the values
-    # to _keep_, and the other values are replaced by the second value (default NA)
-    mat = mat.where(mat != var_info["fill"])
-
-    # Data tidying - set nulls first and then clamp. Need to explicitly exclude nulls
-    # from clamping operations.
-    if var_info["discard_above"] is not None:
-        mat = mat.where(mat <= var_info["discard_above"])
-
-    if var_info["clamp_below"] is not None:
-        mat = mat.where(
-            (mat >= var_info["clamp_below"]) | mat.isnull(), var_info["clamp_below"]
-        )
-
-    # Manual unit16 encoding
-    # - xarray does provide the 'encoding' argument to to_netcdf(), but the memory
-    #   management of this (make copy, set NA, cast copy) uses 2.5 x data in RAM, with
-    #   some odd spikes. This script does that manually and sets attributes directly.
-
-    if (var_info["add_offset"] is not None) and (var_info["scale_factor"] is not None):
-        mat_cast = np.round(
-            (mat - var_info["add_offset"]) * var_info["scale_factor"], 0
-        ).astype(var_info["encode_type"])
-    else:
-        mat_cast = mat.astype(var_info["encode_type"])
+# The number of latitude rows in each slab - each slab is read, encoded and written in a
+# single pass, so the memory used depends on the slab size and not the file size.
+SLAB_ROWS = 360
 
-    # Set the NULL VALUE
-    mat_cast = mat_cast.where(mat.notnull(), NULL_VALUE)
 
-    # Reporting
-    report_mem(process, "Data loaded; ")
+def encode_slab(data: np.ndarray, var_info: dict) -> np.ndarray:
+    """Encode a slab of data using the encoding rules for a variable.
 
-    # Extend the existing variable attributes
-    var_attrs = {
-        **mat.attrs,
-        "_FillValue": NULL_VALUE,
-    }
+    The fill, discard_above and clamp_below rules are applied and the data are then
+    scaled, offset and cast to the encoded type, with missing values set to the missing
+    value. The operations are applied in place on the float slab, so only the encoded
+    output and a mask of missing values are allocated.
 
-    if var_info["scale_factor"] is not None:
-        var_attrs["scale_factor"] = 1 / var_info["scale_factor"]
+    Args:
+        data: A floating point slab of data, which is modified in place.
+        var_info: The variable encoding rules.
+    """
 
-    if var_info["add_offset"] is not None:
-        var_attrs["add_offset"] = var_info["add_offset"]
+    # Identify missing values: NaN, the fill value and any values to discard
+    missing = np.isnan(data)
+    missing |= data == var_info["fill"]
 
     if var_info["discard_above"] is not None:
-        var_attrs[
-            "discard_above"
-        ] = f"Values above {var_info['discard_above']} set to missing"
+        # Use a negated test so that positive infinity is also discarded
+        missing |= ~(data <= var_info["discard_above"])
 
     if var_info["clamp_below"] is not None:
-        var_attrs[
-            "clamp_below"
-        ] = f"Values below {var_info['clamp_below']} set to {var_info['clamp_below']}"
+        np.maximum(data, var_info["clamp_below"], out=data)
+
+    if (var_info["add_offset"] is not None) and (var_info["scale_factor"] is not None):
+        np.subtract(data, var_info["add_offset"], out=data)
+        np.multiply(data, var_info["scale_factor"], out=data)
+        np.round(data, 0, out=data)
 
-    # Remove the 'fill' attribute - old NA value
-    if "fill" in var_attrs:
-        del var_attrs["fill"]
+    # Cast to the encoded type - missing values are overwritten after the cast, so any
+    # invalid casts of NaN values are discarded.
+    data[missing] = 0
+    encoded = data.astype(var_info["encode_type"])
+    encoded[missing] = NULL_VALUE
 
-    xds = xarray.DataArray(
-        mat_cast,
-        coords=[mat["time"], mat["latitude"], mat["longitude"]],
-        dims=["time", "latitude", "longitude"],
-        name=file_var,
-        attrs=var_attrs,
-    )
+    return encoded
 
-    report_mem(process, "DataArray created; ")
+
+# Loop over months
+for this_month in year_files:
 
     # Save to disk - creating output directory
     out_dir = os.path.join(dir_root, f"{var}_{outdir_suffix}")
     os.makedirs(out_dir, exist_ok=True)
     out_file = os.path.join(out_dir, this_month.name)
+    temp_file = out_file + ".tmp"
+
+    # Manual uint16 encoding
+    # - xarray does provide the 'encoding' argument to to_netcdf(), but the memory
+    #   management of this (make copy, set NA, cast copy) uses 2.5 x data in RAM, with
+    #   some odd spikes. This script reads, encodes and writes the data in slabs
+    #   directly using netCDF4 and sets attributes directly.
+    with (
+        netCDF4.Dataset(this_month) as in_ds,
+        netCDF4.Dataset(temp_file, "w", format="NETCDF4") as out_ds,
+    ):
+        in_var = in_ds[file_var]
+        n_time, n_lat, n_lon = in_var.shape
+
+        # Copy the dimensions and coordinates
+        for dim_name in ("time", "latitude", "longitude"):
+            in_coord = in_ds[dim_name]
+            out_ds.createDimension(dim_name, len(in_coord))
+            out_coord = out_ds.createVariable(dim_name, in_coord.dtype, (dim_name,))
+            out_coord.setncatts(
+                {
+                    k: in_coord.getncattr(k)
+                    for k in in_coord.ncattrs()
+                    if k != "_FillValue"
+                }
+            )
+            out_coord[:] = in_coord[:]
+
+        # Extend the existing variable attributes
+        var_attrs = {
+            k: in_var.getncattr(k)
+            for k in in_var.ncattrs()
+            if k not in ("_FillValue", "fill", "scale_factor", "add_offset")
+        }
+
+        if var_info["scale_factor"] is not None:
+            var_attrs["scale_factor"] = 1 / var_info["scale_factor"]
+
+        if var_info["add_offset"] is not None:
+            var_attrs["add_offset"] = var_info["add_offset"]
+
+        if var_info["discard_above"] is not None:
+            var_attrs[
+                "discard_above"
+            ] = f"Values above {var_info['discard_above']} set to missing"
+
+        if var_info["clamp_below"] is not None:
+            clamp_below = var_info["clamp_below"]
+            var_attrs[
+                "clamp_below"
+            ] = f"Values below {clamp_below} set to {clamp_below}"
+
+        out_var = out_ds.createVariable(
+            file_var,
+            var_info["encode_type"],
+            ("time", "latitude", "longitude"),
+            zlib=True,
+            complevel=6,
+            chunksizes=(1, min(SLAB_ROWS, n_lat), n_lon),
+            fill_value=NULL_VALUE,
+        )
+        out_var.setncatts(var_attrs)
+
+        # The output data are already packed, so disable automatic masking and scaling
+        out_var.set_auto_maskandscale(False)
+
+        for time_idx in range(n_time):
+            for row in range(0, n_lat, SLAB_ROWS):
+                rows = slice(row, row + SLAB_ROWS)
+                slab = np.ma.filled(in_var[time_idx, rows, :].astype("float32"), np.nan)
+                out_var[time_idx, rows, :] = encode_slab(slab, var_info)
+
+        report_mem(process, f"Encoded {this_month.name}; ")
 
-    xds.to_netcdf(out_file, encoding={file_var: {"zlib": True, "complevel": 6}})
+    os.replace(temp_file, out_file)
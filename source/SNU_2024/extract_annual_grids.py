@@ -4,62 +4,57 @@ This script converts the updated SNU data (see standardise_and_add_coords.py) in
 annual grids.
 
 The code:
-* Sets up the multi-index of latitude and longitude onto cell_id
-* Reshapes to two dimensional lat long arrays by unstacking the cell_id multi index.
-* Reindexes using the full set of latitude  and longitude values from the land mask to
-  fill in values along those dimensions where no land cells occur (should just be
-  missing latitudes thanks to Antarctica, but still playing safe)
-* Rename the dimensions to comply with CF standards.
+* Loads the grid row and column index of each land cell along the cell_id dimension,
+  which are saved in the cleaned data.
+* Preallocates a single float32 grid holding a year of data on the full latitude and
+  longitude axes of the land mask, so that latitudes and longitudes with no land cells
+  are filled with missing values.
+* Passes once through the source data a year at a time, scattering the land cell data
+  for each year into the grid with a single indexed assignment.
+* Uses the CF standard dimension order (time, latitude, longitude).
 * Save as compressed float32 to save space
 """
 
 import xarray as xr
 import numpy as np
-import pandas as pd
 from pathlib import Path
 
 
 root = Path("/rds/general/project/lemontree/live/source/SNU_2024")
 
 
-# Open the dataset
+# Open the dataset and load the land cell grid indices
 ds = xr.open_dataset(root / "snu_fpar_cleaned_v1.nc")
+cell_rows = ds["cell_row"].values
+cell_cols = ds["cell_col"].values
 
-# Get the unique years
-years = set(ds["time"].dt.year.data)
+# Get the unique years and the time indices for each year
+years = ds["time"].dt.year.values
+unique_years = np.unique(years)
 
-for this_year in years:
-    # Get a data array (ditching the landmask) of the fAPAR data for the year.
-    ds_sub = ds["fAPAR"].isel({"time": ds["time"].dt.year == this_year})
+# Preallocate the annual grid, sized for a full year of monthly data
+grid = np.empty((12, ds.sizes["latitude"], ds.sizes["longitude"]), dtype="float32")
 
-    # Create a multi-dimensional index onto cell id
-    mindex = pd.MultiIndex.from_arrays(
-        [
-            ds_sub["cell_longitude"].data,
-            ds_sub["cell_latitude"].data,
-        ],
-        names=["cell_longitude", "cell_latitude"],
-    )
-    mindex_coords = xr.Coordinates.from_pandas_multiindex(mindex, "cell_id")
-    ds_sub = ds_sub.assign_coords(mindex_coords)
+for this_year in unique_years:
+    # Read the fAPAR data for the year as (time, cell_id)
+    year_index = np.flatnonzero(years == this_year)
+    cell_data = ds["fAPAR"].isel(time=year_index).transpose("time", "cell_id").values
 
-    # Unstack the cell_id multi_index to lat and long
-    reshaped = ds_sub.unstack("cell_id")
+    # Scatter the land cells into the grid, leaving all other cells as missing
+    year_grid = grid[: len(year_index)]
+    year_grid.fill(np.nan)
+    year_grid[:, cell_rows, cell_cols] = cell_data
 
-    # Add missing coordinates from the global grid
-    reshaped = reshaped.reindex(
-        indexers={
-            "cell_latitude": ds["latitude"].data,
-            "cell_longitude": ds["longitude"].data,
+    reshaped = xr.Dataset(
+        data_vars={
+            "fAPAR": (("time", "latitude", "longitude"), year_grid, ds["fAPAR"].attrs)
+        },
+        coords={
+            "time": ds["time"].values[year_index],
+            "latitude": ds["latitude"].values,
+            "longitude": ds["longitude"].values,
         },
-        fill_value=np.nan,
-    )
-
-    # Rename dimensions and convert to float32
-    reshaped = reshaped.rename(
-        {"cell_latitude": "latitude", "cell_longitude": "longitude"}
     )
-    reshaped = reshaped.astype("float32")
 
     # Compress and save
     reshaped.to_netcdf(
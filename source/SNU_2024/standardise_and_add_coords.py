@@ -5,6 +5,10 @@ provides correct coordinates along the data dimensions, including a multi index
 latitude and longitude along the cell_id index. The raw data stores only land cell
 values along the cell_id index but does not provide a mapping of that dimension onto
 geographic coordinates, which is added here.
+
+The grid row and column index of each land cell are also saved along the cell_id
+dimension as `cell_row` and `cell_col`, so that the land cell data can be scattered
+directly into latitude and longitude grids without rebuilding the cell index.
 """
 
 import xarray as xr
@@ -61,6 +65,15 @@ mindex = pd.MultiIndex.from_arrays(
 mindex_coords = xr.Coordinates.from_pandas_multiindex(mindex, "cell_id")
 ds = ds.assign_coords(mindex_coords)
 
+# Save the positions of the land cells along the latitude and longitude dimensions, so
+# that data can be gridded using `grid[rows, cols] = data`.
+lat_index = ds.indexes["latitude"]
+lon_index = ds.indexes["longitude"]
+cell_rows = lat_index.get_indexer(landmsk_land_cells["latitude"].data)
+cell_cols = lon_index.get_indexer(landmsk_land_cells["longitude"].data)
+ds["cell_row"] = ("cell_id", cell_rows.astype("int32"))
+ds["cell_col"] = ("cell_id", cell_cols.astype("int32"))
+
 # The multindex can't be saved to NetCDF, so need to use reindex to drop the indexing,
 # leaving the relevant data in place.
 ds = ds.reset_index("cell_id")
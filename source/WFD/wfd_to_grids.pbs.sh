@@ -1,10 +1,12 @@
 #!/bin/bash
 
-# This script repackages the WFD from monthly files ofland cells only into annual grids
+# This script repackages the WFD from monthly files ofland cells only into annual grids.
+# The monthly files are scattered onto the grid in parallel across the requested cpus.
+# Submit with `qsub -v DAILY=1 wfd_to_grids.pbs.sh` to also write daily mean grids.
 
-# Use the throughput class - single node, single cpu, using GPFS for better file handling
+# Single node with 8 cpus, using GPFS for better file handling
 
-#PBS -lselect=1:ncpus=8:mem=96gb:gpfs=true
+#PBS -lselect=1:ncpus=8:mem=16gb:gpfs=true
 #PBS -lwalltime=24:00:00
 #PBS -J 1901-2001
 #PBS -j oe
@@ -1,66 +1,186 @@
+"""Convert WFD SWdown land cell data to annual grids.
+
+The WFD data are distributed as monthly gzipped files of 3-hourly data for land cells
+only. This script converts the files for a year into a single annual gridded file.
+
+The script is intended to be submitted with an array job to loop over years, using
+PBS_ARRAY_INDEX as the year. The monthly files are decompressed in memory and scattered
+onto the grid in parallel across NCPUS worker processes. Each worker writes its month
+directly into the right time steps of a float32 year buffer, which is a memory map in
+the job temporary directory, and the year is then written from the buffer.
+
+If the DAILY environment variable is set to 1, daily mean grids are also calculated
+from the year buffer and written to a separate file, so that daily workflows do not need
+to read the 3-hourly data again.
+
+Existing annual files are skipped, so a failed array job can simply be resubmitted.
+"""
+
 import datetime
 import gzip
 import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-import xarray
+import netCDF4
 import numpy as np
+import xarray
 
 root = Path("/rds/general/project/lemontree/live")
 
-# Load the land cells to grid translation table
-land_map = xarray.load_dataset(root / "source/WFD/SWDown/WFD-land-lat-long-z.nc")
-
-# Load the requested year and get the files to compile
-year = os.getenv("PBS_ARRAY_INDEX")
-paths = list((root / "source/WFD/SWDown/").glob(f"SWdown_WFD_{year}*"))
-paths.sort()
-
-data = []
-
-for each_file in paths:
-
-    # Load the data on the land coords
-    with gzip.open(each_file) as fp:
-        ds = xarray.load_dataset(fp, decode_times=False)
-
-    # Create the full grid and insert the data into the right locations
-    swdown = np.full((ds["SWdown"].shape[0], 360, 720), fill_value=np.nan, dtype=float)
-    swdown[:, land_map["Grid_lat"] - 1, land_map["Grid_lon"] - 1] = ds["SWdown"]
-
-    # Build the date coordinates - timestp gives a multiple of 3 hours from an origin
-    origin_iso = datetime.datetime.strptime(
-        ds["timestp"].attrs["time_origin"].strip(), "%Y-%b-%d %H:%M:%S"
-    ).isoformat()
-    origin = np.datetime64(origin_iso).astype("datetime64[ns]")
-    times = origin + np.timedelta64(60 * 60 * 3, "s") * ds["timestp"].to_numpy()
-
-    # Append the data to the list
-    data.append(
-        xarray.DataArray(
-            swdown,
-            coords={
-                "time": times,
-                "lat": np.arange(89.75, -90, -0.5),
-                "lon": np.arange(-179.75, 180, 0.5),
-            },
-            name="swdown",
+# The WFD time step and grid
+STEP = np.timedelta64(3, "h")
+STEPS_PER_DAY = 8
+latitude = np.arange(89.75, -90, -0.5)
+longitude = np.arange(-179.75, 180, 0.5)
+
+
+def scatter_month(path, buffer_path, buffer_shape, year_start, rows, cols):
+    """Decompress a monthly land cell file and scatter it into the year buffer.
+
+    Returns the first and last index of the time steps written to the buffer.
+    """
+
+    # Open the decompressed data in memory
+    with gzip.open(path) as fp:
+        content = fp.read()
+
+    with netCDF4.Dataset(path.name, memory=content) as ds:
+        data = np.ma.filled(ds["SWdown"][:].astype("float32"), np.nan)
+
+        # Build the date coordinates - timestp gives a multiple of 3 hours from an
+        # origin
+        origin = datetime.datetime.strptime(
+            ds["timestp"].time_origin.strip(), "%Y-%b-%d %H:%M:%S"
         )
+        times = np.datetime64(origin.isoformat()) + STEP * ds["timestp"][:].astype(int)
+
+    # Find the time steps in the year buffer
+    steps = (times - year_start) // STEP
+    first, last = int(steps[0]), int(steps[-1])
+    if not np.array_equal(steps, np.arange(first, last + 1)):
+        raise ValueError(f"Time steps in {path} are not contiguous")
+    if first < 0 or last >= buffer_shape[0]:
+        raise ValueError(f"Time steps in {path} are outside of the year")
+
+    # Fill the month with missing values and insert the land cells
+    buffer = np.memmap(buffer_path, dtype="float32", mode="r+", shape=buffer_shape)
+    month = buffer[first : last + 1]
+    month.fill(np.nan)
+    month[:, rows, cols] = data
+    buffer.flush()
+
+    return first, last
+
+
+def write_grid(data, times, out_file):
+    """Write gridded data to a NetCDF file via a temporary file."""
+
+    xds = xarray.DataArray(
+        data,
+        coords={"time": times, "lat": latitude, "lon": longitude},
+        dims=["time", "lat", "lon"],
+        name="swdown",
+    )
+
+    temp_file = out_file.with_suffix(".tmp")
+    xds.to_netcdf(
+        temp_file,
+        encoding={
+            "swdown": {
+                "zlib": True,
+                "complevel": 6,
+                "chunksizes": (min(len(times), STEPS_PER_DAY), 360, 720),
+            }
+        },
     )
+    temp_file.replace(out_file)
+
+
+if __name__ == "__main__":
+
+    # Load the requested year and get the files to compile
+    year = os.getenv("PBS_ARRAY_INDEX")
+    paths = list((root / "source/WFD/SWDown/").glob(f"SWdown_WFD_{year}*"))
+    paths.sort()
+
+    daily = os.getenv("DAILY", "0") == "1"
+
+    # Make sure the output directories exist
+    grid_out_dir = root / "source/WFD/SWDown_gridded"
+    grid_out_dir.mkdir(exist_ok=True)
+    out_file = grid_out_dir / f"WFD_SWDOWN_{year}.nc"
+
+    daily_out_dir = root / "source/WFD/SWDown_daily"
+    daily_out_file = daily_out_dir / f"WFD_SWDOWN_daily_{year}.nc"
+    if daily:
+        daily_out_dir.mkdir(exist_ok=True)
+
+    if out_file.exists() and (not daily or daily_out_file.exists()):
+        print(f"Outputs for {year} already exist")
+        raise SystemExit(0)
+
+    # Load the land cells to grid translation table
+    land_map = xarray.load_dataset(root / "source/WFD/SWDown/WFD-land-lat-long-z.nc")
+    rows = land_map["Grid_lat"].to_numpy().astype(int) - 1
+    cols = land_map["Grid_lon"].to_numpy().astype(int) - 1
+
+    # The year buffer holds every 3-hourly step in the year
+    year_start = np.datetime64(f"{year}-01-01", "ns")
+    year_end = np.datetime64(f"{int(year) + 1}-01-01", "ns")
+    times = np.arange(year_start, year_end, STEP)
+    buffer_shape = (len(times), len(latitude), len(longitude))
+
+    scratch_dir = os.getenv("TMPDIR", tempfile.gettempdir())
+    n_workers = int(os.getenv("NCPUS", 1))
+
+    with (
+        tempfile.NamedTemporaryFile(dir=scratch_dir, suffix=".dat") as scratch,
+        ProcessPoolExecutor(max_workers=n_workers) as executor,
+    ):
+        year_data = np.memmap(
+            scratch.name, dtype="float32", mode="w+", shape=buffer_shape
+        )
+
+        futures = {
+            each_file: executor.submit(
+                scatter_month,
+                each_file,
+                scratch.name,
+                buffer_shape,
+                year_start,
+                rows,
+                cols,
+            )
+            for each_file in paths
+        }
+
+        # Check that the months cover the whole year
+        covered = np.zeros(len(times), dtype="bool")
+        for each_file, future in futures.items():
+            first, last = future.result()
+            covered[first : last + 1] = True
+            # Progress report
+            print(each_file)
 
-    # Progress report
-    print(each_file)
+        if not covered.all():
+            raise ValueError(f"The WFD files do not cover all of {year}")
 
+        # Write the gridded data out
+        if not out_file.exists():
+            write_grid(year_data, times, out_file)
 
-# Concatenate along time axis
-year_data = xarray.concat(data, dim="time")
+        # Calculate and write the daily means a month at a time
+        if daily and not daily_out_file.exists():
+            n_days = len(times) // STEPS_PER_DAY
+            daily_data = np.empty((n_days, len(latitude), len(longitude)), "float32")
+            for day in range(0, n_days, 31):
+                steps = year_data[day * STEPS_PER_DAY : (day + 31) * STEPS_PER_DAY]
+                daily_data[day : day + 31] = steps.reshape(
+                    (-1, STEPS_PER_DAY) + steps.shape[1:]
+                ).mean(axis=1)
 
-# Make sure the output directory exists
-grid_out_dir = root / "source/WFD/SWDown_gridded"
-grid_out_dir.mkdir(exist_ok=True)
+            write_grid(daily_data, times[::STEPS_PER_DAY], daily_out_file)
 
-# Write the gridded data out
-year_data.to_netcdf(
-    grid_out_dir / f"WFD_SWDOWN_{year}.nc",
-    encoding={"swdown": {"zlib": True, "complevel": 6}},
-)
+        del year_data
@@ -0,0 +1,319 @@
+"""Streaming diagnostics for large gridded arrays.
+
+This module provides the DiagnosticsCollector class, which gathers summary statistics
+for named variables: the counts of finite, NaN and infinite values, the minimum,
+maximum and mean of the finite values and, optionally, a histogram using fixed bins. All
+of the statistics for a variable are calculated in a single pass over the data, working
+through the array in blocks so that only small temporary arrays are needed.
+
+Because the histogram bins are fixed and the mean is stored as a count and a sum, the
+results from different tiles or years can be merged exactly. The collected diagnostics
+are written to and read from JSON files so that model runs can be checked without
+parsing printed summaries.
+
+The module can also be run from the command line to merge a set of JSON diagnostics
+files into a single file:
+
+    python array_diagnostics.py merged.json gpp_1982_diagnostics.json ...
+"""
+
+import argparse
+import json
+import textwrap
+from pathlib import Path
+
+import numpy as np
+
+# The default number of array elements to process at once
+BLOCK_SIZE = 2**22
+
+
+def iter_blocks(data: np.ndarray, block_size: int = BLOCK_SIZE):
+    """Iterate over an array in blocks of leading axis slices.
+
+    The blocks are slices along the leading axes, so no copy of the full array is made,
+    even for arrays created using ``np.broadcast_to``. Each block contains no more than
+    ``block_size`` elements unless a single element along the last axis is larger.
+
+    Args:
+        data: The array to iterate over.
+        block_size: The maximum number of elements in a block.
+    """
+
+    if data.ndim <= 1 or data.size <= block_size:
+        yield data
+        return
+
+    row_size = data.size // data.shape[0]
+    step = block_size // row_size
+
+    if step >= 1:
+        for start in range(0, data.shape[0], step):
+            yield data[start : start + step]
+    else:
+        for row in data:
+            yield from iter_blocks(row, block_size)
+
+
+class VariableSummary:
+    """Mergeable summary statistics for a single variable.
+
+    The histogram bins are ``n_bins`` equal width bins covering the half-open interval
+    ``[lower, upper)``. Finite values outside of this interval are counted as ``below``
+    or ``above`` the histogram.
+
+    Args:
+        bins: An optional tuple of (lower, upper, n_bins) giving the histogram bins.
+    """
+
+    def __init__(self, bins: tuple[float, float, int] | None = None):
+        self.count = 0
+        self.n_nan = 0
+        self.n_inf = 0
+        self.sum = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.bins = None
+        self.histogram = None
+
+        if bins is not None:
+            lower, upper, n_bins = bins
+            if not upper > lower or n_bins < 1:
+                raise ValueError(f"Invalid histogram bins: {bins}")
+            self.bins = (float(lower), float(upper), int(n_bins))
+            # The histogram includes the below and above counts at either end
+            self.histogram = np.zeros(int(n_bins) + 2, dtype=np.int64)
+
+    def update(self, data: np.ndarray, block_size: int = BLOCK_SIZE) -> None:
+        """Add the values in an array to the summary.
+
+        Args:
+            data: An array of values.
+            block_size: The maximum number of elements to process at once.
+        """
+
+        for block in iter_blocks(np.asarray(data), block_size):
+            finite = np.isfinite(block)
+            n_finite = int(np.count_nonzero(finite))
+            n_nan = int(np.count_nonzero(np.isnan(block)))
+
+            self.count += n_finite
+            self.n_nan += n_nan
+            self.n_inf += block.size - n_finite - n_nan
+
+            if n_finite == 0:
+                continue
+
+            values = block[finite]
+            self.sum += float(values.sum(dtype=np.float64))
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+
+            if self.bins is not None:
+                # Find the bin index of each value, clipping values outside the bins to
+                # the below (-1) and above (n_bins) indices, and then count the indices
+                # offset by one to include the below and above counts.
+                lower, upper, n_bins = self.bins
+                index = values - lower
+                index *= n_bins / (upper - lower)
+                np.floor(index, out=index)
+                np.clip(index, -1, n_bins, out=index)
+                self.histogram += np.bincount(
+                    index.astype(np.intp) + 1, minlength=n_bins + 2
+                )
+
+    def merge(self, other: "VariableSummary") -> None:
+        """Merge the statistics from another summary into this summary.
+
+        Args:
+            other: Another summary, which must use the same histogram bins.
+        """
+
+        if self.bins != other.bins:
+            raise ValueError(
+                f"Cannot merge histogram bins {self.bins} and {other.bins}"
+            )
+
+        self.count += other.count
+        self.n_nan += other.n_nan
+        self.n_inf += other.n_inf
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+        if self.histogram is not None:
+            self.histogram += other.histogram
+
+    @property
+    def mean(self) -> float | None:
+        """The mean of the finite values."""
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self) -> dict:
+        """Export the summary as a JSON compatible dictionary."""
+
+        summary = {
+            "count": self.count,
+            "n_nan": self.n_nan,
+            "n_inf": self.n_inf,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "mean": self.mean,
+            "sum": self.sum,
+        }
+
+        if self.bins is not None:
+            lower, upper, n_bins = self.bins
+            summary["histogram"] = {
+                "lower": lower,
+                "upper": upper,
+                "n_bins": n_bins,
+                "below": int(self.histogram[0]),
+                "counts": self.histogram[1:-1].tolist(),
+                "above": int(self.histogram[-1]),
+            }
+
+        return summary
+
+    @classmethod
+    def from_dict(cls, summary: dict) -> "VariableSummary":
+        """Create a summary from a dictionary created by ``to_dict``."""
+
+        hist = summary.get("histogram")
+        bins = None if hist is None else (hist["lower"], hist["upper"], hist["n_bins"])
+
+        instance = cls(bins=bins)
+        instance.count = summary["count"]
+        instance.n_nan = summary["n_nan"]
+        instance.n_inf = summary["n_inf"]
+        instance.sum = summary["sum"]
+
+        if instance.count:
+            instance.min = summary["min"]
+            instance.max = summary["max"]
+
+        if hist is not None:
+            instance.histogram = np.array(
+                [hist["below"], *hist["counts"], hist["above"]], dtype=np.int64
+            )
+
+        return instance
+
+
+class DiagnosticsCollector:
+    """Collect mergeable diagnostics for a set of named variables.
+
+    Histogram bins can be provided for variables by name, as a tuple of (lower, upper,
+    n_bins). Variables without bins only collect the summary statistics.
+
+    Args:
+        bins: A dictionary of histogram bins keyed by variable name.
+        sources: An optional list of labels for the data included in the diagnostics,
+            such as years or tiles, which is combined when collectors are merged.
+    """
+
+    def __init__(
+        self,
+        bins: dict[str, tuple[float, float, int]] | None = None,
+        sources: list[str] | None = None,
+    ):
+        self.bins = bins or {}
+        self.sources = list(sources or [])
+        self.variables: dict[str, VariableSummary] = {}
+
+    def add(self, name: str, data: np.ndarray, block_size: int = BLOCK_SIZE) -> None:
+        """Add the values of an array to the diagnostics for a variable.
+
+        Args:
+            name: The variable name.
+            data: An array of values.
+            block_size: The maximum number of elements to process at once.
+        """
+
+        if name not in self.variables:
+            self.variables[name] = VariableSummary(bins=self.bins.get(name))
+
+        self.variables[name].update(data, block_size=block_size)
+
+    def merge(self, other: "DiagnosticsCollector") -> None:
+        """Merge the diagnostics from another collector into this collector.
+
+        Args:
+            other: Another collector.
+        """
+
+        for name, summary in other.variables.items():
+            if name in self.variables:
+                self.variables[name].merge(summary)
+            else:
+                self.variables[name] = VariableSummary.from_dict(summary.to_dict())
+
+        self.sources.extend(other.sources)
+
+    def to_dict(self) -> dict:
+        """Export the diagnostics as a JSON compatible dictionary."""
+        return {
+            "sources": self.sources,
+            "variables": {
+                name: summary.to_dict() for name, summary in self.variables.items()
+            },
+        }
+
+    def to_json(self, path: Path) -> None:
+        """Write the diagnostics to a JSON file.
+
+        Args:
+            path: The output file path.
+        """
+        with open(path, "w") as outf:
+            json.dump(self.to_dict(), outf, indent=2)
+
+    @classmethod
+    def from_json(cls, path: Path) -> "DiagnosticsCollector":
+        """Load diagnostics from a JSON file created by ``to_json``.
+
+        Args:
+            path: The input file path.
+        """
+
+        with open(path) as inf:
+            contents = json.load(inf)
+
+        instance = cls(sources=contents["sources"])
+        for name, summary in contents["variables"].items():
+            instance.variables[name] = VariableSummary.from_dict(summary)
+            instance.bins[name] = instance.variables[name].bins
+
+        return instance
+
+
+def merge_diagnostics_cli():
+    """Merge diagnostics JSON files.
+
+    This command line tool merges a set of diagnostics files created by the
+    DiagnosticsCollector class - for example from different years or tiles - and writes
+    the combined diagnostics to a new JSON file.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(merge_diagnostics_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument("out_file", type=Path, help="The merged output file")
+    parser.add_argument("in_files", type=Path, nargs="+", help="Files to merge")
+
+    args = parser.parse_args()
+
+    merged = DiagnosticsCollector()
+    for in_file in args.in_files:
+        merged.merge(DiagnosticsCollector.from_json(in_file))
+
+    merged.to_json(args.out_file)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    merge_diagnostics_cli()
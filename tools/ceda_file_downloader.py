@@ -6,7 +6,9 @@ Edited to:
     - Improve docstrings (the original is a reworking of remote_nc_reader.py)
       and not fully redocumented.
     - Make the download path user specifiable not just into the working directory
-    -
+    - Stream downloads to disk in chunks, resuming partial downloads using HTTP Range
+      requests, verifying the size (and optionally a checksum) before renaming the
+      completed file, and reusing a single session and certificate across downloads
 
 ceda_file_downloader.py
 ===================
@@ -40,9 +42,13 @@ $ python simple_file_downloader.py $URL mydownload.nc
 
 # Import standard libraries
 import os
+import re
 import sys
+import time
 import datetime
+import hashlib
 import requests
+import urllib3
 
 # Import third-party libraries
 from cryptography import x509
@@ -60,6 +66,22 @@ CREDENTIALS_FILE_PATH = os.path.join(CERTS_DIR, 'credentials.pem')
 TRUSTROOTS_SERVICE = 'https://slcs.ceda.ac.uk/onlineca/trustroots/'
 CERT_SERVICE = 'https://slcs.ceda.ac.uk/onlineca/certificate/'
 
+# Downloads are streamed to disk in chunks of this many bytes
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Partial downloads are written to the filename with this suffix
+PARTIAL_SUFFIX = '.part'
+
+# The certificate must be valid for at least this many seconds to be reused
+MIN_CERT_LIFETIME = 600
+
+# The delay before the first retry of a failed download (seconds), which doubles for
+# each further retry
+RETRY_DELAY = 5
+
+# The session shared by all downloads, which is created by get_session
+_session = None
+
 
 def cert_is_valid(cert_file, min_lifetime=0):
     """
@@ -128,27 +150,159 @@ def setup_credentials(credentials):
     return True
 
 
-def download(file_url, filename, credentials):
+def get_session(credentials):
+    """
+    Get a requests session that uses the CEDA certificate.
+
+    The credentials are only set up and a new session created if there is no session
+    yet or the certificate is about to expire, so that all downloads in a batch share
+    one session, its connection pool and the certificate. The session asks for the
+    files without any content encoding, so that the raw bytes streamed by
+    stream_download are the bytes of the file.
+
+    :param credentials: A dict holding 'username' and 'password' values to login to CEDA
+    :return: requests.Session
+    """
+    global _session
+
+    if _session is None or not cert_is_valid(CREDENTIALS_FILE_PATH, MIN_CERT_LIFETIME):
+        setup_credentials(credentials)
+        _session = requests.Session()
+        _session.cert = CREDENTIALS_FILE_PATH
+        _session.verify = False
+        _session.headers['Accept-Encoding'] = 'identity'
+
+    return _session
+
+
+def parse_checksum(checksum):
+    """
+    Get a hash object and the expected digest from a checksum string.
+
+    :param checksum: A checksum as 'algorithm:hexdigest', for example 'md5:9e10...'
+    :return: tuple of the hash object and the expected hex digest
+    """
+    algorithm, digest = checksum.split(':', 1)
+    return hashlib.new(algorithm.strip().lower()), digest.strip().lower()
+
+
+def stream_download(session, file_url, filename, checksum=None, timeout=60):
+    """
+    Stream a file to disk, resuming a partial download if one exists.
+
+    The file is written in chunks to filename + PARTIAL_SUFFIX. If that file already
+    exists, an HTTP Range request is used to fetch only the remaining bytes. Once
+    complete, the size is checked against the size reported by the server and the
+    checksum is checked if given, and the file is then renamed to filename.
+
+    :param session: The requests session to use.
+    :param file_url: URL of a CEDA file
+    :param filename: The filename to save the file to
+    :param checksum: An optional checksum as 'algorithm:hexdigest'
+    :param timeout: The connection and read timeout (seconds)
+    :return: The size of the file in bytes.
+    """
+
+    partial = filename + PARTIAL_SUFFIX
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+
+    response = session.get(file_url, headers=headers, stream=True, timeout=timeout)
+
+    with response:
+
+        if response.status_code == 416:
+            # The partial file already holds all of the bytes: bytes */total
+            match = re.match(r'bytes \*/(\d+)',
+                             response.headers.get('Content-Range', ''))
+            total = offset if match is None else int(match.group(1))
+            chunks = []
+        else:
+            response.raise_for_status()
+            # Read the raw bytes, which are the file bytes as the session does not
+            # accept any content encoding
+            chunks = response.raw.stream(CHUNK_SIZE, decode_content=False)
+
+            if response.status_code == 206:
+                # Resuming - get the total size from Content-Range: bytes a-b/total
+                match = re.match(r'bytes (\d+)-\d+/(\d+|\*)',
+                                 response.headers.get('Content-Range', ''))
+                if match is None or int(match.group(1)) != offset:
+                    raise IOError('Unexpected Content-Range for {}'.format(file_url))
+                total = None if match.group(2) == '*' else int(match.group(2))
+            else:
+                # The server sent the whole file, so start again
+                offset = 0
+                length = response.headers.get('Content-Length')
+                total = None if length is None else int(length)
+
+        # Include the bytes already downloaded in the checksum
+        if checksum is not None:
+            file_hash, expected_digest = parse_checksum(checksum)
+            if offset:
+                with open(partial, 'rb') as file_object:
+                    for block in iter(lambda: file_object.read(CHUNK_SIZE), b''):
+                        file_hash.update(block)
+
+        with open(partial, 'ab' if offset else 'wb') as file_object:
+            for chunk in chunks:
+                file_object.write(chunk)
+                if checksum is not None:
+                    file_hash.update(chunk)
+
+    size = os.path.getsize(partial)
+    if total is not None and size != total:
+        # A partial file larger than the file on the server cannot be resumed
+        if size > total:
+            os.remove(partial)
+        raise IOError('Incomplete download of {}: {} of {} bytes'.format(
+            file_url, size, total))
+
+    if checksum is not None and file_hash.hexdigest() != expected_digest:
+        # A corrupt partial file cannot be resumed, so remove it
+        os.remove(partial)
+        raise IOError('Checksum mismatch for {}'.format(file_url))
+
+    os.replace(partial, filename)
+
+    return size
+
+
+def download(file_url, filename, credentials, checksum=None, retries=3):
     """
     Main downloader function.
 
+    The file is streamed to disk, and interrupted downloads are resumed, both when
+    retrying after an error and when the function is called again for the same file.
+    The session and certificate are shared between calls. Each retry waits for
+    RETRY_DELAY seconds, doubling on each further retry.
+
     :param file_url: URL of a CEDA file
     :param filename: The filename to save the file to
     :param credentials: A dict holding 'username' and 'password' values to login to CEDA
+    :param checksum: An optional checksum as 'algorithm:hexdigest'
+    :param retries: The number of times to resume after a failed attempt
     :return: None
     """
-    
-    
+
     try:
-        setup_credentials(credentials)
+        session = get_session(credentials)
     except KeyError:
         print("CEDA_USERNAME and CEDA_PASSWORD environment variables required")
         return
 
-    # Download file to current working directory
-    response = requests.get(file_url, cert=(CREDENTIALS_FILE_PATH), verify=False)
-    with open(filename, 'wb') as file_object:
-        file_object.write(response.content)
+    for attempt in range(retries + 1):
+        try:
+            stream_download(session, file_url, filename, checksum)
+            return
+        except (requests.RequestException, urllib3.exceptions.HTTPError,
+                IOError) as excep:
+            if attempt == retries:
+                raise
+            delay = RETRY_DELAY * 2 ** attempt
+            print('[WARNING] Retrying {} in {} seconds: {}'.format(
+                file_url, delay, excep))
+            time.sleep(delay)
 
 
 if __name__ == '__main__':
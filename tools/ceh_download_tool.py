@@ -1,41 +1,41 @@
 """This tool can be used to recursively download a directory from CEDA.
 
 It uses requests.
+
+In mirror mode, the directory and any subdirectories are synchronised with a local
+copy: files are downloaded in parallel by a bounded pool of threads sharing a single
+pooled session, each file is streamed to disk rather than held in memory, and files
+where the local copy matches the Last-Modified time of the remote file, or matches its
+size and is not older than the remote file, are skipped, so that a mirror can be rerun
+to fetch only new or changed files.
 """
 
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
 from html.parser import HTMLParser
 from pathlib import Path
+from urllib.parse import unquote, urlparse
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 import textwrap
 
+# Files are streamed to disk in chunks of this many bytes
+CHUNK_SIZE = 1024**2
+
+# The connection and read timeout for requests in mirror mode (seconds)
+TIMEOUT = 60
 
-def download_ceh_directory(
-    ceh_path: str,
-    out_dir: Path,
-    user: str,
-    passwd: str,
-    dry_run: bool = False,
-) -> bool:
-    """Download the contents of a remote CEH directory.
+
+def parse_index_links(html: str) -> list[str]:
+    """Get the links to the contents of a directory from a CEH index page.
 
     Args:
-        ceh_path: The directory name within CEDA to be downloaded
-        out_dir: A base path to download into
-        user: A valid CEH user account name
-        passwd: A valid CEH password
-        dry_run: Prints out the expected file downloads and exclusions without
-            downloading.
+        html: The text of the index page.
     """
 
-    # Try and get an authenticated response from the path
-    auth = HTTPBasicAuth(user, passwd)
-    response = requests.get(ceh_path, auth=auth)
-    if not response.ok:
-        print(f"Could not connect to CEH: {str(response.reason)}")
-        return False
-
     # Define a link parser that will populate a list of files. The problem here is that
     # the index page is just a list of links, including links to sort the page and a
     # link back to the parent directory. There's no obvious way to identify files from
@@ -67,7 +67,258 @@ def download_ceh_directory(
                 link_list.pop()
 
     parser = LinkParser()
-    parser.feed(response.text)
+    parser.feed(html)
+
+    return link_list
+
+
+def list_ceh_files(
+    session: requests.Session, ceh_path: str, out_dir: Path
+) -> list[tuple[str, Path]]:
+    """List the files in a remote CEH directory and its subdirectories.
+
+    Links ending in a slash are treated as subdirectories and listed recursively. Links
+    that point outside of the directory are ignored.
+
+    Args:
+        session: The session used to fetch the index pages
+        ceh_path: The URL of the directory, ending in a slash
+        out_dir: The local directory corresponding to the remote directory
+
+    Returns:
+        A list of tuples of the remote URL and local path of each file.
+    """
+
+    response = session.get(ceh_path, timeout=TIMEOUT)
+    response.raise_for_status()
+
+    files = []
+    for link in parse_index_links(response.text):
+
+        # Skip absolute links, queries and links to parent directories
+        if urlparse(link).netloc or link.startswith(("/", "?", "..")):
+            continue
+
+        local = out_dir.joinpath(unquote(link))
+        if link.endswith("/"):
+            files.extend(list_ceh_files(session, ceh_path + link, local))
+        else:
+            files.append((ceh_path + link, local))
+
+    return files
+
+
+def last_modified(headers) -> float | None:
+    """Get the Last-Modified time of a remote file as a timestamp.
+
+    Args:
+        headers: The response headers for the remote file
+
+    Returns:
+        The timestamp, or None if the header is missing or cannot be parsed.
+    """
+
+    modified = headers.get("Last-Modified")
+    if modified is None:
+        return None
+
+    try:
+        return parsedate_to_datetime(modified).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def local_copy_matches(local: Path, headers) -> bool:
+    """Check if a local file matches a remote file.
+
+    The local file matches if its modification time is the Last-Modified time of the
+    remote file, which is set on files downloaded by mirror_file. Otherwise, the local
+    file matches if it has the same size as the remote file and, if the server gives a
+    Last-Modified time, was modified at or after that time. The modification time of
+    such files, for example from a download without --mirror, is then set to the
+    Last-Modified time, so that a remote file that is later reissued with the same
+    size is still downloaded.
+
+    Args:
+        local: The local file
+        headers: The response headers for the remote file
+    """
+
+    if not local.exists():
+        return False
+
+    stat = local.stat()
+    modified = last_modified(headers)
+
+    if modified is not None and modified == stat.st_mtime:
+        return True
+
+    length = headers.get("Content-Length")
+    if length is None or int(length) != stat.st_size:
+        return False
+
+    if modified is not None:
+        if stat.st_mtime < modified:
+            return False
+        os.utime(local, (modified, modified))
+
+    return True
+
+
+def mirror_file(
+    session: requests.Session, url: str, local: Path, dry_run: bool = False
+) -> bool:
+    """Download a remote file unless the local copy matches it.
+
+    The file is streamed to a temporary file, which is renamed once the download is
+    complete, and the modification time is set to the Last-Modified time of the remote
+    file.
+
+    Args:
+        session: The session used to fetch the file
+        url: The URL of the remote file
+        local: The local file
+        dry_run: Check the local copy without downloading the file.
+
+    Returns:
+        True if the file was downloaded, or would be in a dry run, and False if the
+        local copy already matches.
+    """
+
+    response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    response.raise_for_status()
+
+    if local_copy_matches(local, response.headers):
+        return False
+
+    if dry_run:
+        return True
+
+    local.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = local.with_name(local.name + ".tmp")
+
+    try:
+        with session.get(url, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            with open(temp_file, "wb") as outf:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    outf.write(chunk)
+    except BaseException:
+        # Do not leave a partial download behind
+        temp_file.unlink(missing_ok=True)
+        raise
+
+    temp_file.replace(local)
+
+    modified = last_modified(response.headers)
+    if modified is not None:
+        os.utime(local, (modified, modified))
+
+    return True
+
+
+def mirror_ceh_directory(
+    ceh_path: str,
+    out_dir: Path,
+    user: str,
+    passwd: str,
+    workers: int = 4,
+    dry_run: bool = False,
+) -> bool:
+    """Mirror a remote CEH directory and its subdirectories.
+
+    Args:
+        ceh_path: The directory name within CEDA to be downloaded
+        out_dir: A base path to download into
+        user: A valid CEH user account name
+        passwd: A valid CEH password
+        workers: The number of concurrent downloads
+        dry_run: Prints out the expected file downloads without downloading.
+
+    Returns:
+        True if all of the files were mirrored.
+    """
+
+    # Share one session and its connection pool between the download threads
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(user, passwd)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    with session:
+        try:
+            files = list_ceh_files(session, ceh_path, out_dir)
+        except requests.RequestException as excep:
+            print(f"Could not connect to CEH: {excep}")
+            return False
+
+        print(f"Found {len(files)} files")
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(mirror_file, session, url, local, dry_run): url
+                for url, local in files
+            }
+
+            for future in as_completed(futures):
+                try:
+                    downloaded = future.result()
+                except (requests.RequestException, OSError, ValueError) as excep:
+                    print(f"Could not download {futures[future]}: {excep}")
+                    failed += 1
+                    continue
+
+                if downloaded:
+                    print(f"Downloading: {futures[future]}")
+                else:
+                    print(f"Up to date: {futures[future]}")
+
+    return failed == 0
+
+
+def download_ceh_directory(
+    ceh_path: str,
+    out_dir: Path,
+    user: str,
+    passwd: str,
+    dry_run: bool = False,
+    mirror: bool = False,
+    workers: int = 4,
+) -> bool:
+    """Download the contents of a remote CEH directory.
+
+    Args:
+        ceh_path: The directory name within CEDA to be downloaded
+        out_dir: A base path to download into
+        user: A valid CEH user account name
+        passwd: A valid CEH password
+        dry_run: Prints out the expected file downloads and exclusions without
+            downloading.
+        mirror: Mirror the directory and its subdirectories, downloading files in
+            parallel and skipping files that match the local copies.
+        workers: The number of concurrent downloads in mirror mode.
+    """
+
+    if mirror:
+        return mirror_ceh_directory(
+            ceh_path=ceh_path,
+            out_dir=out_dir,
+            user=user,
+            passwd=passwd,
+            workers=workers,
+            dry_run=dry_run,
+        )
+
+    # Try and get an authenticated response from the path
+    auth = HTTPBasicAuth(user, passwd)
+    response = requests.get(ceh_path, auth=auth)
+    if not response.ok:
+        print(f"Could not connect to CEH: {str(response.reason)}")
+        return False
+
+    link_list = parse_index_links(response.text)
 
     # Now download them all
     for file in link_list:
@@ -93,6 +344,10 @@ def download_ceh_directory_cli():
     This command line tool takes the URL of a CEH data archive and downloads the
     contents to a provided output directory. A CEH username and  password are required.
 
+    With --mirror, subdirectories are also downloaded, files are downloaded in parallel
+    and files that match the local copies are skipped, so the command can be rerun to
+    update an existing download.
+
     Example usage:
 
         python ceh_download_tool.py \\
@@ -114,6 +369,17 @@ def download_ceh_directory_cli():
         help="Dry run showing files to be downloaded or excluded.",
         action="store_true",
     )
+    parser.add_argument(
+        "--mirror",
+        help="Mirror the directory and subdirectories, skipping up to date files.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="The number of concurrent downloads in mirror mode.",
+    )
 
     args = parser.parse_args()
 
@@ -125,6 +391,8 @@ def download_ceh_directory_cli():
 
     # Print a short text report
     report_string = f"Downloading: {args.ceh_path}\nDestination: {args.out_dir}\n"
+    if args.mirror:
+        report_string += f"MIRROR: Using {args.workers} concurrent downloads\n"
     if args.dry_run:
         report_string += "DRY RUN: No files downloaded\n"
 
@@ -136,6 +404,8 @@ def download_ceh_directory_cli():
         user=args.user,
         passwd=args.passwd,
         dry_run=args.dry_run,
+        mirror=args.mirror,
+        workers=args.workers,
     )
 
     return not success
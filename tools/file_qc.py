@@ -0,0 +1,347 @@
+"""Parallel, cached quality checks for sets of gridded input files.
+
+This module checks the distribution of values for a variable across a set of NetCDF
+files, typically raw incoming data, and reports for each file the counts of missing and
+infinite values, the minimum, maximum and mean of the finite values and, optionally, a
+histogram with fixed bins.
+
+* Each file is read in slabs along the leading axes and the statistics for all of the
+  slabs are gathered in a single pass using the VariableSummary class from
+  array_diagnostics.py, so memory use does not depend on the file size.
+* The files are checked in parallel across a pool of worker processes.
+* The summaries are mergeable, so the summary across all files is built by merging the
+  file summaries.
+* The summary for each file is stored in a JSON cache along with the size and
+  modification time of the file and the check settings. Rerunning the checks only reads
+  files that are new or have changed since the cache was written.
+
+Values equal to the missing value are counted with NaN values as missing.
+
+The module can be run from the command line:
+
+    python file_qc.py FPAR FPAR_distribution.csv /path/to/FPAR_raw/*.nc \
+        --missing-value -10 --bins -0.2 1.9 21 --cache FPAR_qc_cache.json
+"""
+
+import argparse
+import json
+import os
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+
+from array_diagnostics import BLOCK_SIZE, VariableSummary
+
+
+def iter_slabs(shape: tuple[int, ...], block_size: int = BLOCK_SIZE):
+    """Generate index tuples for slabs of an array along the leading axes.
+
+    Each slab contains no more than ``block_size`` elements unless a single slice along
+    the last axis is larger.
+
+    Args:
+        shape: The array shape.
+        block_size: The maximum number of elements in a slab.
+    """
+
+    if len(shape) <= 1 or int(np.prod(shape)) <= block_size:
+        yield ()
+        return
+
+    row_size = int(np.prod(shape[1:]))
+    step = block_size // row_size
+
+    if step >= 1:
+        for start in range(0, shape[0], step):
+            yield (slice(start, start + step),)
+    else:
+        for idx in range(shape[0]):
+            for sub_slab in iter_slabs(shape[1:], block_size):
+                yield (idx, *sub_slab)
+
+
+def summarise_file(
+    path: Path,
+    variable: str,
+    missing_value: float | None = None,
+    bins: tuple[float, float, int] | None = None,
+    block_size: int = BLOCK_SIZE,
+) -> dict:
+    """Summarise the values of a variable in a NetCDF file.
+
+    Args:
+        path: The NetCDF file.
+        variable: The variable to summarise.
+        missing_value: An optional value to treat as missing.
+        bins: Optional histogram bins as (lower, upper, n_bins).
+        block_size: The maximum number of elements to read at once.
+
+    Returns:
+        The summary as a dictionary, as produced by ``VariableSummary.to_dict``, or a
+        dictionary with an ``error`` entry if the file could not be read.
+    """
+
+    summary = VariableSummary(bins=bins)
+
+    try:
+        with netCDF4.Dataset(path) as ds:
+            data_var = ds[variable]
+
+            for slab_index in iter_slabs(data_var.shape, block_size):
+                slab = np.ma.filled(
+                    data_var[slab_index].astype("float64"), np.nan
+                ).reshape(-1)
+                if missing_value is not None:
+                    slab[slab == missing_value] = np.nan
+                summary.update(slab, block_size=block_size)
+
+    except (OSError, RuntimeError, ValueError, IndexError) as excep:
+        return {"error": str(excep).replace("\n", " ")}
+
+    return summary.to_dict()
+
+
+class FileQCCache:
+    """A JSON cache of file summaries keyed by file path.
+
+    Each entry records the file size and modification time and the settings used to
+    create the summary, and an entry is only used if all of these match.
+
+    Args:
+        path: The path of the JSON cache file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.entries: dict[str, dict] = {}
+
+        if self.path.exists():
+            with open(self.path) as inf:
+                self.entries = json.load(inf)
+
+    @staticmethod
+    def _file_key(path: Path, settings: dict) -> dict:
+        """Get the size, modification time and settings used to validate an entry."""
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "settings": settings}
+
+    def get(self, path: Path, settings: dict) -> dict | None:
+        """Get the cached summary for a file, if it is still valid.
+
+        Args:
+            path: The file path.
+            settings: The settings used to create the summary.
+        """
+
+        entry = self.entries.get(str(path))
+        if entry is None or entry["key"] != self._file_key(path, settings):
+            return None
+
+        return entry["summary"]
+
+    def set(self, path: Path, settings: dict, summary: dict) -> None:
+        """Store the summary for a file.
+
+        Args:
+            path: The file path.
+            settings: The settings used to create the summary.
+            summary: The file summary.
+        """
+        self.entries[str(path)] = {
+            "key": self._file_key(path, settings),
+            "summary": summary,
+        }
+
+    def save(self) -> None:
+        """Write the cache to a temporary file and rename it to the cache path."""
+
+        temp_file = self.path.with_suffix(".tmp")
+        with open(temp_file, "w") as outf:
+            json.dump(self.entries, outf)
+        temp_file.replace(self.path)
+
+
+def check_files(
+    files: list[Path],
+    variable: str,
+    missing_value: float | None = None,
+    bins: tuple[float, float, int] | None = None,
+    cache_path: Path | None = None,
+    workers: int = 1,
+) -> dict[Path, dict]:
+    """Summarise the values of a variable across a set of files.
+
+    Files without a valid cached summary are summarised in parallel and the cache is
+    updated with the new summaries.
+
+    Args:
+        files: The NetCDF files to check.
+        variable: The variable to summarise.
+        missing_value: An optional value to treat as missing.
+        bins: Optional histogram bins as (lower, upper, n_bins).
+        cache_path: An optional path to a JSON cache of file summaries.
+        workers: The number of worker processes.
+
+    Returns:
+        A dictionary of the summary for each file.
+    """
+
+    # JSON compatible settings used to validate cached summaries
+    settings = {
+        "variable": variable,
+        "missing_value": missing_value,
+        "bins": None if bins is None else list(bins),
+    }
+
+    cache = None if cache_path is None else FileQCCache(cache_path)
+    summaries = {}
+
+    if cache is not None:
+        for each_file in files:
+            summary = cache.get(each_file, settings)
+            if summary is not None:
+                summaries[each_file] = summary
+
+    to_check = [f for f in files if f not in summaries]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            each_file: executor.submit(
+                summarise_file, each_file, variable, missing_value, bins
+            )
+            for each_file in to_check
+        }
+
+        for each_file, future in futures.items():
+            summaries[each_file] = future.result()
+            # Only cache successful summaries so that failed files are retried
+            if cache is not None and "error" not in summaries[each_file]:
+                cache.set(each_file, settings, summaries[each_file])
+
+    if cache is not None and to_check:
+        cache.save()
+
+    return {each_file: summaries[each_file] for each_file in files}
+
+
+def merge_summaries(summaries: dict[Path, dict]) -> VariableSummary | None:
+    """Merge the file summaries from ``check_files`` into a single summary.
+
+    Files that could not be read are skipped.
+
+    Args:
+        summaries: A dictionary of file summaries.
+    """
+
+    merged = None
+    for summary in summaries.values():
+        if "error" in summary:
+            continue
+        if merged is None:
+            merged = VariableSummary.from_dict(summary)
+        else:
+            merged.merge(VariableSummary.from_dict(summary))
+
+    return merged
+
+
+def write_csv(summaries: dict[Path, dict], path: Path) -> None:
+    """Write file summaries to a CSV file.
+
+    Each row gives the file name, the counts of missing and infinite values, the
+    minimum, maximum and mean and any histogram counts, including the counts below and
+    above the histogram bins. A final row gives the merged summary for all files and
+    files that could not be read are reported with the error message.
+
+    Args:
+        summaries: A dictionary of file summaries.
+        path: The output path.
+    """
+
+    def row(label, summary):
+        values = [label, summary["n_nan"], summary["n_inf"]]
+        values += [summary["min"], summary["max"], summary["mean"]]
+        if "histogram" in summary:
+            hist = summary["histogram"]
+            values += [hist["below"], *hist["counts"], hist["above"]]
+        return ",".join("NA" if val is None else str(val) for val in values)
+
+    merged = merge_summaries(summaries)
+
+    with open(path, "w") as outf:
+        header = "file,N_na,N_inf,min,max,mean"
+        if merged is not None and merged.bins is not None:
+            lower, upper, n_bins = merged.bins
+            edges = np.linspace(lower, upper, n_bins + 1)[:-1]
+            header += f",lo,{','.join(f'{x:0.2f}' for x in edges)},hi"
+        outf.write(header + "\n")
+
+        for each_file, summary in summaries.items():
+            if "error" in summary:
+                outf.write(f"{each_file} # {summary['error']}\n")
+            else:
+                outf.write(row(each_file, summary) + "\n")
+
+        if merged is not None:
+            outf.write(row("all_files", merged.to_dict()) + "\n")
+
+
+def file_qc_cli():
+    """Check the distribution of values for a variable across NetCDF files.
+
+    Each file is summarised in a single streaming pass, in parallel across worker
+    processes, and the results are written to a CSV file with one row per file and a
+    final row for all files. With a cache file, only new or changed files are read.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(file_qc_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument("variable", help="The variable to check")
+    parser.add_argument("out_file", type=Path, help="The output CSV file")
+    parser.add_argument("files", type=Path, nargs="+", help="The files to check")
+    parser.add_argument(
+        "--missing-value", type=float, help="A value to treat as missing"
+    )
+    parser.add_argument(
+        "--bins",
+        type=float,
+        nargs=3,
+        metavar=("LOWER", "UPPER", "N_BINS"),
+        help="Histogram bins",
+    )
+    parser.add_argument("--cache", type=Path, help="A JSON cache of file summaries")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("NCPUS", 1)),
+        help="The number of worker processes (default: NCPUS or 1)",
+    )
+
+    args = parser.parse_args()
+
+    bins = None
+    if args.bins is not None:
+        bins = (args.bins[0], args.bins[1], int(args.bins[2]))
+
+    summaries = check_files(
+        sorted(args.files),
+        args.variable,
+        missing_value=args.missing_value,
+        bins=bins,
+        cache_path=args.cache,
+        workers=args.workers,
+    )
+    write_csv(summaries, args.out_file)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    file_qc_cli()
@@ -0,0 +1,647 @@
+"""Storage of gridded land data as gathered land cells.
+
+Many of our gridded products only have data over land, so storing the full latitude and
+longitude grid wastes space on ocean cells that are always missing and every read has to
+decompress them. This module supports a gathered storage format that only stores the
+land cells, using the CF conventions for compression by gathering:
+
+* Data variables use a ``landpoint`` dimension in place of the latitude and longitude
+  dimensions, for example ``Tair(time, landpoint)``.
+* The ``landpoint`` coordinate variable gives the position of each land cell in the
+  flattened (lat, lon) grid, as ``row * n_lon + col``, and has the attribute
+  ``compress = "lat lon"`` naming the grid dimensions.
+* The full latitude and longitude axes are stored as the usual coordinate variables.
+
+Files in this format can be unpacked automatically by CF aware tools such as cf-python
+and are still simple NetCDF files for xarray and netCDF4. This module provides:
+
+* The GatherIndex class, which holds the grid axes and the land cell positions and
+  gathers gridded arrays onto the land cells and unpacks land cell arrays to full grids
+  with single vectorized indexing operations.
+* The ``gather_dataset`` function to convert a gridded Dataset to the gathered format
+  and the ``unpack_dataarray`` and ``iter_unpacked`` functions to unpack gathered data,
+  either all at once or lazily in chunks along the time dimension.
+* Readers that unpack a gathered variable to the full grid (``read_unpacked``), or that
+  read only the land cells within a bounding box (``read_bbox``) or nearest to a set of
+  sites (``read_sites``) without unpacking.
+
+The module can also be run from the command line to convert files between the gridded
+and gathered formats:
+
+    python gathered_grids.py gather gridded.nc gathered.nc --variables Tair Qair
+    python gathered_grids.py unpack gathered.nc gridded.nc
+"""
+
+import argparse
+import textwrap
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+import xarray
+
+from point_extractor import SiteGridIndex
+
+GATHER_DIM = "landpoint"
+"""The name of the gathered land cell dimension."""
+
+
+class GatherIndex:
+    """The positions of the land cells on a latitude and longitude grid.
+
+    Args:
+        lat: The latitude axis of the grid.
+        lon: The longitude axis of the grid.
+        flat_index: The position of each land cell in the flattened grid.
+        lat_name: The name of the latitude dimension.
+        lon_name: The name of the longitude dimension.
+    """
+
+    def __init__(
+        self,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        flat_index: np.ndarray,
+        lat_name: str = "lat",
+        lon_name: str = "lon",
+    ):
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.lat_name = lat_name
+        self.lon_name = lon_name
+        self.flat_index = np.asarray(flat_index, dtype="int64")
+
+        n_grid = self.lat.size * self.lon.size
+        if np.any((self.flat_index < 0) | (self.flat_index >= n_grid)):
+            raise ValueError("Land cell positions outside of the grid")
+
+        self.rows, self.cols = np.divmod(self.flat_index, self.lon.size)
+        self._sorter = np.argsort(self.flat_index, kind="stable")
+
+    @classmethod
+    def from_mask(
+        cls,
+        mask: np.ndarray,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        lat_name: str = "lat",
+        lon_name: str = "lon",
+    ) -> "GatherIndex":
+        """Create an index from a boolean (lat, lon) land mask.
+
+        The land cells are ordered by row and then by column.
+
+        Args:
+            mask: The land mask.
+            lat: The latitude axis of the grid.
+            lon: The longitude axis of the grid.
+            lat_name: The name of the latitude dimension.
+            lon_name: The name of the longitude dimension.
+        """
+
+        mask = np.asarray(mask, dtype="bool")
+        if mask.shape != (len(lat), len(lon)):
+            raise ValueError("Land mask shape does not match the grid axes")
+
+        return cls(lat, lon, np.flatnonzero(mask), lat_name, lon_name)
+
+    @classmethod
+    def from_indices(
+        cls,
+        lat: np.ndarray,
+        lon: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        lat_name: str = "lat",
+        lon_name: str = "lon",
+    ) -> "GatherIndex":
+        """Create an index from the grid row and column of each land cell.
+
+        Args:
+            lat: The latitude axis of the grid.
+            lon: The longitude axis of the grid.
+            rows: The grid row of each land cell.
+            cols: The grid column of each land cell.
+            lat_name: The name of the latitude dimension.
+            lon_name: The name of the longitude dimension.
+        """
+
+        flat_index = np.asarray(rows, dtype="int64") * len(lon) + np.asarray(cols)
+
+        return cls(lat, lon, flat_index, lat_name, lon_name)
+
+    @classmethod
+    def from_file(cls, path: Path) -> "GatherIndex":
+        """Load the index from a file in the gathered format.
+
+        Args:
+            path: The gathered NetCDF file.
+        """
+
+        with netCDF4.Dataset(path) as ds:
+            landpoint = ds[GATHER_DIM]
+            lat_name, lon_name = landpoint.compress.split()
+
+            return cls(
+                ds[lat_name][:].filled(np.nan),
+                ds[lon_name][:].filled(np.nan),
+                landpoint[:].filled(-1),
+                lat_name,
+                lon_name,
+            )
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """The shape of the full grid."""
+        return (self.lat.size, self.lon.size)
+
+    @property
+    def n_cells(self) -> int:
+        """The number of land cells."""
+        return self.flat_index.size
+
+    def gather(self, data: np.ndarray) -> np.ndarray:
+        """Gather the land cells from gridded data.
+
+        Args:
+            data: An array with the grid as the last two dimensions.
+
+        Returns:
+            An array with the land cells as the last dimension.
+        """
+        return np.asarray(data)[..., self.rows, self.cols]
+
+    def unpack(
+        self,
+        data: np.ndarray,
+        fill_value: float = np.nan,
+        out: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Unpack land cell data to the full grid.
+
+        Args:
+            data: An array with the land cells as the last dimension.
+            fill_value: The value used for cells that are not land cells, which must be
+                representable in the output dtype. The default NaN fill can only be
+                used with floating point data, so integer data needs an explicit fill.
+            out: An optional preallocated output array, which must have the shape of
+                the data with the last dimension replaced by the grid.
+
+        Returns:
+            An array with the grid as the last two dimensions.
+
+        Raises:
+            ValueError: If the output shape does not match or the fill value cannot be
+                represented in the output dtype.
+        """
+
+        data = np.asarray(data)
+        shape = data.shape[:-1] + self.shape
+
+        # Check the fill value survives the cast to the output dtype, which would
+        # otherwise silently turn NaN into an arbitrary integer
+        dtype = data.dtype if out is None else out.dtype
+        fill = np.array(fill_value)
+        with np.errstate(invalid="ignore", over="ignore"):
+            cast_fill = fill.astype(dtype)
+        if not (cast_fill == fill or (np.isnan(fill) and np.isnan(cast_fill))):
+            raise ValueError(f"Fill value {fill_value} cannot be stored as {dtype}")
+
+        if out is None:
+            out = np.full(shape, fill_value, dtype=data.dtype)
+        elif out.shape != shape:
+            raise ValueError(f"Output shape {out.shape} does not match {shape}")
+        else:
+            out.fill(fill_value)
+
+        out[..., self.rows, self.cols] = data
+
+        return out
+
+    def find_cells(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Find the land cells at grid positions.
+
+        Args:
+            rows: The grid rows.
+            cols: The grid columns.
+
+        Returns:
+            The index of the land cell at each position or -1 if the position is not a
+            land cell.
+        """
+
+        flat = np.asarray(rows, dtype="int64") * self.lon.size + np.asarray(cols)
+        if not self.n_cells:
+            return np.full(flat.shape, -1)
+
+        pos = np.searchsorted(self.flat_index, flat, sorter=self._sorter)
+        cells = self._sorter[np.clip(pos, 0, self.n_cells - 1)]
+
+        return np.where(self.flat_index[cells] == flat, cells, -1)
+
+    def bbox_cells(
+        self, lat_min: float, lat_max: float, lon_min: float, lon_max: float
+    ) -> np.ndarray:
+        """Find the land cells with centres within a bounding box.
+
+        Args:
+            lat_min: The southern edge of the box.
+            lat_max: The northern edge of the box.
+            lon_min: The western edge of the box.
+            lon_max: The eastern edge of the box.
+
+        Returns:
+            The land cell indices, in storage order.
+        """
+
+        cell_lat = self.lat[self.rows]
+        cell_lon = self.lon[self.cols]
+
+        return np.flatnonzero(
+            (cell_lat >= lat_min)
+            & (cell_lat <= lat_max)
+            & (cell_lon >= lon_min)
+            & (cell_lon <= lon_max)
+        )
+
+    def coords(self) -> dict:
+        """Get the coordinates used to store the index in the gathered format."""
+
+        landpoint = xarray.DataArray(
+            self.flat_index.astype("int32"),
+            dims=GATHER_DIM,
+            attrs={"compress": f"{self.lat_name} {self.lon_name}"},
+        )
+
+        return {
+            self.lat_name: (self.lat_name, self.lat),
+            self.lon_name: (self.lon_name, self.lon),
+            GATHER_DIM: landpoint,
+        }
+
+    def cell_coords(self, cells: np.ndarray | None = None) -> dict:
+        """Get the latitude and longitude of land cells as coordinates.
+
+        Args:
+            cells: The land cell indices, defaulting to all cells.
+        """
+
+        cells = slice(None) if cells is None else cells
+
+        return {
+            f"cell_{self.lat_name}": (GATHER_DIM, self.lat[self.rows[cells]]),
+            f"cell_{self.lon_name}": (GATHER_DIM, self.lon[self.cols[cells]]),
+        }
+
+
+def landmask_from_data(
+    path: Path,
+    variables: list[str],
+    lat_name: str = "lat",
+    lon_name: str = "lon",
+    block_steps: int = 24,
+) -> np.ndarray:
+    """Find the grid cells with any data in a gridded NetCDF file.
+
+    The variables are read in blocks along the leading time dimension, so the whole
+    file is never loaded.
+
+    Args:
+        path: The gridded NetCDF file.
+        variables: The variables with dimensions (..., lat, lon) to check.
+        lat_name: The name of the latitude dimension.
+        lon_name: The name of the longitude dimension.
+        block_steps: The number of steps along the leading dimension read at once.
+
+    Returns:
+        A boolean (lat, lon) array that is true for cells with data.
+    """
+
+    with netCDF4.Dataset(path) as ds:
+        shape = (ds.dimensions[lat_name].size, ds.dimensions[lon_name].size)
+        mask = np.zeros(shape, dtype="bool")
+
+        for var in variables:
+            data_var = ds[var]
+            if data_var.dimensions[-2:] != (lat_name, lon_name):
+                raise ValueError(f"{var} does not have trailing {lat_name}, {lon_name}")
+
+            # Read the variable in blocks of grids along the leading dimension
+            n_steps = data_var.shape[0] if data_var.ndim > 2 else 1
+            for start in range(0, n_steps, block_steps):
+                if data_var.ndim > 2:
+                    block = data_var[start : start + block_steps]
+                else:
+                    block = data_var[:]
+                block = np.ma.filled(block.astype("float64"), np.nan)
+                block = block.reshape((-1,) + mask.shape)
+                mask |= np.isfinite(block).any(axis=0)
+
+    return mask
+
+
+def gather_dataset(
+    ds: xarray.Dataset,
+    index: GatherIndex,
+    variables: list[str] | None = None,
+) -> xarray.Dataset:
+    """Convert a gridded Dataset to the gathered format.
+
+    Variables with the latitude and longitude dimensions are gathered onto the land
+    cells, which loads each variable in turn. Other variables and the dataset attributes
+    are kept.
+
+    Args:
+        ds: The gridded Dataset.
+        index: The land cell index.
+        variables: The variables to include, defaulting to all data variables.
+    """
+
+    grid_dims = (index.lat_name, index.lon_name)
+    variables = list(ds.data_vars) if variables is None else variables
+
+    data_vars = {}
+    for var in variables:
+        data = ds[var]
+        if not set(grid_dims).issubset(data.dims):
+            data_vars[var] = data
+            continue
+
+        other_dims = [dim for dim in data.dims if dim not in grid_dims]
+        data = data.transpose(*other_dims, *grid_dims)
+        data_vars[var] = xarray.Variable(
+            (*other_dims, GATHER_DIM), index.gather(data.values), data.attrs
+        )
+
+    coords = {name: crd for name, crd in ds.coords.items() if name not in grid_dims}
+    coords.update(index.coords())
+
+    return xarray.Dataset(data_vars, coords=coords, attrs=ds.attrs)
+
+
+def unpack_dataarray(
+    data: xarray.DataArray,
+    index: GatherIndex,
+    fill_value: float = np.nan,
+    cell_dim: str = GATHER_DIM,
+) -> xarray.DataArray:
+    """Unpack a gathered DataArray to the full grid.
+
+    Args:
+        data: The gathered DataArray, with a land cell dimension covering all of the
+            land cells in the index.
+        index: The land cell index.
+        fill_value: The value used for cells that are not land cells.
+        cell_dim: The name of the land cell dimension.
+    """
+
+    other_dims = [dim for dim in data.dims if dim != cell_dim]
+    data = data.transpose(*other_dims, cell_dim)
+
+    return xarray.DataArray(
+        index.unpack(data.values, fill_value=fill_value),
+        dims=(*other_dims, index.lat_name, index.lon_name),
+        coords={
+            **{dim: data[dim] for dim in other_dims if dim in data.coords},
+            index.lat_name: index.lat,
+            index.lon_name: index.lon,
+        },
+        attrs=data.attrs,
+        name=data.name,
+    )
+
+
+def iter_unpacked(
+    data: xarray.DataArray,
+    index: GatherIndex,
+    chunk_size: int,
+    dim: str = "time",
+    fill_value: float = np.nan,
+    cell_dim: str = GATHER_DIM,
+):
+    """Unpack a gathered DataArray to the full grid in chunks along a dimension.
+
+    Only one chunk of the gathered data is loaded and unpacked at a time, so a long or
+    partial time series can be unpacked without allocating the full grid for the whole
+    series. Each chunk is unpacked with a single indexed assignment.
+
+    Args:
+        data: The gathered DataArray, which can be lazily loaded from a file.
+        index: The land cell index.
+        chunk_size: The number of steps along the dimension in each chunk.
+        dim: The dimension to iterate over.
+        fill_value: The value used for cells that are not land cells.
+        cell_dim: The name of the land cell dimension.
+
+    Yields:
+        The unpacked DataArray for each chunk.
+    """
+
+    for start in range(0, data.sizes[dim], chunk_size):
+        chunk = data.isel({dim: slice(start, start + chunk_size)})
+        yield unpack_dataarray(chunk, index, fill_value=fill_value, cell_dim=cell_dim)
+
+
+def read_unpacked(
+    path: Path, variable: str, index: GatherIndex | None = None, **isel
+) -> xarray.DataArray:
+    """Read a gathered variable and unpack it to the full grid.
+
+    Args:
+        path: The gathered NetCDF file.
+        variable: The variable to read.
+        index: The land cell index, which is loaded from the file if not provided.
+        isel: Optional selections along the other dimensions, such as ``time``.
+    """
+
+    index = GatherIndex.from_file(path) if index is None else index
+
+    with xarray.open_dataset(path) as ds:
+        data = ds[variable].isel(**isel).load()
+
+    return unpack_dataarray(data, index)
+
+
+def read_cells(path: Path, variable: str, cells: np.ndarray) -> xarray.DataArray:
+    """Read selected land cells from a gathered variable.
+
+    The file is only read over the range of land cells that are requested.
+
+    Args:
+        path: The gathered NetCDF file.
+        variable: The variable to read.
+        cells: The land cell indices.
+    """
+
+    cells = np.asarray(cells, dtype="int64")
+
+    with xarray.open_dataset(path) as ds:
+        if not cells.size:
+            return ds[variable].isel({GATHER_DIM: cells}).load()
+
+        start, stop = cells.min(), cells.max() + 1
+        data = ds[variable].isel({GATHER_DIM: slice(start, stop)}).load()
+
+    return data.isel({GATHER_DIM: cells - start})
+
+
+def read_bbox(
+    path: Path,
+    variable: str,
+    lat_min: float,
+    lat_max: float,
+    lon_min: float,
+    lon_max: float,
+    index: GatherIndex | None = None,
+) -> xarray.DataArray:
+    """Read the land cells within a bounding box from a gathered variable.
+
+    The land cells are not unpacked: the returned data uses the ``landpoint`` dimension,
+    with the cell latitudes and longitudes as coordinates.
+
+    Args:
+        path: The gathered NetCDF file.
+        variable: The variable to read.
+        lat_min: The southern edge of the box.
+        lat_max: The northern edge of the box.
+        lon_min: The western edge of the box.
+        lon_max: The eastern edge of the box.
+        index: The land cell index, which is loaded from the file if not provided.
+    """
+
+    index = GatherIndex.from_file(path) if index is None else index
+    cells = index.bbox_cells(lat_min, lat_max, lon_min, lon_max)
+
+    return read_cells(path, variable, cells).assign_coords(index.cell_coords(cells))
+
+
+def read_sites(
+    path: Path,
+    variable: str,
+    site_ids,
+    site_lat,
+    site_lon,
+    index: GatherIndex | None = None,
+) -> xarray.DataArray:
+    """Read the nearest grid cells to a set of sites from a gathered variable.
+
+    Sites are matched to the nearest grid cell and sites where that cell is not a land
+    cell are filled with missing values.
+
+    Args:
+        path: The gathered NetCDF file.
+        variable: The variable to read.
+        site_ids: Identifiers for the sites.
+        site_lat: The site latitudes.
+        site_lon: The site longitudes.
+        index: The land cell index, which is loaded from the file if not provided.
+
+    Returns:
+        A DataArray with a ``site_id`` dimension in place of the land cells.
+    """
+
+    index = GatherIndex.from_file(path) if index is None else index
+    sites = SiteGridIndex(site_ids, site_lat, site_lon, index.lat, index.lon)
+    site_cells = index.find_cells(sites.rows, sites.cols)
+
+    # Read each unique land cell once and map back onto the sites
+    cells, site_map = np.unique(site_cells[site_cells >= 0], return_inverse=True)
+    data = read_cells(path, variable, cells)
+
+    other_dims = [dim for dim in data.dims if dim != GATHER_DIM]
+    data = data.transpose(*other_dims, GATHER_DIM)
+    values = np.full(data.shape[:-1] + (len(site_cells),), np.nan)
+    values[..., site_cells >= 0] = data.values[..., site_map.reshape(-1)]
+
+    return xarray.DataArray(
+        values,
+        dims=(*other_dims, "site_id"),
+        coords={
+            **{dim: data[dim] for dim in other_dims if dim in data.coords},
+            "site_id": sites.site_ids,
+            "lat": ("site_id", sites.site_lat),
+            "lon": ("site_id", sites.site_lon),
+        },
+        attrs=data.attrs,
+        name=variable,
+    )
+
+
+def gathered_grids_cli():
+    """Convert NetCDF files between gridded and gathered land cell formats.
+
+    The gather command stores the land cells from a gridded file, where the land cells
+    are the cells with data at any time in any of the gathered variables. The unpack
+    command restores a gathered file to the full grid.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(gathered_grids_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    gather_parser = subparsers.add_parser("gather", help="Gather land cells")
+    gather_parser.add_argument("in_file", type=Path, help="The gridded file")
+    gather_parser.add_argument("out_file", type=Path, help="The gathered file")
+    gather_parser.add_argument(
+        "--variables", nargs="+", required=True, help="The variables to gather"
+    )
+    gather_parser.add_argument("--lat-name", default="lat", help="The latitude name")
+    gather_parser.add_argument("--lon-name", default="lon", help="The longitude name")
+    gather_parser.add_argument(
+        "--complevel", type=int, default=4, help="The zlib compression level"
+    )
+
+    unpack_parser = subparsers.add_parser("unpack", help="Unpack to the full grid")
+    unpack_parser.add_argument("in_file", type=Path, help="The gathered file")
+    unpack_parser.add_argument("out_file", type=Path, help="The gridded file")
+    unpack_parser.add_argument(
+        "--complevel", type=int, default=4, help="The zlib compression level"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "gather":
+        mask = landmask_from_data(
+            args.in_file, args.variables, args.lat_name, args.lon_name
+        )
+
+        with xarray.open_dataset(args.in_file) as ds:
+            index = GatherIndex.from_mask(
+                mask,
+                ds[args.lat_name].values,
+                ds[args.lon_name].values,
+                args.lat_name,
+                args.lon_name,
+            )
+            out_ds = gather_dataset(ds, index, args.variables)
+            encoding = {
+                var: {"zlib": True, "complevel": args.complevel, "shuffle": True}
+                for var in args.variables
+            }
+            out_ds.to_netcdf(args.out_file, encoding=encoding)
+
+        print(f"Gathered {index.n_cells} of {mask.size} cells")
+
+    else:
+        index = GatherIndex.from_file(args.in_file)
+
+        with xarray.open_dataset(args.in_file) as ds:
+            variables = [var for var in ds.data_vars if GATHER_DIM in ds[var].dims]
+            out_ds = xarray.Dataset(
+                {var: unpack_dataarray(ds[var].load(), index) for var in variables},
+                attrs=ds.attrs,
+            )
+            encoding = {
+                var: {"zlib": True, "complevel": args.complevel, "shuffle": True}
+                for var in variables
+            }
+            out_ds.to_netcdf(args.out_file, encoding=encoding)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    gathered_grids_cli()
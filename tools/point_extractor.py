@@ -0,0 +1,573 @@
+"""Point extraction of site time series from gridded NetCDF files.
+
+Selecting a few sites from a large set of gridded files using
+``xarray.open_mfdataset(...).sel(method="nearest")`` builds a very large dask graph and
+reads far more data than is needed. This module provides a lighter approach:
+
+* The SiteGridIndex class resolves a set of sites to the (row, col) indices of the
+  nearest grid cells once, using the latitude and longitude axes of the grid.
+* The read_file_cells function then reads only the time series for those cells from a
+  file, using direct hyperslab reads through the netCDF4 package. Cells are grouped by
+  the storage chunk containing them, so each chunk is read once for all of the cells.
+* The extract_site_series function runs read_file_cells across a set of files using a
+  pool of worker processes to extract the full time series for the sites.
+* The extract_monthly_means function does the same but reduces each file to monthly
+  sums and counts as it is read, so that only the monthly means for the sites are ever
+  held in memory.
+
+Both extraction functions can use a SiteCache from the site_cache module, so that only
+cells that have not been extracted before are read from the files.
+
+A process pool is used rather than threads because the netCDF-C library is not
+thread-safe: each worker process opens its own files.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+from pathlib import Path
+from typing import Callable
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray
+
+from site_cache import SiteCache
+
+
+def nearest_index(axis: np.ndarray, values: np.ndarray, periodic: bool = False):
+    """Find the index of the nearest value on a coordinate axis.
+
+    Args:
+        axis: The coordinate axis values.
+        values: The values to locate on the axis.
+        periodic: Treat the axis as periodic over 360°, for longitude axes.
+    """
+
+    difference = axis[None, :] - np.asarray(values, dtype="float64")[:, None]
+
+    if periodic:
+        difference = (difference + 180) % 360 - 180
+
+    return np.abs(difference).argmin(axis=1)
+
+
+class SiteGridIndex:
+    """The grid cell indices for a set of sites.
+
+    The sites are resolved to the nearest (row, col) cell on the grid defined by the
+    latitude and longitude axes. Sites falling in the same cell share a single cell, so
+    the unique cells can be read once and mapped back onto the sites.
+
+    Args:
+        site_ids: Identifiers for the sites.
+        site_lat: The site latitudes.
+        site_lon: The site longitudes.
+        grid_lat: The latitude axis of the grid.
+        grid_lon: The longitude axis of the grid.
+    """
+
+    def __init__(self, site_ids, site_lat, site_lon, grid_lat, grid_lon):
+        self.site_ids = np.asarray(site_ids)
+        self.site_lat = np.asarray(site_lat, dtype="float64")
+        self.site_lon = np.asarray(site_lon, dtype="float64")
+
+        self.rows = nearest_index(np.asarray(grid_lat), self.site_lat)
+        self.cols = nearest_index(np.asarray(grid_lon), self.site_lon, periodic=True)
+
+        # Unique cells and the mapping from sites onto those cells
+        cells, self.site_cell = np.unique(
+            np.stack([self.rows, self.cols], axis=1), axis=0, return_inverse=True
+        )
+        self.site_cell = self.site_cell.reshape(-1)
+        self.cell_rows = cells[:, 0]
+        self.cell_cols = cells[:, 1]
+
+    @classmethod
+    def from_file(
+        cls,
+        path: Path,
+        site_ids,
+        site_lat,
+        site_lon,
+        lat_name: str = "lat",
+        lon_name: str = "lon",
+    ) -> "SiteGridIndex":
+        """Create a site index using the grid axes from a NetCDF file.
+
+        Args:
+            path: A NetCDF file on the required grid.
+            site_ids: Identifiers for the sites.
+            site_lat: The site latitudes.
+            site_lon: The site longitudes.
+            lat_name: The name of the latitude axis variable.
+            lon_name: The name of the longitude axis variable.
+        """
+
+        with netCDF4.Dataset(path) as ds:
+            grid_lat = ds[lat_name][:].filled(np.nan)
+            grid_lon = ds[lon_name][:].filled(np.nan)
+
+        return cls(site_ids, site_lat, site_lon, grid_lat, grid_lon)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Export the site locations and grid cell indices as a data frame."""
+        return pd.DataFrame(
+            {
+                "site_id": self.site_ids,
+                "lat": self.site_lat,
+                "lon": self.site_lon,
+                "row": self.rows,
+                "col": self.cols,
+            }
+        )
+
+    def to_sites(self, cell_data: np.ndarray) -> np.ndarray:
+        """Map data for the unique cells back onto the sites.
+
+        Args:
+            cell_data: An array with the unique cells on the last axis.
+        """
+        return cell_data[..., self.site_cell]
+
+
+def _chunk_groups(data_var: netCDF4.Variable, rows: np.ndarray, cols: np.ndarray):
+    """Group cells by the storage chunk of a variable that contains them.
+
+    Cells in contiguous variables are not grouped, so each cell forms its own group.
+
+    Args:
+        data_var: A NetCDF variable with dimensions (time, latitude, longitude).
+        rows: The row indices of the cells.
+        cols: The column indices of the cells.
+
+    Returns:
+        A list of arrays of the indices of the cells in each group.
+    """
+
+    chunking = data_var.chunking()
+
+    if chunking is None or chunking == "contiguous":
+        return [np.array([idx]) for idx in range(len(rows))]
+
+    chunk_keys = np.stack([rows // chunking[-2], cols // chunking[-1]], axis=1)
+    _, group = np.unique(chunk_keys, axis=0, return_inverse=True)
+    group = group.reshape(-1)
+
+    return [np.flatnonzero(group == idx) for idx in range(group.max() + 1)]
+
+
+def _read_times(time_var: netCDF4.Variable) -> np.ndarray:
+    """Read the values of a time variable, decoding CF times to datetime64[ns]."""
+
+    if hasattr(time_var, "units") and " since " in time_var.units:
+        times = netCDF4.num2date(
+            time_var[:],
+            units=time_var.units,
+            calendar=getattr(time_var, "calendar", "standard"),
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+        return np.array(times, dtype="datetime64[ns]")
+
+    return np.asarray(time_var[:])
+
+
+def read_file_cells(
+    path: Path,
+    variables: list[str],
+    rows: np.ndarray,
+    cols: np.ndarray,
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Read the time series for a set of grid cells for variables in a NetCDF file.
+
+    The file is opened once to read all of the variables, which must have the
+    dimensions (time, latitude, longitude) and share the same time dimension, although
+    the time dimension can have any name, such as ``month`` or ``year``. Time values
+    with CF units are decoded to datetime64[ns] values and other time values are
+    returned unchanged.
+
+    The cells are grouped by the storage chunk that contains them and the cells in each
+    group are read using a single hyperslab read covering those cells, so that each
+    chunk is only read and decompressed once. Missing values are returned as NaN.
+
+    Args:
+        path: The NetCDF file.
+        variables: The variables to read.
+        rows: The row indices of the cells.
+        cols: The column indices of the cells.
+
+    Returns:
+        A tuple of the time values and a dictionary of float64 arrays of the cell
+        values with shape (time, cells), keyed by variable name.
+    """
+
+    rows = np.asarray(rows, dtype="int64")
+    cols = np.asarray(cols, dtype="int64")
+
+    with netCDF4.Dataset(path) as ds:
+        times = _read_times(ds[ds[variables[0]].dimensions[0]])
+
+        data = {}
+        for variable in variables:
+            data_var = ds[variable]
+            values = np.empty((len(times), len(rows)), dtype="float64")
+
+            for group in _chunk_groups(data_var, rows, cols):
+                row_start, col_start = rows[group].min(), cols[group].min()
+                block = data_var[
+                    :,
+                    row_start : rows[group].max() + 1,
+                    col_start : cols[group].max() + 1,
+                ]
+                values[:, group] = np.ma.filled(
+                    block[:, rows[group] - row_start, cols[group] - col_start].astype(
+                        "float64"
+                    ),
+                    np.nan,
+                )
+
+            data[variable] = values
+
+    return times, data
+
+
+def read_cells(
+    path: Path,
+    variable: str,
+    rows: np.ndarray,
+    cols: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Read the time series for a set of grid cells for a variable in a NetCDF file.
+
+    See ``read_file_cells`` for details.
+
+    Args:
+        path: The NetCDF file.
+        variable: The variable to read.
+        rows: The row indices of the cells.
+        cols: The column indices of the cells.
+
+    Returns:
+        A tuple of the time values and a float64 array of the cell values with shape
+        (time, cells).
+    """
+
+    times, data = read_file_cells(path, [variable], rows, cols)
+
+    return times, data[variable]
+
+
+def monthly_file_sums(
+    path: Path,
+    variables: list[str],
+    rows: np.ndarray,
+    cols: np.ndarray,
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+) -> tuple[np.ndarray, dict[str, tuple[np.ndarray, np.ndarray]]]:
+    """Read cell time series from a file and reduce them to monthly sums and counts.
+
+    If a time window is given, only the time steps within the window are included in
+    the sums and counts, so months that are split by the window are reduced using just
+    the time steps within the window.
+
+    Args:
+        path: The NetCDF file.
+        variables: The variables to read.
+        rows: The row indices of the cells.
+        cols: The column indices of the cells.
+        start: An optional start time for the time window.
+        end: An optional end time for the time window.
+
+    Returns:
+        A tuple of the months as datetime64[M] values and a dictionary keyed by variable
+        name of tuples of the sums of the finite values in each month and the counts of
+        finite values, both with shape (months, cells).
+    """
+
+    times, data = read_file_cells(path, variables, rows, cols)
+
+    # Reduce to the time steps within the window
+    in_window = np.ones(len(times), dtype="bool")
+    if start is not None:
+        in_window &= times >= start
+    if end is not None:
+        in_window &= times <= end
+
+    if not in_window.all():
+        times = times[in_window]
+        data = {variable: values[in_window] for variable, values in data.items()}
+
+    months, month_index = np.unique(
+        times.astype("datetime64[M]"), return_inverse=True
+    )
+
+    monthly = {}
+    for variable, values in data.items():
+        finite = np.isfinite(values)
+        sums = np.zeros((len(months), values.shape[1]))
+        counts = np.zeros((len(months), values.shape[1]), dtype="int64")
+        np.add.at(sums, month_index, np.where(finite, values, 0))
+        np.add.at(counts, month_index, finite)
+        monthly[variable] = (sums, counts)
+
+    return months, monthly
+
+
+def combine_series(
+    results, variables: list[str], n_cells: int
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Combine the results of ``read_file_cells`` from a set of files in time order.
+
+    Args:
+        results: An iterable of the results for each file.
+        variables: The variables read from the files.
+        n_cells: The number of cells read from the files.
+
+    Returns:
+        A tuple of the time values and a dictionary of (time, cells) arrays of the cell
+        values keyed by variable name.
+    """
+
+    results = list(results)
+
+    times = np.concatenate([times for times, _ in results])
+    order = np.argsort(times, kind="stable")
+
+    data = {
+        variable: np.concatenate([data[variable] for _, data in results]).reshape(
+            -1, n_cells
+        )[order]
+        for variable in variables
+    }
+
+    return times[order], data
+
+
+def combine_monthly(
+    results, variables: list[str], n_cells: int
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Combine the results of ``monthly_file_sums`` from a set of files.
+
+    The monthly sums and counts are accumulated as each result is taken from the
+    results iterable, so that results can be combined as they arrive from worker
+    processes. Months can be split across files.
+
+    Args:
+        results: An iterable of the results for each file.
+        variables: The variables read from the files.
+        n_cells: The number of cells read from the files.
+
+    Returns:
+        A tuple of the months as datetime64[ns] values at the start of each month and a
+        dictionary of (time, cells) arrays of the monthly means keyed by variable name.
+    """
+
+    month_sums: dict[np.datetime64, dict[str, np.ndarray]] = {}
+    month_counts: dict[np.datetime64, dict[str, np.ndarray]] = {}
+
+    for months, monthly in results:
+        for idx, month in enumerate(months):
+            if month not in month_sums:
+                month_sums[month] = {v: np.zeros(n_cells) for v in variables}
+                month_counts[month] = {
+                    v: np.zeros(n_cells, dtype="int64") for v in variables
+                }
+            for variable, (sums, counts) in monthly.items():
+                month_sums[month][variable] += sums[idx]
+                month_counts[month][variable] += counts[idx]
+
+    months = sorted(month_sums)
+
+    data = {}
+    for variable in variables:
+        sums = np.array([month_sums[m][variable] for m in months]).reshape(-1, n_cells)
+        counts = np.array([month_counts[m][variable] for m in months]).reshape(
+            -1, n_cells
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            data[variable] = np.where(counts > 0, sums / counts, np.nan)
+
+    months = np.array(months, dtype="datetime64[M]").astype("datetime64[ns]")
+
+    return months, data
+
+
+def extract_cells(
+    files: list[Path],
+    variable: str,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    workers: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Extract the time series for a set of grid cells from a set of NetCDF files.
+
+    The files are read in a pool of worker processes and the time series from each file
+    are combined in time order.
+
+    Args:
+        files: The NetCDF files to read.
+        variable: The variable to read.
+        rows: The row indices of the cells.
+        cols: The column indices of the cells.
+        workers: The number of worker processes.
+
+    Returns:
+        A tuple of the time values and a (time, cells) array of the cell values.
+    """
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            read_file_cells, files, repeat([variable]), repeat(rows), repeat(cols)
+        )
+        times, data = combine_series(results, [variable], len(rows))
+
+    return times, data[variable]
+
+
+def extract_cell_monthly_means(
+    files: list[Path],
+    variable: str,
+    rows: np.ndarray,
+    cols: np.ndarray,
+    workers: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Extract monthly mean values for a set of grid cells from a set of NetCDF files.
+
+    Each file is read and reduced to monthly sums and counts for the cells in a pool of
+    worker processes, and the monthly results are combined as they arrive, so the
+    sub-monthly data are never held in memory together.
+
+    Args:
+        files: The NetCDF files to read.
+        variable: The variable to read.
+        rows: The row indices of the cells.
+        cols: The column indices of the cells.
+        workers: The number of worker processes.
+
+    Returns:
+        A tuple of the months as datetime64[ns] values at the start of each month and a
+        (time, cells) array of the monthly means.
+    """
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            monthly_file_sums, files, repeat([variable]), repeat(rows), repeat(cols)
+        )
+        months, data = combine_monthly(results, [variable], len(rows))
+
+    return months, data[variable]
+
+
+def site_data_array(
+    times: np.ndarray, values: np.ndarray, variable: str, site_index: SiteGridIndex
+) -> xarray.DataArray:
+    """Create a site DataArray from the values for the unique cells of a site index.
+
+    Args:
+        times: The time values.
+        values: A (time, cells) array of values for the unique cells of the index.
+        variable: The variable name.
+        site_index: The grid cell indices for the sites.
+
+    Returns:
+        A DataArray of the values with dimensions (time, site_id).
+    """
+
+    return xarray.DataArray(
+        site_index.to_sites(values),
+        dims=("time", "site_id"),
+        coords={
+            "time": times,
+            "site_id": site_index.site_ids,
+            "lat": ("site_id", site_index.site_lat),
+            "lon": ("site_id", site_index.site_lon),
+        },
+        name=variable,
+    )
+
+
+def _extract_sites(
+    extract: Callable,
+    files: list[Path],
+    variable: str,
+    site_index: SiteGridIndex,
+    workers: int,
+    cache: SiteCache | None,
+) -> xarray.DataArray:
+    """Extract cell data for a set of sites, optionally using a site cache.
+
+    Args:
+        extract: The cell extraction function.
+        files: The NetCDF files to read.
+        variable: The variable to read.
+        site_index: The grid cell indices for the sites.
+        workers: The number of worker processes.
+        cache: An optional site cache.
+    """
+
+    extract = partial(extract, workers=workers)
+    cells = (site_index.cell_rows, site_index.cell_cols)
+
+    if cache is None:
+        times, values = extract(files, variable, *cells)
+    else:
+        times, values = cache.get(variable, files, *cells, extract=extract)
+
+    return site_data_array(times, values, variable, site_index)
+
+
+def extract_site_series(
+    files: list[Path],
+    variable: str,
+    site_index: SiteGridIndex,
+    workers: int = 1,
+    cache: SiteCache | None = None,
+) -> xarray.DataArray:
+    """Extract the time series for a set of sites from a set of NetCDF files.
+
+    Args:
+        files: The NetCDF files to read.
+        variable: The variable to read.
+        site_index: The grid cell indices for the sites.
+        workers: The number of worker processes.
+        cache: An optional site cache, which is used to provide the time series for
+            previously extracted cells and is updated with any new cells.
+
+    Returns:
+        A DataArray of the values with dimensions (time, site_id).
+    """
+
+    return _extract_sites(extract_cells, files, variable, site_index, workers, cache)
+
+
+def extract_monthly_means(
+    files: list[Path],
+    variable: str,
+    site_index: SiteGridIndex,
+    workers: int = 1,
+    cache: SiteCache | None = None,
+) -> xarray.DataArray:
+    """Extract monthly mean values for a set of sites from a set of NetCDF files.
+
+    See ``extract_cell_monthly_means`` for details. The cache source name should show
+    that the cached values are monthly means.
+
+    Args:
+        files: The NetCDF files to read.
+        variable: The variable to read.
+        site_index: The grid cell indices for the sites.
+        workers: The number of worker processes.
+        cache: An optional site cache, which is used to provide the monthly means for
+            previously extracted cells and is updated with any new cells.
+
+    Returns:
+        A DataArray of the monthly means with dimensions (time, site_id), where the time
+        values are the start of each month.
+    """
+
+    return _extract_sites(
+        extract_cell_monthly_means, files, variable, site_index, workers, cache
+    )
@@ -0,0 +1,682 @@
+"""Regridding of latitude and longitude grids using precomputed sparse weights.
+
+The ERA5 data are remapped to the 0.5° grid in ``half_degree.grd`` using ``cdo
+remapbil``, which recalculates the interpolation geometry for every file and has to be
+run as a separate command for each file. Every file from a source uses the same grid, so
+this module instead calculates the remapping weights once and applies them to each
+block of data as a single sparse matrix multiplication:
+
+* The RegridWeights class holds a sparse matrix of shape (target cells, source cells),
+  where the cells are the flattened (lat, lon) grids in the order ``row * n_lon + col``.
+  Regridding a block of data with shape (..., lat, lon) is then a single multiplication
+  of the flattened block by the weights, which is much faster than recalculating the
+  interpolation for each time step.
+* Bilinear weights match ``cdo remapbil`` for regular latitude and longitude grids.
+  Conservative weights use the overlapping area of the source and target cells, in the
+  same way as ``cdo remapcon``, and are better suited to aggregating fine resolution
+  sources such as CHELSA.
+* Both methods are separable on rectilinear grids, so the weights are calculated for
+  the latitude and longitude axes independently and then combined as the Kronecker
+  product of the two axis weights. Longitude axes that cover the whole globe are
+  treated as periodic, so target cells near the dateline use source cells on both
+  sides of it, whatever the longitude convention of the source and target grids.
+* Weights can be saved to and loaded from a NumPy ``.npz`` file, so that the same
+  weights can be reused across jobs for a source, and the ``read_grid_description``
+  function reads target grids from CDO grid description files, such as
+  ``half_degree.grd``.
+
+Missing data in the source (NaN values) propagate to any target cell that uses them, as
+with CDO. For land only sources, such as CRU-JRA and WFDE5, the ``min_weight`` option
+instead renormalises the weights over the valid source cells, so that coastal target
+cells are calculated from the neighbouring land cells.
+
+The module can also be run from the command line to remap NetCDF files, reading and
+writing a block of time steps at a time and reusing a weights file across runs:
+
+    python regrid_weights.py ssrd_1980_*.nc --grid half_degree.grd --out-dir ssrd \\
+        --weights era5_bilinear.npz
+"""
+
+import argparse
+import textwrap
+from pathlib import Path
+
+import netCDF4
+import numpy as np
+import scipy.sparse
+import xarray
+
+METHODS = ("bilinear", "conservative")
+"""The available regridding methods."""
+
+LAT_NAMES = ("lat", "latitude")
+LON_NAMES = ("lon", "longitude")
+
+# Attributes that describe the storage of the source data and are not copied to the
+# regridded float32 variables.
+STORAGE_ATTRS = ("_FillValue", "missing_value", "scale_factor", "add_offset")
+
+
+def read_grid_description(path: Path) -> tuple[np.ndarray, np.ndarray]:
+    """Read the latitude and longitude axes from a CDO lonlat grid description.
+
+    Args:
+        path: The grid description file.
+
+    Returns:
+        A tuple of the latitude and longitude axes.
+    """
+
+    grid = {}
+    with open(path) as grid_file:
+        for line in grid_file:
+            if "=" in line:
+                key, value = line.split("=", maxsplit=1)
+                grid[key.strip()] = value.strip()
+
+    if grid["gridtype"] != "lonlat":
+        raise ValueError(f"Unsupported grid type: {grid['gridtype']}")
+
+    lon = float(grid["xfirst"]) + float(grid["xinc"]) * np.arange(int(grid["xsize"]))
+    lat = float(grid["yfirst"]) + float(grid["yinc"]) * np.arange(int(grid["ysize"]))
+
+    return lat, lon
+
+
+def is_periodic(lon: np.ndarray) -> bool:
+    """Check if a regular longitude axis covers the whole globe."""
+
+    lon = np.asarray(lon, dtype="float64")
+    if lon.size < 2:
+        return False
+
+    return bool(np.isclose(lon.size * np.abs(np.diff(lon)).mean(), 360))
+
+
+def cell_edges(centres: np.ndarray, limits: tuple[float, float] | None = None):
+    """Get the edges of the cells on an ascending axis from the cell centres.
+
+    Args:
+        centres: The ascending cell centres.
+        limits: Optional limits for the edges, such as the poles for latitude.
+
+    Returns:
+        An array of the cell edges, with one more value than the centres.
+    """
+
+    mid = (centres[1:] + centres[:-1]) / 2
+    edges = np.concatenate(
+        [[2 * centres[0] - mid[0]], mid, [2 * centres[-1] - mid[-1]]]
+    )
+
+    if limits is not None:
+        edges = np.clip(edges, *limits)
+
+    return edges
+
+
+def linear_axis_weights(
+    src: np.ndarray, dst: np.ndarray, periodic: bool = False
+) -> scipy.sparse.csr_matrix:
+    """Get the linear interpolation weights from one axis to another.
+
+    Target values outside the source axis have no weights, unless the axis is periodic.
+
+    Args:
+        src: The source axis, in any order.
+        dst: The target axis.
+        periodic: Whether the axis is a periodic longitude axis.
+
+    Returns:
+        A sparse matrix of shape (len(dst), len(src)).
+    """
+
+    src = np.asarray(src, dtype="float64")
+    dst = np.asarray(dst, dtype="float64")
+    order = np.argsort(src, kind="stable")
+    axis = src[order]
+
+    if periodic:
+        # Repeat the last and first source values across the period and bring the
+        # targets into the range of the source values.
+        axis = np.concatenate([[axis[-1] - 360], axis, [axis[0] + 360]])
+        order = np.concatenate([[order[-1]], order, [order[0]]])
+        dst = (dst - axis[1]) % 360 + axis[1]
+
+    valid = (dst >= axis[0]) & (dst <= axis[-1])
+    rows = np.flatnonzero(valid)
+    lower = np.searchsorted(axis, dst[valid], side="right") - 1
+    lower = np.clip(lower, 0, len(axis) - 2)
+    weight = (dst[valid] - axis[lower]) / (axis[lower + 1] - axis[lower])
+
+    matrix = scipy.sparse.csr_matrix(
+        (
+            np.concatenate([1 - weight, weight]),
+            (np.tile(rows, 2), np.concatenate([order[lower], order[lower + 1]])),
+        ),
+        shape=(len(dst), len(src)),
+    )
+    matrix.eliminate_zeros()
+
+    return matrix
+
+
+def overlap_axis_weights(
+    src: np.ndarray,
+    dst: np.ndarray,
+    periodic: bool = False,
+    latitude: bool = False,
+) -> scipy.sparse.csr_matrix:
+    """Get the weights from the overlap of the cells on one axis with another.
+
+    The weights for each target cell are the lengths of its overlap with the source
+    cells, normalised to sum to one over the source cells that it overlaps. Latitude
+    overlaps are measured in the sine of latitude, so that the weights are proportional
+    to the cell areas.
+
+    Args:
+        src: The source cell centres, in any order.
+        dst: The target cell centres.
+        periodic: Whether the axis is a periodic longitude axis.
+        latitude: Whether the axis is a latitude axis.
+
+    Returns:
+        A sparse matrix of shape (len(dst), len(src)).
+    """
+
+    src = np.asarray(src, dtype="float64")
+    dst = np.asarray(dst, dtype="float64")
+    limits = (-90, 90) if latitude else None
+
+    src_order = np.argsort(src, kind="stable")
+    src_edges = cell_edges(src[src_order], limits)
+    dst_order = np.argsort(dst, kind="stable")
+    dst_edges = cell_edges(dst[dst_order], limits)
+
+    if periodic:
+        # Bring the targets into the range of the source cells and repeat the source
+        # cells either side, so that target cells can overlap the start and end.
+        shift = (dst_edges[0] - src_edges[0]) % 360 - (dst_edges[0] - src_edges[0])
+        dst_edges = dst_edges + shift
+        src_edges = np.concatenate(
+            [src_edges[:-1] - 360, src_edges[:-1], src_edges + 360]
+        )
+        src_order = np.tile(src_order, 3)
+
+    if latitude:
+        src_edges = np.sin(np.deg2rad(src_edges))
+        dst_edges = np.sin(np.deg2rad(dst_edges))
+
+    # Find the range of source cells overlapping each target cell
+    n_src = len(src_edges) - 1
+    first = np.searchsorted(src_edges, dst_edges[:-1], side="right") - 1
+    last = np.searchsorted(src_edges, dst_edges[1:], side="left") - 1
+    first = np.clip(first, 0, n_src - 1)
+    last = np.clip(last, 0, n_src - 1)
+    counts = np.maximum(last - first + 1, 0)
+
+    rows = np.repeat(np.arange(len(dst)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cols = first[rows] + offsets
+
+    overlap = np.minimum(dst_edges[rows + 1], src_edges[cols + 1]) - np.maximum(
+        dst_edges[rows], src_edges[cols]
+    )
+    keep = overlap > 0
+    rows, cols, overlap = rows[keep], cols[keep], overlap[keep]
+
+    # Normalise the overlaps for each target cell
+    totals = np.bincount(rows, weights=overlap, minlength=len(dst))
+    matrix = scipy.sparse.csr_matrix(
+        (overlap / totals[rows], (dst_order[rows], src_order[cols])),
+        shape=(len(dst), len(src)),
+    )
+
+    return matrix
+
+
+class RegridWeights:
+    """Sparse weights to regrid data from a source grid to a target grid.
+
+    Args:
+        matrix: The sparse weights, with shape (target cells, source cells).
+        src_lat: The latitude axis of the source grid.
+        src_lon: The longitude axis of the source grid.
+        dst_lat: The latitude axis of the target grid.
+        dst_lon: The longitude axis of the target grid.
+        method: The regridding method used to calculate the weights.
+    """
+
+    def __init__(
+        self,
+        matrix: scipy.sparse.csr_matrix,
+        src_lat: np.ndarray,
+        src_lon: np.ndarray,
+        dst_lat: np.ndarray,
+        dst_lon: np.ndarray,
+        method: str,
+    ):
+        self.src_lat = np.asarray(src_lat)
+        self.src_lon = np.asarray(src_lon)
+        self.dst_lat = np.asarray(dst_lat)
+        self.dst_lon = np.asarray(dst_lon)
+        self.method = method
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+
+        if self.matrix.shape != (self.dst_lat.size * self.dst_lon.size, self.n_src):
+            raise ValueError("Weights shape does not match the grid axes")
+
+        # Target cells with no source cells, which are outside the source grid
+        self.uncovered = np.diff(self.matrix.indptr) == 0
+
+    @classmethod
+    def from_grids(
+        cls,
+        src_lat: np.ndarray,
+        src_lon: np.ndarray,
+        dst_lat: np.ndarray,
+        dst_lon: np.ndarray,
+        method: str = "bilinear",
+        dtype: str = "float32",
+    ) -> "RegridWeights":
+        """Calculate the weights between two regular latitude and longitude grids.
+
+        Args:
+            src_lat: The latitude axis of the source grid.
+            src_lon: The longitude axis of the source grid.
+            dst_lat: The latitude axis of the target grid.
+            dst_lon: The longitude axis of the target grid.
+            method: The regridding method, which is one of METHODS.
+            dtype: The data type of the weights.
+        """
+
+        periodic = is_periodic(src_lon)
+
+        if method == "bilinear":
+            lat_weights = linear_axis_weights(src_lat, dst_lat)
+            lon_weights = linear_axis_weights(src_lon, dst_lon, periodic)
+        elif method == "conservative":
+            lat_weights = overlap_axis_weights(src_lat, dst_lat, latitude=True)
+            lon_weights = overlap_axis_weights(src_lon, dst_lon, periodic)
+        else:
+            raise ValueError(f"Unknown regridding method: {method}")
+
+        # The flattened grid index is row * n_lon + col, which is the ordering of the
+        # Kronecker product of the latitude and longitude weights.
+        matrix = scipy.sparse.kron(lat_weights, lon_weights, format="csr")
+
+        return cls(matrix.astype(dtype), src_lat, src_lon, dst_lat, dst_lon, method)
+
+    @classmethod
+    def load(cls, path: Path) -> "RegridWeights":
+        """Load weights saved by the ``save`` method.
+
+        Args:
+            path: The weights file.
+        """
+
+        with np.load(path) as saved:
+            matrix = scipy.sparse.csr_matrix(
+                (saved["data"], saved["indices"], saved["indptr"]),
+                shape=tuple(saved["shape"]),
+            )
+
+            return cls(
+                matrix,
+                saved["src_lat"],
+                saved["src_lon"],
+                saved["dst_lat"],
+                saved["dst_lon"],
+                str(saved["method"]),
+            )
+
+    def save(self, path: Path) -> None:
+        """Save the weights and grid axes to a NumPy ``.npz`` file.
+
+        Args:
+            path: The weights file.
+        """
+
+        np.savez(
+            path,
+            data=self.matrix.data,
+            indices=self.matrix.indices,
+            indptr=self.matrix.indptr,
+            shape=np.array(self.matrix.shape),
+            src_lat=self.src_lat,
+            src_lon=self.src_lon,
+            dst_lat=self.dst_lat,
+            dst_lon=self.dst_lon,
+            method=self.method,
+        )
+
+    @property
+    def src_shape(self) -> tuple[int, int]:
+        """The shape of the source grid."""
+        return (self.src_lat.size, self.src_lon.size)
+
+    @property
+    def dst_shape(self) -> tuple[int, int]:
+        """The shape of the target grid."""
+        return (self.dst_lat.size, self.dst_lon.size)
+
+    @property
+    def n_src(self) -> int:
+        """The number of source cells."""
+        return self.src_lat.size * self.src_lon.size
+
+    def matches(
+        self,
+        src_lat: np.ndarray,
+        src_lon: np.ndarray,
+        dst_lat: np.ndarray | None = None,
+        dst_lon: np.ndarray | None = None,
+    ) -> bool:
+        """Check if the weights are for a source grid and, optionally, a target grid.
+
+        Args:
+            src_lat: The latitude axis of the source grid.
+            src_lon: The longitude axis of the source grid.
+            dst_lat: The latitude axis of the target grid.
+            dst_lon: The longitude axis of the target grid.
+        """
+
+        pairs = [(self.src_lat, src_lat), (self.src_lon, src_lon)]
+        if dst_lat is not None:
+            pairs.append((self.dst_lat, dst_lat))
+        if dst_lon is not None:
+            pairs.append((self.dst_lon, dst_lon))
+
+        return all(
+            np.shape(ours) == np.shape(theirs) and np.allclose(ours, theirs)
+            for ours, theirs in pairs
+        )
+
+    def regrid(self, data: np.ndarray, min_weight: float | None = None) -> np.ndarray:
+        """Regrid data from the source grid to the target grid.
+
+        Args:
+            data: An array with the source grid as the last two dimensions.
+            min_weight: If given, missing source values are excluded and the weights
+                are renormalised over the valid source cells. Target cells are missing
+                if the valid source cells have less than this total weight.
+
+        Returns:
+            An array with the target grid as the last two dimensions.
+        """
+
+        data = np.asarray(data)
+        if data.shape[-2:] != self.src_shape:
+            raise ValueError(f"Data shape {data.shape} does not match the source grid")
+
+        # Flatten the grids, giving (source cells, slabs), and regrid all of the slabs
+        # with a single sparse matrix multiplication.
+        lead_shape = data.shape[:-2]
+        flat = data.reshape((-1, self.n_src)).T
+
+        if min_weight is None:
+            result = self.matrix @ flat
+        else:
+            valid = np.isfinite(flat)
+            result = self.matrix @ np.where(valid, flat, 0)
+            total = self.matrix @ valid.astype(self.matrix.dtype)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result = np.where(total >= min_weight, result / total, np.nan)
+
+        result = result.astype(np.result_type(data.dtype, "float32"), copy=False)
+        result[self.uncovered] = np.nan
+
+        return result.T.reshape(lead_shape + self.dst_shape)
+
+    def regrid_dataarray(
+        self,
+        data: xarray.DataArray,
+        lat_name: str = "latitude",
+        lon_name: str = "longitude",
+        min_weight: float | None = None,
+    ) -> xarray.DataArray:
+        """Regrid a DataArray to the target grid.
+
+        Args:
+            data: The data, which is loaded into memory to regrid.
+            lat_name: The name of the source latitude dimension.
+            lon_name: The name of the source longitude dimension.
+            min_weight: See ``regrid``.
+
+        Returns:
+            The regridded data, with target grid dimensions named lat and lon.
+        """
+
+        dims = [dim for dim in data.dims if dim not in (lat_name, lon_name)]
+        data = data.transpose(*dims, lat_name, lon_name)
+
+        return xarray.DataArray(
+            self.regrid(data.values, min_weight),
+            dims=(*dims, "lat", "lon"),
+            coords={
+                **{dim: data[dim].values for dim in dims if dim in data.coords},
+                "lat": ("lat", self.dst_lat, {"units": "degrees_north"}),
+                "lon": ("lon", self.dst_lon, {"units": "degrees_east"}),
+            },
+            name=data.name,
+            attrs=data.attrs,
+        )
+
+
+def grid_names(ds: netCDF4.Dataset) -> tuple[str, str]:
+    """Find the names of the latitude and longitude dimensions in a NetCDF file."""
+
+    lat_name = next((name for name in LAT_NAMES if name in ds.dimensions), None)
+    lon_name = next((name for name in LON_NAMES if name in ds.dimensions), None)
+
+    if lat_name is None or lon_name is None:
+        raise ValueError(f"No latitude and longitude dimensions in {ds.filepath()}")
+
+    return lat_name, lon_name
+
+
+def load_weights(
+    path: Path | None,
+    src_lat: np.ndarray,
+    src_lon: np.ndarray,
+    dst_lat: np.ndarray,
+    dst_lon: np.ndarray,
+    method: str = "bilinear",
+) -> RegridWeights:
+    """Load weights from a file, calculating and saving them if needed.
+
+    The weights are recalculated if the file is missing or is for other grids or
+    another method.
+
+    Args:
+        path: The weights file, or None to calculate the weights without saving them.
+        src_lat: The latitude axis of the source grid.
+        src_lon: The longitude axis of the source grid.
+        dst_lat: The latitude axis of the target grid.
+        dst_lon: The longitude axis of the target grid.
+        method: The regridding method.
+    """
+
+    if path is not None and path.exists():
+        weights = RegridWeights.load(path)
+        if weights.method == method and weights.matches(
+            src_lat, src_lon, dst_lat, dst_lon
+        ):
+            return weights
+
+    weights = RegridWeights.from_grids(src_lat, src_lon, dst_lat, dst_lon, method)
+    if path is not None:
+        weights.save(path)
+
+    return weights
+
+
+def regrid_file(
+    in_file: Path,
+    out_file: Path,
+    weights: RegridWeights,
+    block_steps: int = 24,
+    complevel: int = 6,
+    min_weight: float | None = None,
+) -> None:
+    """Regrid the gridded variables in a NetCDF file.
+
+    Variables with the source grid as their last two dimensions are regridded a block
+    of steps along their leading dimension at a time and written as float32. Other
+    variables, such as the time axis, are copied. The output is written to a temporary
+    file and renamed once complete.
+
+    Args:
+        in_file: The source NetCDF file.
+        out_file: The output NetCDF file.
+        weights: The regridding weights for the source grid.
+        block_steps: The number of steps along the leading dimension regridded at once.
+        complevel: The zlib compression level of the regridded variables.
+        min_weight: See ``RegridWeights.regrid``.
+    """
+
+    temp_file = out_file.with_suffix(".tmp")
+
+    with netCDF4.Dataset(in_file) as src, netCDF4.Dataset(temp_file, "w") as dest:
+        lat_name, lon_name = grid_names(src)
+        if not weights.matches(src[lat_name][:], src[lon_name][:]):
+            raise ValueError(f"The weights do not match the grid in {in_file}")
+
+        dest.setncatts(src.__dict__)
+        dest.history = (
+            getattr(src, "history", "")
+            + f" | Regridded using {weights.method} weights with regrid_weights.py"
+        )
+
+        for name, dim in src.dimensions.items():
+            if name not in (lat_name, lon_name):
+                dest.createDimension(name, None if dim.isunlimited() else dim.size)
+
+        # Create the target grid axes
+        for name, values, units in (
+            ("lat", weights.dst_lat, "degrees_north"),
+            ("lon", weights.dst_lon, "degrees_east"),
+        ):
+            dest.createDimension(name, len(values))
+            axis_var = dest.createVariable(name, "f8", (name,))
+            axis_var.units = units
+            axis_var[:] = values
+
+        for name, src_var in src.variables.items():
+            if name in (lat_name, lon_name):
+                continue
+
+            if src_var.dimensions[-2:] != (lat_name, lon_name):
+                # Copy variables that are not on the grid, dropping any others that
+                # use the source grid dimensions, such as cell bounds
+                if {lat_name, lon_name} & set(src_var.dimensions):
+                    continue
+                attrs = src_var.__dict__
+                dest_var = dest.createVariable(
+                    name,
+                    src_var.datatype,
+                    src_var.dimensions,
+                    fill_value=attrs.get("_FillValue"),
+                )
+                dest_var.setncatts(
+                    {k: v for k, v in attrs.items() if k != "_FillValue"}
+                )
+                dest_var[:] = src_var[:]
+                continue
+
+            dims = src_var.dimensions[:-2] + ("lat", "lon")
+            dest_var = dest.createVariable(
+                name,
+                "f4",
+                dims,
+                zlib=True,
+                complevel=complevel,
+                fill_value=np.float32(np.nan),
+                chunksizes=(1,) * (len(dims) - 2) + weights.dst_shape,
+            )
+            dest_var.setncatts(
+                {k: v for k, v in src_var.__dict__.items() if k not in STORAGE_ATTRS}
+            )
+
+            n_steps = src_var.shape[0] if src_var.ndim > 2 else 1
+            for start in range(0, n_steps, block_steps):
+                block = slice(start, start + block_steps) if src_var.ndim > 2 else ...
+                data = np.ma.filled(src_var[block].astype("float32"), np.nan)
+                dest_var[block] = weights.regrid(data, min_weight)
+
+    temp_file.rename(out_file)
+
+
+def regrid_weights_cli():
+    """Regrid NetCDF files to a target grid using precomputed sparse weights.
+
+    The weights are calculated from the grid of the first file and reused for the
+    remaining files, which must all use the same grid. If a weights file is given, the
+    weights are loaded from it, or calculated and saved to it if it does not exist or is
+    for a different grid. Existing output files are skipped.
+    """
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(regrid_weights_cli.__doc__),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("in_files", type=Path, nargs="+", help="The source files")
+    parser.add_argument(
+        "--grid", type=Path, required=True, help="A CDO grid description file"
+    )
+    parser.add_argument(
+        "--out-dir", type=Path, required=True, help="The output directory"
+    )
+    parser.add_argument(
+        "--method", choices=METHODS, default="bilinear", help="The regridding method"
+    )
+    parser.add_argument("--weights", type=Path, help="A weights file to reuse")
+    parser.add_argument(
+        "--min-weight",
+        type=float,
+        help="Renormalise over valid source cells with at least this weight",
+    )
+    parser.add_argument(
+        "--block-steps",
+        type=int,
+        default=24,
+        help="The number of time steps regridded at once",
+    )
+    parser.add_argument(
+        "--complevel", type=int, default=6, help="The zlib compression level"
+    )
+
+    args = parser.parse_args()
+
+    dst_lat, dst_lon = read_grid_description(args.grid)
+    with netCDF4.Dataset(args.in_files[0]) as ds:
+        lat_name, lon_name = grid_names(ds)
+        src_lat, src_lon = ds[lat_name][:], ds[lon_name][:]
+
+    weights = load_weights(
+        args.weights, src_lat, src_lon, dst_lat, dst_lon, args.method
+    )
+
+    args.out_dir.mkdir(parents=True, exist_ok=True)
+    for in_file in args.in_files:
+        out_file = args.out_dir / in_file.name
+        if out_file.exists():
+            print(f"Skipping {out_file}")
+            continue
+
+        regrid_file(
+            in_file,
+            out_file,
+            weights,
+            block_steps=args.block_steps,
+            complevel=args.complevel,
+            min_weight=args.min_weight,
+        )
+        print(f"Regridded {in_file}")
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    regrid_weights_cli()
@@ -0,0 +1,236 @@
+"""A persistent cache of grid cell time series for site extractions.
+
+Site extractions are often rerun with slightly different site lists or date windows and
+rescanning a gridded archive for each run is slow. The SiteCache class stores the full
+time series for each grid cell that has been extracted from a source, keyed by (source,
+variable, grid cell), so that later extractions only read the archive for cells that
+have not been seen before.
+
+Each (source, variable) pair is stored as a small compressed NetCDF file in the cache
+directory, with the time series for each cell stored as a column of a (time, cell)
+array along with the row and column indices of the cell. The file also records the
+names, sizes and modification times of the source files used to extract the data and
+the cache for a variable is discarded if the source files change, for example when new
+years are added to an archive or a file is regenerated under the same name.
+
+Cache files are written to a temporary file and then renamed, so an interrupted run
+cannot leave a partial cache file.
+"""
+
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import xarray
+
+
+class SiteCache:
+    """A persistent cache of grid cell time series for a data source.
+
+    The source name should identify both the gridded data and any processing applied to
+    the extracted time series, such as "wfde5_monthly_mean".
+
+    Args:
+        cache_dir: The directory used to store the cache files.
+        source: The name of the data source.
+    """
+
+    def __init__(self, cache_dir: Path, source: str):
+        self.cache_dir = Path(cache_dir)
+        self.source = source
+
+    def cache_file(self, variable: str) -> Path:
+        """Get the path of the cache file for a variable.
+
+        Args:
+            variable: The variable name.
+        """
+        return self.cache_dir / f"{self.source}_{variable}.nc"
+
+    def load(self, variable: str, files: list[Path]) -> xarray.Dataset | None:
+        """Load the cached cell data for a variable.
+
+        Args:
+            variable: The variable name.
+            files: The source files for the variable, which must match the files used to
+                create the cache.
+
+        Returns:
+            A dataset containing the ``values`` array with dimensions (time, cell) and
+            the ``row`` and ``col`` indices of the cells, or None if there is no valid
+            cache for the variable.
+        """
+
+        cache_file = self.cache_file(variable)
+
+        if not cache_file.exists():
+            return None
+
+        cached = xarray.load_dataset(cache_file)
+
+        if cached.attrs.get("source_files") != _file_list(files):
+            return None
+
+        return cached
+
+    def save(self, variable: str, files: list[Path], cached: xarray.Dataset) -> None:
+        """Save the cell data for a variable to the cache.
+
+        Args:
+            variable: The variable name.
+            files: The source files for the variable.
+            cached: The cell data, as returned by ``load``.
+        """
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        cached.attrs["source_files"] = _file_list(files)
+
+        cache_file = self.cache_file(variable)
+        temp_file = cache_file.with_suffix(".tmp")
+        cached.to_netcdf(temp_file, encoding={"values": {"zlib": True, "complevel": 6}})
+        temp_file.replace(cache_file)
+
+    def _cell_index(self, cached: xarray.Dataset | None) -> dict[tuple, int]:
+        """Map the (row, col) indices of the cached cells to their cache position."""
+
+        if cached is None:
+            return {}
+
+        return {
+            (row, col): idx
+            for idx, (row, col) in enumerate(
+                zip(cached["row"].values.tolist(), cached["col"].values.tolist())
+            )
+        }
+
+    def missing(
+        self, variable: str, files: list[Path], rows: np.ndarray, cols: np.ndarray
+    ) -> np.ndarray:
+        """Find which of a set of cells are not in the cache for a variable.
+
+        Args:
+            variable: The variable name.
+            files: The source files for the variable.
+            rows: The row indices of the cells.
+            cols: The column indices of the cells.
+
+        Returns:
+            A boolean array that is True for cells missing from the cache.
+        """
+
+        cell_index = self._cell_index(self.load(variable, files))
+
+        return np.array(
+            [(row, col) not in cell_index for row, col in zip(rows, cols)], dtype=bool
+        ).reshape(-1)
+
+    def add(
+        self,
+        variable: str,
+        files: list[Path],
+        times: np.ndarray,
+        values: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+    ) -> None:
+        """Add the time series for a set of new cells to the cache for a variable.
+
+        Args:
+            variable: The variable name.
+            files: The source files for the variable.
+            times: The time values.
+            values: A (time, cells) array of values for the cells.
+            rows: The row indices of the cells.
+            cols: The column indices of the cells.
+        """
+
+        new_data = xarray.Dataset(
+            data_vars={"values": (("time", "cell"), values)},
+            coords={
+                "time": times,
+                "row": ("cell", np.asarray(rows, dtype="int64")),
+                "col": ("cell", np.asarray(cols, dtype="int64")),
+            },
+        )
+
+        cached = self.load(variable, files)
+
+        if cached is not None:
+            new_data = xarray.concat(
+                [cached, new_data], dim="cell", join="outer", combine_attrs="drop"
+            )
+
+        self.save(variable, files, new_data)
+
+    def read(
+        self, variable: str, files: list[Path], rows: np.ndarray, cols: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Read the time series for a set of cells from the cache for a variable.
+
+        Args:
+            variable: The variable name.
+            files: The source files for the variable.
+            rows: The row indices of the cells, which must all be in the cache.
+            cols: The column indices of the cells.
+
+        Returns:
+            A tuple of the times and a (time, cells) array of values for the cells.
+        """
+
+        cached = self.load(variable, files)
+        cell_index = self._cell_index(cached)
+
+        requested = [cell_index[(row, col)] for row, col in zip(rows, cols)]
+
+        return cached["time"].values, cached["values"].values[:, requested]
+
+    def get(
+        self,
+        variable: str,
+        files: list[Path],
+        rows: np.ndarray,
+        cols: np.ndarray,
+        extract: Callable,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Get the time series for a set of cells, extracting any uncached cells.
+
+        The extract function is only called for cells that are not already in the cache,
+        using ``extract(files, variable, rows, cols)``, and must return a tuple of the
+        times and a (time, cells) array of values. The newly extracted cells are then
+        added to the cache.
+
+        Args:
+            variable: The variable name.
+            files: The source files for the variable.
+            rows: The row indices of the cells.
+            cols: The column indices of the cells.
+            extract: A function to extract the time series for cells from the files.
+
+        Returns:
+            A tuple of the times and a (time, cells) array of values for the cells.
+        """
+
+        rows = np.asarray(rows, dtype="int64")
+        cols = np.asarray(cols, dtype="int64")
+
+        missing = self.missing(variable, files, rows, cols)
+
+        if missing.any():
+            new_cells = np.unique(
+                np.stack([rows[missing], cols[missing]], axis=1), axis=0
+            )
+            times, values = extract(files, variable, new_cells[:, 0], new_cells[:, 1])
+            self.add(variable, files, times, values, new_cells[:, 0], new_cells[:, 1])
+
+        return self.read(variable, files, rows, cols)
+
+
+def _file_list(files: list[Path]) -> str:
+    """Get a string identifying a set of source files by name, size and mtime."""
+
+    entries = []
+    for each_file in files:
+        stat = Path(each_file).stat()
+        entries.append(f"{Path(each_file).name} {stat.st_size} {stat.st_mtime_ns}")
+
+    return "\n".join(sorted(entries))
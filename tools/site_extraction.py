@@ -0,0 +1,597 @@
+"""Extraction of site time series from multiple gridded data products.
+
+This module provides the extract_sites function and a command line tool to extract the
+time series for a set of sites from one or more of the gridded products held in the
+LEMONTREE project space and merge them into a single dataset:
+
+    python site_extraction.py sites.csv site_data.nc \
+        --products wfde5:Tair,Qair snu_fapar soilmstress_mengoli \
+        --start 1982-01-01 --end 2019-12-31 --monthly \
+        --id-column Ecoregion_Location --lat-column Lat --lon-column Long
+
+The products are defined in the PRODUCTS dictionary below and a product name can be
+followed by a comma separated list of the variables to extract. The reads are planned
+for each product before any data is read:
+
+* The sites are resolved to the nearest grid cells for each product once and only the
+  unique cells are read.
+* Only the files dated within the ``--start`` and ``--end`` time window are read,
+  using the dates in the file names.
+* Products where all variables are stored in the same files are read using a single
+  task per file, so each file is opened once to read all of the variables for all of
+  the sites. Within each file the cells are read in groups sharing a storage chunk.
+* If a cache directory is provided, the cells for each variable that are already in the
+  site cache are not read again. The cache holds the full series for each cell from
+  the whole archive, so that it can be reused for any time window, and the window is
+  applied to the cached data.
+* The tasks for all of the products are submitted to a single pool of worker
+  processes, so the products are read in parallel.
+
+With the ``--monthly`` option, products with sub-monthly data are reduced to monthly
+means of the time steps within the time window as each file is read, so months split by
+the window are averaged over the part of the month within the window. Cached monthly
+means cover whole months, so the months at either end of the window are read again from
+the files covering them. Otherwise, the time dimension for each product is taken from
+the PRODUCTS definition and products sharing a time dimension are aligned using an outer
+join.
+"""
+
+import argparse
+import os
+import re
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray
+
+from point_extractor import (
+    SiteGridIndex,
+    combine_monthly,
+    combine_series,
+    monthly_file_sums,
+    read_file_cells,
+    site_data_array,
+)
+from site_cache import SiteCache
+
+# The default root of the LEMONTREE project space
+ROOT = Path("/rds/general/project/lemontree/live")
+
+# The gridded products available for extraction. The files are given as a glob pattern
+# relative to the project root, which can include a {variable} placeholder for products
+# that store each variable in separate files. The lat and lon entries give the names of
+# the coordinate variables, time_dim gives the name of the time dimension in the output
+# and sub_monthly shows whether the data can be reduced to monthly means. The optional
+# file_dates entry is a regular expression matching the year, and optionally the month,
+# covered by each file in the file names, which is used to select the files within a
+# time window without opening them.
+PRODUCTS = {
+    "wfde5": dict(
+        files="source/wfde5/wfde5_v2/{variable}/*/*.nc",
+        file_dates=r"_(?P<year>\d{4})(?P<month>\d{2})_v[\d.]+\.nc$",
+        variables=["PSurf", "Qair", "SWdown", "Tair"],
+        lat="lat",
+        lon="lon",
+        time_dim="time",
+        sub_monthly=True,
+    ),
+    "snu_fapar": dict(
+        files="source/SNU_005_Version_1/FPAR_daily_by_month/*.nc",
+        file_dates=r"_(?P<year>\d{4})_(?P<month>\d{2})\.nc$",
+        variables=["FPAR"],
+        lat="latitude",
+        lon="longitude",
+        time_dim="time",
+        sub_monthly=True,
+    ),
+    "splash_cru_ts4.07": dict(
+        files="derived/splash_cru_ts4.07/data/splash_cru_ts4.07_*.nc",
+        file_dates=r"_(?P<year>\d{4})\.nc$",
+        variables=["aet", "wn", "pre", "pet"],
+        lat="lat",
+        lon="lon",
+        time_dim="time",
+        sub_monthly=True,
+    ),
+    "soilmstress_mengoli": dict(
+        files="derived/aridity/data/soilmstress_mengoli_*.nc",
+        file_dates=r"_(?P<year>\d{4})\.nc$",
+        variables=["soilmstress_mengoli"],
+        lat="lat",
+        lon="lon",
+        time_dim="time",
+        sub_monthly=True,
+    ),
+    "annual_aridity_indices": dict(
+        files="derived/aridity/data/annual_aridity_indices.nc",
+        variables=["aridity_index"],
+        lat="lat",
+        lon="lon",
+        time_dim="year",
+        sub_monthly=False,
+    ),
+    "monthly_potential_gpp": dict(
+        files="derived/potential_gpp/data/monthly_potential_gpp_*.nc",
+        variables=[
+            "pot_gpp_c3_default_kphio",
+            "pot_gpp_c4_default_kphio",
+            "pot_gpp_c3_max_kphio",
+            "pot_gpp_c4_max_kphio",
+            "mean_monthly_water_stress",
+        ],
+        lat="lat",
+        lon="lon",
+        time_dim="month",
+        sub_monthly=False,
+    ),
+}
+
+
+def file_dates(
+    path: Path, pattern: str | None
+) -> tuple[np.datetime64, np.datetime64] | None:
+    """Get the dates covered by a file from the year and month in the file name.
+
+    Args:
+        path: The file.
+        pattern: A regular expression with a ``year`` group and an optional ``month``
+            group, or None if the file names are not dated.
+
+    Returns:
+        The start of the period covered by the file and the start of the following
+        period, or None if the file name is not dated.
+    """
+
+    match = None if pattern is None else re.search(pattern, path.name)
+    if match is None:
+        return None
+
+    if match.groupdict().get("month") is None:
+        first = np.datetime64(match["year"], "Y")
+    else:
+        first = np.datetime64(f"{match['year']}-{match['month']}", "M")
+
+    return first.astype("datetime64[D]"), (first + 1).astype("datetime64[D]")
+
+
+def files_in_window(
+    files: list[Path],
+    pattern: str | None,
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+) -> list[Path]:
+    """Select the files with dates in the file names that overlap a time window.
+
+    Files are not filtered if their names are not dated.
+
+    Args:
+        files: The files.
+        pattern: The ``file_dates`` pattern for the product.
+        start: An optional start date for the time window.
+        end: An optional end date for the time window.
+    """
+
+    selected = []
+    for each_file in files:
+        dates = file_dates(each_file, pattern)
+        if dates is not None:
+            first, stop = dates
+            before = start is not None and stop <= start
+            after = end is not None and first > end
+            if before or after:
+                continue
+        selected.append(each_file)
+
+    return selected
+
+
+def boundary_files(
+    files: list[Path],
+    pattern: str | None,
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+) -> list[Path]:
+    """Select the files covering the months at either end of a time window.
+
+    Args:
+        files: The files.
+        pattern: The ``file_dates`` pattern for the product.
+        start: An optional start date for the time window.
+        end: An optional end date for the time window.
+    """
+
+    selected = []
+    for edge in (start, end):
+        if edge is not None:
+            month = np.datetime64(edge, "M")
+            month_end = (month + 1).astype("datetime64[s]") - np.timedelta64(1, "s")
+            selected.extend(files_in_window(files, pattern, month, month_end))
+
+    return list(dict.fromkeys(selected))
+
+
+def plan_reads(
+    products: list[str],
+    sites: pd.DataFrame,
+    monthly: bool,
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+    root: Path = ROOT,
+    cache_dir: Path | None = None,
+) -> list[dict]:
+    """Plan the reads needed to extract a set of products for a set of sites.
+
+    Each planned read is a set of files that are read together, along with the
+    variables and grid cells to read from those files.
+
+    Args:
+        products: The product names, optionally followed by a colon and a comma
+            separated list of variables.
+        sites: A data frame with site_id, lat and lon columns.
+        monthly: Should sub-monthly products be reduced to monthly means.
+        start: An optional start date for the time window.
+        end: An optional end date for the time window.
+        root: The root of the project space.
+        cache_dir: An optional site cache directory.
+
+    Returns:
+        A list of dictionaries describing each read.
+    """
+
+    reads = []
+
+    for product_spec in products:
+        product, _, variable_list = product_spec.partition(":")
+
+        if product not in PRODUCTS:
+            raise ValueError(f"Unknown product: {product}")
+
+        config = PRODUCTS[product]
+        variables = variable_list.split(",") if variable_list else config["variables"]
+
+        unknown = set(variables).difference(config["variables"])
+        if unknown:
+            raise ValueError(f"Unknown variables for {product}: {', '.join(unknown)}")
+
+        to_monthly = monthly and config["sub_monthly"]
+        cache = None
+        if cache_dir is not None:
+            source = f"{product}_monthly_mean" if to_monthly else product
+            cache = SiteCache(cache_dir, source)
+
+        # Split the variables into groups sharing the same files
+        if "{variable}" in config["files"]:
+            groups = [[variable] for variable in variables]
+        else:
+            groups = [variables]
+
+        site_index = None
+
+        for group in groups:
+            pattern = config["files"].format(variable=group[0])
+            archive_files = sorted(root.glob(pattern))
+
+            if not archive_files:
+                raise FileNotFoundError(f"No files found for {product}: {pattern}")
+
+            files = files_in_window(archive_files, config.get("file_dates"), start, end)
+
+            if not files:
+                raise FileNotFoundError(
+                    f"No files found for {product} in the time window: {pattern}"
+                )
+
+            # All of the files for a product share a grid, so only find the site cells
+            # once for each product.
+            if site_index is None:
+                site_index = SiteGridIndex.from_file(
+                    files[0],
+                    sites["site_id"],
+                    sites["lat"],
+                    sites["lon"],
+                    lat_name=config["lat"],
+                    lon_name=config["lon"],
+                )
+
+            cells = (site_index.cell_rows, site_index.cell_cols)
+
+            # Find the cells that need to be read for each variable and hence the
+            # cells to read for the group. The cache is keyed on the whole archive and
+            # stores the full series for each cell, so uncached cells are read from all
+            # of the files and the window is applied later. Cached monthly means cover
+            # whole months, so the months at the ends of the window are read again.
+            if cache is None:
+                missing = {v: np.ones(len(cells[0]), dtype=bool) for v in group}
+                read_files = files
+                edge_files = []
+            else:
+                missing = {v: cache.missing(v, archive_files, *cells) for v in group}
+                read_files = archive_files
+                edge_files = (
+                    boundary_files(files, config.get("file_dates"), start, end)
+                    if to_monthly
+                    else []
+                )
+
+            read_cells = np.logical_or.reduce(list(missing.values()))
+
+            reads.append(
+                dict(
+                    product=product,
+                    files=archive_files,
+                    read_files=read_files,
+                    boundary_files=edge_files,
+                    variables=group,
+                    site_index=site_index,
+                    missing=missing,
+                    read_cells=read_cells,
+                    monthly=to_monthly,
+                    time_dim="time" if to_monthly else config["time_dim"],
+                    cache=cache,
+                )
+            )
+
+    return reads
+
+
+def _read_result(
+    read: dict, futures: list, boundary_futures: list
+) -> dict[str, xarray.DataArray]:
+    """Combine the file results for a planned read and return the site data.
+
+    Any newly read cells are added to the site cache for the read.
+
+    Args:
+        read: The planned read.
+        futures: The futures for the file tasks for the read.
+        boundary_futures: The futures for the monthly sums within the time window
+            for the files covering the months at the ends of the window.
+    """
+
+    site_index = read["site_index"]
+    cell_rows, cell_cols = site_index.cell_rows, site_index.cell_cols
+    read_cells = read["read_cells"]
+    variables = read["variables"]
+
+    results = (future.result() for future in futures)
+    combine = combine_monthly if read["monthly"] else combine_series
+
+    if read_cells.any():
+        times, data = combine(results, variables, int(read_cells.sum()))
+
+    if boundary_futures:
+        boundary_months, boundary_data = combine_monthly(
+            (future.result() for future in boundary_futures),
+            variables,
+            len(cell_rows),
+        )
+
+    site_data = {}
+
+    for variable in variables:
+        if read["cache"] is None:
+            values = data[variable]
+        else:
+            # Add the cells missing for this variable to the cache and then read all of
+            # the cells back from the cache
+            missing = read["missing"][variable]
+            cache_args = (variable, read["files"])
+
+            if missing.any():
+                read["cache"].add(
+                    *cache_args,
+                    times,
+                    data[variable][:, missing[read_cells]],
+                    cell_rows[missing],
+                    cell_cols[missing],
+                )
+
+            cached_times, values = read["cache"].read(
+                *cache_args, cell_rows, cell_cols
+            )
+
+            # Replace the cached means for the months split by the window
+            if boundary_futures:
+                month_index = {month: idx for idx, month in enumerate(cached_times)}
+                values = values.copy()
+                for idx, month in enumerate(boundary_months):
+                    if month in month_index:
+                        values[month_index[month]] = boundary_data[variable][idx]
+
+        site_data[variable] = site_data_array(
+            times if read["cache"] is None else cached_times,
+            values,
+            variable,
+            site_index,
+        ).rename(time=read["time_dim"])
+
+    return site_data
+
+
+def extract_sites(
+    sites: pd.DataFrame,
+    products: list[str],
+    start: np.datetime64 | None = None,
+    end: np.datetime64 | None = None,
+    monthly: bool = False,
+    root: Path = ROOT,
+    cache_dir: Path | None = None,
+    workers: int = 1,
+) -> xarray.Dataset:
+    """Extract time series for a set of sites from a set of gridded products.
+
+    Args:
+        sites: A data frame with site_id, lat and lon columns.
+        products: The product names, optionally followed by a colon and a comma
+            separated list of variables.
+        start: An optional start date for the time window.
+        end: An optional end date for the time window.
+        monthly: Should sub-monthly products be reduced to monthly means.
+        root: The root of the project space.
+        cache_dir: An optional site cache directory.
+        workers: The number of worker processes.
+
+    Returns:
+        A dataset of the site data for all of the requested variables.
+    """
+
+    reads = plan_reads(
+        products, sites, monthly, start=start, end=end, root=root, cache_dir=cache_dir
+    )
+
+    site_arrays = []
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Submit the file tasks for all of the reads before collecting any results, so
+        # that the products are read in parallel.
+        read_futures = []
+        for read in reads:
+            variables = read["variables"]
+            cell_rows = read["site_index"].cell_rows
+            cell_cols = read["site_index"].cell_cols
+            rows = cell_rows[read["read_cells"]]
+            cols = cell_cols[read["read_cells"]]
+            futures = []
+
+            # Uncached monthly reads apply the time window to the sub-monthly time
+            # steps, but the cache stores the full series
+            file_window = (start, end) if read["cache"] is None else (None, None)
+
+            if read["read_cells"].any():
+                futures = [
+                    executor.submit(
+                        monthly_file_sums, f, variables, rows, cols, *file_window
+                    )
+                    if read["monthly"]
+                    else executor.submit(read_file_cells, f, variables, rows, cols)
+                    for f in read["read_files"]
+                ]
+
+            boundary_futures = [
+                executor.submit(
+                    monthly_file_sums, f, variables, cell_rows, cell_cols, start, end
+                )
+                for f in read["boundary_files"]
+            ]
+
+            read_futures.append((futures, boundary_futures))
+
+        for read, (futures, boundary_futures) in zip(reads, read_futures):
+            site_data = _read_result(read, futures, boundary_futures)
+
+            # Reduce to the time window
+            for data_array in site_data.values():
+                time_dim = data_array.dims[0]
+                if read["monthly"]:
+                    # The window has already been applied to the sub-monthly data, so
+                    # keep the months labelled with the first day of each month
+                    window = slice(
+                        None if start is None else start.astype("datetime64[M]"), end
+                    )
+                elif np.issubdtype(data_array[time_dim].dtype, np.datetime64):
+                    window = slice(start, end)
+                else:
+                    # Integer time values, such as years
+                    window = slice(
+                        None if start is None else start.astype(object).year,
+                        None if end is None else end.astype(object).year,
+                    )
+                site_arrays.append(data_array.sel({time_dim: window}))
+
+    return xarray.merge(site_arrays, join="outer", compat="no_conflicts")
+
+
+def site_extraction_cli():
+    """Extract site time series from gridded data products.
+
+    This tool reads a CSV file of site ids and locations and extracts the time series
+    for one or more gridded data products at the nearest grid cell to each site. The
+    results are merged into a single NetCDF file.
+
+    The available products and their variables are:
+    """
+
+    product_list = "\n".join(
+        f"  {name}: {', '.join(config['variables'])}"
+        for name, config in PRODUCTS.items()
+    )
+
+    parser = argparse.ArgumentParser(
+        description=textwrap.dedent(site_extraction_cli.__doc__) + product_list,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument("site_file", type=Path, help="A CSV file of site locations")
+    parser.add_argument("out_file", type=Path, help="The output NetCDF file")
+    parser.add_argument(
+        "--products",
+        nargs="+",
+        required=True,
+        help="Products to extract, optionally as product:var1,var2",
+    )
+    parser.add_argument("--start", type=np.datetime64, help="Start of the time window")
+    parser.add_argument("--end", type=np.datetime64, help="End of the time window")
+    parser.add_argument(
+        "--monthly",
+        action="store_true",
+        help="Reduce sub-monthly products to monthly means",
+    )
+    parser.add_argument(
+        "--id-column", default="site_id", help="The site id column (default: site_id)"
+    )
+    parser.add_argument(
+        "--lat-column", default="lat", help="The latitude column (default: lat)"
+    )
+    parser.add_argument(
+        "--lon-column", default="lon", help="The longitude column (default: lon)"
+    )
+    parser.add_argument(
+        "--root",
+        type=Path,
+        default=ROOT,
+        help=f"The project root (default: {ROOT})",
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path, help="An optional site cache directory"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("NCPUS", 1)),
+        help="The number of worker processes (default: NCPUS or 1)",
+    )
+
+    args = parser.parse_args()
+
+    # Load the sites, allowing for a byte order mark at the start of the file
+    sites = pd.read_csv(args.site_file, encoding="utf-8-sig")
+    sites = sites.rename(
+        columns={
+            args.id_column: "site_id",
+            args.lat_column: "lat",
+            args.lon_column: "lon",
+        }
+    )
+
+    site_data = extract_sites(
+        sites,
+        products=args.products,
+        start=args.start,
+        end=args.end,
+        monthly=args.monthly,
+        root=args.root,
+        cache_dir=args.cache_dir,
+        workers=args.workers,
+    )
+
+    site_data.to_netcdf(args.out_file)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    site_extraction_cli()
@@ -0,0 +1,101 @@
+"""Streaming linear interpolation of time series to a finer time step.
+
+Interpolating a whole year of sub-daily data to a finer time step in memory, for example
+using ``xarray.Dataset.resample(time="1h").interpolate("linear")``, needs the full
+source and the much larger interpolated result in memory at once. The
+LinearInterpolator class in this module instead interpolates blocks of source time
+steps as they are read:
+
+* The interpolation weights for the output steps within each source interval are
+  precomputed once, and each block is interpolated with a single vectorized
+  calculation.
+* The last source step of each block is carried over to the next block, so that the
+  interval spanning the boundary between blocks is interpolated correctly and the
+  output from the blocks is continuous.
+* The data can have any trailing dimensions, so the interpolation can be applied
+  directly to land cell vectors in the gathered format (see gathered_grids.py) rather
+  than to full grids.
+
+The output from interpolating the blocks in turn is identical to linear interpolation of
+the whole series: output steps start at the first source step and end at the last source
+step, unless a following source step is provided to complete the final interval.
+"""
+
+import numpy as np
+
+
+def linear_weights(ratio: int, dtype: str = "float32") -> np.ndarray:
+    """Get the weights of the next source step for output steps in a source interval.
+
+    Args:
+        ratio: The number of output steps per source step.
+        dtype: The data type of the weights.
+    """
+
+    if ratio < 1:
+        raise ValueError(f"Invalid interpolation ratio: {ratio}")
+
+    return (np.arange(ratio) / ratio).astype(dtype)
+
+
+class LinearInterpolator:
+    """Linear interpolation of a series of source steps supplied in blocks.
+
+    Args:
+        ratio: The number of output steps per source step.
+        dtype: The data type used for the calculation and the output.
+    """
+
+    def __init__(self, ratio: int, dtype: str = "float32"):
+        self.ratio = ratio
+        self.dtype = dtype
+        self.weights = linear_weights(ratio, dtype)
+        self.carry: np.ndarray | None = None
+
+    def push(self, block: np.ndarray) -> np.ndarray:
+        """Interpolate a block of source steps.
+
+        The output covers the intervals between the step carried over from the previous
+        block and the source steps in this block, so the first block gives no output for
+        its last step until the next block or ``finish`` is called.
+
+        Args:
+            block: The source data, with time as the first dimension.
+
+        Returns:
+            The interpolated data, with time as the first dimension.
+        """
+
+        block = np.asarray(block, dtype=self.dtype)
+        if self.carry is not None:
+            block = np.concatenate([self.carry[None], block], axis=0)
+
+        if not block.shape[0]:
+            return block
+
+        self.carry = block[-1].copy()
+
+        # Interpolate all of the intervals as start + weight * (end - start), giving an
+        # array of shape (interval, ratio, ...) that is flattened along the time axes.
+        start = block[:-1, None]
+        change = block[1:, None] - start
+        weights = self.weights.reshape((1, self.ratio) + (1,) * (block.ndim - 1))
+        output = start + weights * change
+
+        return output.reshape((-1,) + block.shape[1:])
+
+    def finish(self) -> np.ndarray:
+        """Get the final output step, which is the last source step.
+
+        Returns:
+            The final step, with a time dimension of length one, or an empty array if
+            no data have been interpolated.
+        """
+
+        if self.carry is None:
+            return np.empty((0,), dtype=self.dtype)
+
+        final = self.carry[None]
+        self.carry = None
+
+        return final
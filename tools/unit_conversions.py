@@ -0,0 +1,204 @@
+"""Unit conversions for forcing variables.
+
+This module provides named unit conversions for the forcing variables used in the
+different modelling pipelines. The conversions are written for large regional or global
+arrays and avoid the full size temporary arrays created by expressions such as
+``(rsds * 1e6) / (24 * 60 * 60) * 2.04``:
+
+* By default, the conversions are applied in place, using the ``out`` argument of the
+  numpy ufuncs so that each step overwrites the input array.
+* Alternatively, an ``out`` array can be provided to hold the converted values, which
+  leaves the input data unchanged.
+
+The output array must have a floating point dtype and the conversions preserve that
+dtype, so that float32 data is not promoted to float64. The converted array is returned.
+
+Conversions that need more than one input, or that call ``pyrealm`` functions that
+allocate intermediate arrays, are applied in blocks along the first axis to limit the
+size of those intermediate arrays.
+"""
+
+import numpy as np
+
+# The default number of array elements to process at once for blocked conversions
+BLOCK_SIZE = 2**22
+
+# The conversion from W m-2 to PPFD in µmol m-2 s-1: 1 W m-2 ~ 4.57 µmol m-2 s-1 and
+# roughly 44% of shortwave radiation is photosynthetically active, so 4.57 * 0.44 ~ 2.04
+SWDOWN_TO_PPFD = 2.04
+
+# CHELSA rsds in MJ m-2 day-1 to PPFD in µmol m-2 s-1: MJ to J, per day to per second
+# and then W m-2 to PPFD.
+CHELSA_RSDS_TO_PPFD = 1e6 / (24 * 60 * 60) * SWDOWN_TO_PPFD
+
+
+def _get_output(data: np.ndarray, out: np.ndarray | None) -> np.ndarray:
+    """Get and validate the output array for a conversion.
+
+    Args:
+        data: The input data.
+        out: An optional output array, defaulting to the input data.
+    """
+
+    if out is None:
+        out = data
+
+    if not isinstance(out, np.ndarray) or not np.issubdtype(out.dtype, np.floating):
+        raise TypeError("Conversions require a floating point numpy output array")
+
+    if out.shape != np.shape(data):
+        raise ValueError(f"Output shape {out.shape} does not match {np.shape(data)}")
+
+    return out
+
+
+def _block_slices(shape: tuple[int, ...], block_size: int = BLOCK_SIZE):
+    """Generate slices along the first axis containing at most block_size elements.
+
+    Args:
+        shape: The array shape.
+        block_size: The maximum number of elements in a block, unless a single slice
+            along the first axis is larger.
+    """
+
+    if len(shape) == 0:
+        yield ...
+        return
+
+    row_size = int(np.prod(shape[1:]))
+    step = max(1, block_size // max(row_size, 1))
+
+    for start in range(0, shape[0], step):
+        yield slice(start, start + step)
+
+
+def chelsa_tas_to_celsius(
+    data: np.ndarray, out: np.ndarray | None = None, min_celsius: float | None = -25.0
+) -> np.ndarray:
+    """Convert CHELSA tas from Kelvin / 10 to °C.
+
+    Args:
+        data: The CHELSA tas data.
+        out: An optional output array, defaulting to converting in place.
+        min_celsius: An optional lower limit used to clip the temperatures.
+    """
+
+    out = _get_output(data, out)
+    np.divide(data, 10, out=out)
+    np.subtract(out, 273.15, out=out)
+
+    if min_celsius is not None:
+        np.maximum(out, min_celsius, out=out)
+
+    return out
+
+
+def chelsa_pr_to_mm(data: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """Convert CHELSA pr from kg m-2 month-1 * 100 to mm month-1.
+
+    This approximates 1 kg m-2 as 1 litre m-2, which is 1 mm.
+
+    Args:
+        data: The CHELSA pr data.
+        out: An optional output array, defaulting to converting in place.
+    """
+
+    out = _get_output(data, out)
+    np.divide(data, 100, out=out)
+
+    return out
+
+
+def cloud_to_sunshine_fraction(
+    data: np.ndarray, out: np.ndarray | None = None
+) -> np.ndarray:
+    """Convert percentage cloud cover to sunshine fraction as ``1 - (cloud / 100)``.
+
+    This is used for both CHELSA clt and CRU TS cld data.
+
+    Args:
+        data: The cloud cover percentage data.
+        out: An optional output array, defaulting to converting in place.
+    """
+
+    out = _get_output(data, out)
+    np.divide(data, -100, out=out)
+    np.add(out, 1, out=out)
+
+    return out
+
+
+# CHELSA clt is a cloud cover percentage
+chelsa_clt_to_sunshine_fraction = cloud_to_sunshine_fraction
+
+
+def chelsa_rsds_to_ppfd(data: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """Convert CHELSA rsds in MJ m-2 day-1 to PPFD in µmol m-2 s-1.
+
+    The CHELSA rsds data are integers scaled by a factor of 0.001, which is applied
+    automatically when the files are loaded, so the input data should be in MJ m-2
+    day-1. The conversion is a single multiplication by
+    ``1e6 / (24 * 60 * 60) * 2.04``.
+
+    Args:
+        data: The CHELSA rsds data in MJ m-2 day-1.
+        out: An optional output array, defaulting to converting in place.
+    """
+
+    out = _get_output(data, out)
+    np.multiply(data, CHELSA_RSDS_TO_PPFD, out=out)
+
+    return out
+
+
+def swdown_to_ppfd(data: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """Convert shortwave downwelling radiation in W m-2 to PPFD in µmol m-2 s-1.
+
+    This is used for both WFD and WFDE5 SWdown data.
+
+    Args:
+        data: The shortwave downwelling radiation data in W m-2.
+        out: An optional output array, defaulting to converting in place.
+    """
+
+    out = _get_output(data, out)
+    np.multiply(data, SWDOWN_TO_PPFD, out=out)
+
+    return out
+
+
+def cru_vap_to_vpd(
+    vap: np.ndarray,
+    tmp: np.ndarray,
+    out: np.ndarray | None = None,
+    block_size: int = BLOCK_SIZE,
+) -> np.ndarray:
+    """Convert CRU TS vapour pressure in hPa to VPD in Pa.
+
+    The vapour pressure is converted from hPa to kPa and then to VPD in kPa using the
+    ``pyrealm`` function ``convert_vp_to_vpd``, then converted to Pa and values below
+    zero are clipped to zero. The calculation is applied in blocks along the first axis.
+
+    Args:
+        vap: The CRU TS vapour pressure data in hPa.
+        tmp: The CRU TS air temperature data in °C.
+        out: An optional output array, defaulting to converting ``vap`` in place.
+        block_size: The maximum number of elements to process at once.
+    """
+
+    from pyrealm.core.hygro import convert_vp_to_vpd
+
+    out = _get_output(vap, out)
+
+    if np.shape(tmp) != out.shape:
+        raise ValueError(
+            f"Temperature shape {np.shape(tmp)} does not match {out.shape}"
+        )
+
+    for block in _block_slices(out.shape, block_size):
+        vpd = convert_vp_to_vpd(vp=vap[block] / 10, ta=tmp[block])
+        np.multiply(vpd, 1000, out=out[block], casting="same_kind")
+
+    np.maximum(out, 0, out=out)
+
+    return out